@@ -0,0 +1,56 @@
+# Import analysis/plotting/simulation modules
+import analysis.event
+import analysis.hitfinding
+import plotting.image
+import plotting.line
+import simulation.base
+from backend.pipeline import Pipeline
+
+# Simulate diffraction data  
+sim = simulation.base.Simulation()
+sim.hitrate = 0.1
+sim.sigma = 1
+
+# Specify the facility
+state = {}
+state['Facility'] = 'Dummy'
+
+# Create a dummy facility
+state['Dummy'] = {
+    # The event repetition rate of the dummy facility [Hz]
+    'Repetition Rate' : 20,
+    # Specify simulation
+    'Simulation': sim,
+    # Dictionary of data sources
+    'Data Sources': {
+        # Data from a virtual diffraction detector
+        'CCD': {
+            # Fetch diffraction data from the simulation
+            'data': sim.get_pattern,
+            'unit': 'ADU',
+            'type': 'photonPixelDetectors'
+        }
+    }
+}
+
+# The analysis is split into stages, stages that depend on
+# a gated stage are skipped for every event that is not a hit
+pipeline = Pipeline(report_interval=10)
+
+@pipeline.stage()
+def hitfinding(evt):
+    # Processing rate [Hz]
+    analysis.event.printProcessingRate()
+    # Simple hit finding (counting the number of lit pixels)
+    analysis.hitfinding.countLitPixels(evt, evt["photonPixelDetectors"]["CCD"], aduThreshold=10, hitscoreThreshold=100)
+    analysis.hitfinding.hitrate(evt, evt["analysis"]["litpixel: isHit"].data, history=5000)
+    plotting.line.plotHistory(evt["analysis"]["litpixel: hitscore"], label='Nr. of lit pixels', hline=100, group="A")
+    plotting.line.plotHistory(evt["analysis"]["hitrate"], label='Hit rate [%]', group="B")
+
+# Only runs for hits
+@pipeline.stage(after=["hitfinding"], gate="litpixel: isHit")
+def hits(evt):
+    plotting.image.plotImage(evt["photonPixelDetectors"]["CCD"], vmin=-10, vmax=40, group="Detectors")
+
+# The pipeline is called for every single event
+onEvent = pipeline
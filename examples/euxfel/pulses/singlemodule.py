@@ -25,6 +25,7 @@ state['EuXFEL/FirstCell'] = 1
 state['EuXFEL/LastCell'] = 100
 state['EuXFEL/BadCells'] = [18+i*32 for i in range((state['EuXFEL/LastCell']+18)//32)]
 state['EuXFEL/SkipNrPulses'] = 0
+state['EuXFEL/PulsesPerEvent'] = 1
 
 def onEvent(evt):
 
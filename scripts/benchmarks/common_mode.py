@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""Times the common mode correction of a 1024x1024 float32 pnCCD frame along the
+rows of its halves and along the columns and rows of its quadrants, with the
+precomputed correction and with the previous correction of one segment and
+axis at a time.
+
+    python scripts/benchmarks/common_mode.py [nr. of frames] [batch size]
+"""
+from __future__ import print_function, absolute_import
+import os, sys, time, warnings
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)) + "/../../src")
+from analysis.pixel_detector import _cmc
+from utils.common_mode import CommonMode
+
+nframes = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+batch = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+shape = (1024, 1024)
+frames = (np.random.normal(0, 1, (nframes,) + shape) + np.random.normal(0, 5, (nframes, shape[0], 1))).astype(np.float32)
+mask = np.random.random(shape) > 0.05
+warnings.simplefilter('ignore')
+
+def previous(frame, quadrants, signal_threshold):
+    h, w = shape[0]//2, shape[1]//2
+    if quadrants:
+        segments = [np.s_[:h, :w], np.s_[h:, :w], np.s_[:h, w:], np.s_[h:, w:]]
+    else:
+        segments = [np.s_[:, :w], np.s_[:, w:]]
+    for s in segments:
+        for axis in ([0, 1] if quadrants else [1]):
+            _cmc(frame[s], msk=mask[s], axis=axis, signal_threshold=signal_threshold)
+
+for quadrants in [False, True]:
+    for signal_threshold in [None, 10.]:
+        label = "%s, threshold %s" % ("quadrants" if quadrants else "halves", signal_threshold)
+        t0 = time.time()
+        for i in range(nframes):
+            previous(frames[i].copy(), quadrants, signal_threshold)
+        t_previous = time.time() - t0
+        cm = CommonMode(shape, grid=(2, 2) if quadrants else (1, 2), axes=(0, 1) if quadrants else (1,),
+                        mask=mask, signal_threshold=signal_threshold)
+        t0 = time.time()
+        for i in range(nframes):
+            cm.correct(frames[i].copy())
+        t_frame = time.time() - t0
+        t0 = time.time()
+        for i in range(0, nframes, batch):
+            cm.correct(frames[i:i+batch].copy())
+        t_batch = time.time() - t0
+        print("%-26s previous %6.1f ms/frame, frame %6.1f ms/frame, batch of %d %6.1f ms/frame" %
+              (label, 1000.*t_previous/nframes, 1000.*t_frame/nframes, batch, 1000.*t_batch/nframes))
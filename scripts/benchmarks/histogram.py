@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+"""Times binning the new values of a ring buffer into the interface histograms,
+as done on every replot, with the vectorised histograms and with the previous
+loop over the values.
+
+    python scripts/benchmarks/histogram.py [nr. of values] [nr. of bins]
+"""
+from __future__ import print_function, absolute_import
+import os, sys, time
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)) + "/../../src")
+from interface.ringbuffer import RingBuffer
+from interface.ui.plot_window import Histogram, NormalizedHistogram
+
+nvalues = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+bins = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+values = RingBuffer(nvalues)
+values.extend(np.random.normal(5, 2, nvalues))
+pairs = RingBuffer(nvalues)
+pairs.extend(np.random.normal(5, 2, (nvalues, 2)))
+
+def timed(label, histogram, ringbuffer, loop=False):
+    t0 = time.time()
+    if loop:
+        for v in np.array(ringbuffer):
+            if isinstance(histogram, NormalizedHistogram):
+                index = histogram._value_to_index(v[0])
+                if index is not None:
+                    histogram._histogram[index] += v[1]
+                    histogram._weight[index] += 1.
+            else:
+                index = histogram._value_to_index(v)
+                if index is not None:
+                    histogram._histogram[index] += 1
+    else:
+        histogram.add_values_from_ringbuffer(ringbuffer)
+    dt = time.time() - t0
+    print("%-32s %8.3f s (%.2e values/s)" % (label, dt, nvalues/dt))
+
+timed("histogram, loop", Histogram(0, 10, bins), values, loop=True)
+timed("histogram", Histogram(0, 10, bins), values)
+timed("histogram, autorange", Histogram(4, 6, bins, autorange=True), values)
+timed("normalized histogram, loop", NormalizedHistogram(0, 10, bins), pairs, loop=True)
+timed("normalized histogram", NormalizedHistogram(0, 10, bins), pairs)
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""Compares the collective reductions of ipc.mpi.sum (registered with
+ipc.mpi.register_reduction) with the path that funnels all arrays through
+the master, which ipc.mpi.sum takes for reductions that are not registered.
+
+Run with one master and N event readers, e.g. for 8, 32 and 128 readers:
+
+    mpirun -n 9   python scripts/benchmarks/mpi_reduce.py
+    mpirun -n 33  python scripts/benchmarks/mpi_reduce.py
+    mpirun -n 129 python scripts/benchmarks/mpi_reduce.py
+
+Optional arguments are the number of pixels of the summed array
+(default 4194304, i.e. one AGIPD frame) and the number of iterations.
+"""
+from __future__ import print_function, absolute_import
+import os, sys, time
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)) + "/../../src")
+import ipc.mpi
+from mpi4py import MPI
+
+npixels = int(sys.argv[1]) if len(sys.argv) > 1 else 4*1024*1024
+niter = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+if not ipc.mpi.use_mpi:
+    print("Needs to run with at least 2 MPI processes")
+    sys.exit(1)
+ipc.mpi.register_reduction("benchmark - blocking Allreduce", np.ones(npixels, dtype=np.float32))
+ipc.mpi.register_reduction("benchmark - non-blocking", np.ones(npixels, dtype=np.float32))
+ipc.mpi.init_event_reader_comm(0)
+
+def timeit(label, func):
+    array = np.ones(npixels, dtype=np.float32)
+    ipc.mpi.event_reader_comm.Barrier()
+    t0 = time.time()
+    for i in range(niter):
+        func("benchmark - " + label, array)
+        ipc.mpi.progress_reductions()
+    ipc.mpi.event_reader_comm.Barrier()
+    dt = time.time() - t0
+    if ipc.mpi.is_main_event_reader():
+        print("%-22s %3d readers: %8.2f ms per reduction" % (label, ipc.mpi.nr_event_readers(), 1e3*dt/niter))
+
+if ipc.mpi.is_master():
+    while not ipc.mpi.master_loop():
+        pass
+else:
+    timeit("via master", ipc.mpi.sum_via_master)
+    timeit("blocking Allreduce", lambda cmd, a: ipc.mpi.sum(cmd, a, blocking=True))
+    timeit("non-blocking", ipc.mpi.sum)
+    ipc.mpi.slave_done()
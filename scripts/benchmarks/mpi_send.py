@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+"""Measures how many messages per second the master can receive from the
+slaves and hand over to the (batch mode) zmqserver.
+
+    mpirun -n 9 python scripts/benchmarks/mpi_send.py [events] [messages per event] [send window]
+
+A send window of 0 sends every message on its own with a blocking send,
+which is how all messages were sent before batching was introduced.
+"""
+from __future__ import print_function, absolute_import
+import os, sys, time
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)) + "/../../src")
+
+nevents = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+nmessages = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+window = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+# The zmqserver reads the command line, run it in batch mode
+sys.argv = sys.argv[:1] + ['-m']
+
+import ipc
+import ipc.mpi
+
+if not ipc.mpi.use_mpi:
+    print("Needs to run with at least 2 MPI processes")
+    sys.exit(1)
+ipc.mpi.init_event_reader_comm(0)
+ipc.mpi.send_window = window
+
+if ipc.mpi.is_master():
+    ipc.zmq()
+    nslaves = ipc.mpi.nr_slaves()
+    ipc.mpi.comm.Barrier()
+    t0 = time.time()
+    while not ipc.mpi.master_loop():
+        pass
+    dt = time.time() - t0
+    stats = ipc.mpi.master_stats
+    print("send window %d, %d slaves: %.0f data messages/s (%d MPI messages, %d batches) in %.2f s" %
+          (window, nslaves, stats['forwarded']/dt, stats['messages'], stats['batches'], dt))
+else:
+    ipc.mpi.comm.Barrier()
+    for event_id in range(nevents):
+        for i in range(nmessages):
+            title = "scalar %d" % i
+            ipc.mpi.send(title, [None, 'new_data', title, np.random.random(), event_id, {}])
+        ipc.mpi.flush()
+    ipc.mpi.slave_done()
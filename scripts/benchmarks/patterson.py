@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+"""Times the multiple particle score of 1024x1024 images with the cached Patterson
+scorer in single and double precision, image by image and for a stack of images,
+and with a shifted complex inverse FFT in double precision, numpy.median and the
+exclusion mask rebuilt for every image, as done before.
+
+    python scripts/benchmarks/patterson.py [nr. of images] [nr. of FFT workers]
+"""
+from __future__ import print_function, absolute_import
+import os, sys, time
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)) + "/../../src")
+from analysis.patterson import PattersonScorer
+
+nimages = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+shape = (1024, 1024)
+images = np.random.poisson(3, (nimages,) + shape).astype(np.float32)
+mask = np.random.random(shape) > 0.05
+
+def previous(image):
+    P = abs(np.fft.fftshift(np.fft.ifftn(np.fft.ifftshift(np.float64(image)*mask))))
+    P = P / np.median(P)
+    Y, X = np.indices(P.shape)
+    X -= P.shape[1]//2
+    Y -= P.shape[0]//2
+    M = (P > 2.) & (X**2 + Y**2 > 25**2)
+    return M.sum()
+
+n = min(nimages, 5)
+t0 = time.time()
+for i in range(n):
+    previous(images[i])
+print("%-34s %8.1f ms/image" % ("previous", 1000.*(time.time()-t0)/n))
+for single_precision in [False, True]:
+    scorer = PattersonScorer(shape, mask=mask, threshold=2., diameter_pix=50, single_precision=single_precision, workers=workers)
+    label = "single" if single_precision else "double"
+    t0 = time.time()
+    for i in range(nimages):
+        scorer.score(images[i])
+    print("%-34s %8.1f ms/image" % ("cached, %s, image by image" % label, 1000.*(time.time()-t0)/nimages))
+    t0 = time.time()
+    scorer.score(images)
+    print("%-34s %8.1f ms/image" % ("cached, %s, stack" % label, 1000.*(time.time()-t0)/nimages))
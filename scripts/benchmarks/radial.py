@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+"""Times the radial average of a 1024x1024 float32 frame with a mask with the
+precomputed radial bins and with computing the radius of every pixel and
+averaging every rounded radius for every frame, as done by radialMeanImage
+of libspimage.
+
+    python scripts/benchmarks/radial.py [nr. of frames]
+"""
+from __future__ import print_function, absolute_import
+import os, sys, time
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)) + "/../../src")
+from utils.array import RadialIntegrator
+
+nframes = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+shape = (1024, 1024)
+cx, cy = 500.5, 510.2
+frames = np.random.random((nframes,) + shape).astype(np.float32)
+mask = np.random.random(shape) > 0.05
+
+def previous(img):
+    X, Y = np.meshgrid(np.arange(shape[1]), np.arange(shape[0]))
+    R = np.sqrt((X - cx)**2 + (Y - cy)**2).round()
+    R[mask == 0] = -1
+    radii = np.arange(R.min(), R.max()+1, 1)[1:]
+    return radii, np.array([img[R == r].mean() if (R == r).any() else np.nan for r in radii])
+
+t0 = time.time()
+for i in range(min(nframes, 3)):
+    previous(frames[i])
+t_previous = (time.time() - t0) / min(nframes, 3)
+
+t0 = time.time()
+integrator = RadialIntegrator(shape, cx, cy, mask)
+t_init = time.time() - t0
+t0 = time.time()
+for i in range(nframes):
+    integrator.integrate(frames[i])
+t_frame = (time.time() - t0) / nframes
+t0 = time.time()
+integrator.integrate(frames)
+t_stack = (time.time() - t0) / nframes
+
+print("per pixel radii and loop over radii  %8.1f ms/frame" % (1000.*t_previous))
+print("precomputing the radial bins         %8.1f ms" % (1000.*t_init))
+print("precomputed, frame by frame          %8.1f ms/frame" % (1000.*t_frame))
+print("precomputed, stack of %3d frames     %8.1f ms/frame" % (nframes, 1000.*t_stack))
@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+"""Times adding 10^6 scalars to the interface ring buffers,
+one by one with append and in blocks with extend.
+
+    python scripts/benchmarks/ringbuffer.py [nr. of values] [block size] [buffer length]
+"""
+from __future__ import print_function, absolute_import
+import os, sys, time
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)) + "/../../src")
+from interface.ringbuffer import RingBuffer
+
+nvalues = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+block = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+maxlen = int(sys.argv[3]) if len(sys.argv) > 3 else 10000
+values = np.random.random(nvalues)
+
+rb = RingBuffer(maxlen)
+t0 = time.time()
+for v in values:
+    rb.append(v)
+t_append = time.time() - t0
+
+rb = RingBuffer(maxlen)
+t0 = time.time()
+for i in range(0, nvalues, block):
+    rb.extend(values[i:i+block])
+t_extend = time.time() - t0
+
+print("append:               %8.3f s (%.2e values/s)" % (t_append, nvalues/t_append))
+print("extend (blocks of %d): %8.3f s (%.2e values/s)" % (block, t_extend, nvalues/t_extend))
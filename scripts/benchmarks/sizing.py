@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""Times sizing simulated sphere patterns (virus, 414x414 px after binning) with
+analysis.sizing.fitSphereFast, hit by hit and for a batch of hits, and with the
+libspimage fits of analysis.sizing.fitSphere if libspimage is installed.
+
+    python scripts/benchmarks/sizing.py [nr. of hits]
+"""
+from __future__ import print_function, absolute_import
+import os, sys, time
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)) + "/../../src")
+import analysis.sizing
+import utils.io
+from utils.sphere_model import photons_per_pixel
+from backend import Record
+
+nhits = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+shape = (414, 414)
+params = dict(wavelength=0.12398, pixelsize=110*4, distance=2160, material='virus', mask_radius=100)
+y, x = np.indices(shape)
+r = np.sqrt((x - (shape[1]-1)/2.)**2 + (y - (shape[0]-1)/2.)**2)
+diameters = np.random.uniform(50, 150, nhits)
+intensities = np.random.uniform(0.5, 5, nhits)
+hits = np.array([np.random.poisson(i*1e-3/1e-12*photons_per_pixel(r, d*1e-9, 0.12398e-9, 440e-6, 2.16, 'virus'))
+                 for d, i in zip(diameters, intensities)]).astype(np.float64)
+mask = np.ones(shape, dtype=bool)
+mask[200:214] = False
+
+def report(label, dt, evt):
+    d = np.atleast_1d(evt['analysis']['diameter'].data)
+    print("%-28s %8.2f ms/hit, median diameter error %.2f %%" % (label, 1000.*dt/nhits, 100*np.median(abs(d/diameters[:d.size]-1))))
+
+evt = {'photonPixelDetectors': {'CCD': Record('CCD', hits[0])}, 'analysis': {}}
+t0 = time.time()
+analysis.sizing.fitSphereFast(evt, 'photonPixelDetectors', 'CCD', mask=mask, **params)
+print("%-28s %8.2f ms" % ("table of models", 1000.*(time.time()-t0)))
+
+found = []
+t0 = time.time()
+for i in range(nhits):
+    evt = {'photonPixelDetectors': {'CCD': Record('CCD', hits[i])}, 'analysis': {}}
+    analysis.sizing.fitSphereFast(evt, 'photonPixelDetectors', 'CCD', mask=mask, **params)
+    found.append(evt['analysis']['diameter'].data)
+evt['analysis']['diameter'] = Record('diameter', np.array(found))
+report("fitSphereFast, hit by hit", time.time()-t0, evt)
+
+evt = {'photonPixelDetectors': {'CCD': Record('CCD', hits)}, 'analysis': {}}
+t0 = time.time()
+analysis.sizing.fitSphereFast(evt, 'photonPixelDetectors', 'CCD', mask=mask, **params)
+report("fitSphereFast, batch", time.time()-t0, evt)
+
+success, spimage = utils.io.load_spimage()
+if success:
+    found = []
+    t0 = time.time()
+    for i in range(min(nhits, 10)):
+        evt = {'photonPixelDetectors': {'CCD': Record('CCD', hits[i])}, 'analysis': {}}
+        analysis.sizing.fitSphere(evt, 'photonPixelDetectors', 'CCD', mask=mask, **params)
+        found.append(evt['analysis']['diameter'].data)
+    evt['analysis']['diameter'] = Record('diameter', np.array(found))
+    report("fitSphere (libspimage)", (time.time()-t0)*nhits/min(nhits, 10), evt)
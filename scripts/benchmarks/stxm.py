@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""Times the bright field, dark field, sum and difference STXM values of a 1024x1024
+uint16 frame with the precomputed labels of the pixels and with computing the geometry and
+masks of every mode for every frame, as done before.
+
+    python scripts/benchmarks/stxm.py [nr. of frames]
+"""
+from __future__ import print_function, absolute_import
+import os, sys, time
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)) + "/../../src")
+from analysis.stxm import STXMProcessor
+
+nframes = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+shape = (1024, 1024)
+cx, cy, r = 510.5, 500., 40
+frames = np.random.randint(0, 4000, (nframes,) + shape).astype(np.uint16)
+badmask = np.random.random(shape) > 0.01
+modes = ('bf', 'df', 'sum', 'diff')
+
+def previous(data, mode):
+    Ny, Nx = data.shape
+    xx, yy = np.meshgrid(np.arange(Nx)-cx, np.arange(Ny)-cy)
+    rr = np.sqrt(xx**2 + yy**2)
+    if mode == 'bf':
+        return data[(rr < r) & badmask].sum()
+    elif mode == 'df':
+        return data[(rr > r) & badmask].sum()
+    elif mode == 'sum':
+        return data[badmask].sum()
+    tmp = data*badmask
+    diffx = tmp[:, :510].sum(dtype=np.float64) - tmp[:, 511:1021].sum(dtype=np.float64)
+    diffy = tmp[:500, :].sum(dtype=np.float64) - tmp[501:1001, :].sum(dtype=np.float64)
+    return np.sqrt(diffx**2 + diffy**2)
+
+t0 = time.time()
+for i in range(min(nframes, 3)):
+    for mode in modes:
+        previous(frames[i], mode)
+t_previous = (time.time() - t0) / min(nframes, 3)
+
+print("geometry and masks for every mode    %8.1f ms/frame" % (1000.*t_previous))
+t0 = time.time()
+processor = STXMProcessor(shape, cx=cx, cy=cy, r=r, badmask=badmask, modes=modes)
+t_init = time.time() - t0
+t0 = time.time()
+for i in range(nframes):
+    processor.process(frames[i])
+t_frame = (time.time() - t0) / nframes
+t0 = time.time()
+processor.process(frames)
+t_stack = (time.time() - t0) / nframes
+print("precomputing the labels               %8.1f ms" % (1000.*t_init))
+print("precomputed, frame by frame           %8.1f ms/frame" % (1000.*t_frame))
+print("precomputed, stack of %3d frames      %8.1f ms/frame" % (nframes, 1000.*t_stack))
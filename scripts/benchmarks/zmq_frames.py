@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""Compares the throughput of broadcasting 1 Mpx float32 images with the
+binary array frames (zero-copy on both ends) and with the JSON metadata and
+copied buffers that were used before, with the receive high water mark of the
+interface (100 messages).
+
+    python scripts/benchmarks/zmq_frames.py [nr. of frames] [nr. of pixels]
+"""
+from __future__ import print_function, absolute_import
+import os, sys, time, threading
+import numpy as np
+import zmq
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)) + "/../../src")
+import utils.frames
+
+nframes = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+npixels = int(sys.argv[2]) if len(sys.argv) > 2 else 1024*1024
+key = utils.frames.title_hash('CCD')
+
+def send_json(socket, array, event_id):
+    socket.send(key, zmq.SNDMORE)
+    socket.send_json(dict(dtype=str(array.dtype), shape=array.shape, strides=array.strides), zmq.SNDMORE)
+    socket.send(array, copy=True)
+
+def recv_json(socket):
+    socket.recv()
+    md = socket.recv_json()
+    msg = socket.recv(copy=True)
+    return np.ndarray(shape=md['shape'], dtype=md['dtype'], buffer=msg, strides=md['strides'])
+
+def send_frames(socket, array, event_id):
+    socket.send(key, zmq.SNDMORE)
+    socket.send(utils.frames.encode_header(array, event_id, key), zmq.SNDMORE)
+    socket.send(array, copy=False)
+
+def recv_frames(socket):
+    socket.recv()
+    header = socket.recv()
+    msg = socket.recv(copy=False)
+    return utils.frames.decode_array(header, msg.buffer)
+
+def run(label, send, recv):
+    context = zmq.Context()
+    push = context.socket(zmq.PUSH)
+    push.setsockopt(zmq.SNDHWM, 125)
+    port = push.bind_to_random_port("tcp://127.0.0.1")
+    pull = context.socket(zmq.PULL)
+    pull.setsockopt(zmq.RCVHWM, 100)
+    pull.connect("tcp://127.0.0.1:%d" % port)
+    images = [np.random.random(npixels).astype(np.float32) for i in range(4)]
+    received = []
+    def receiver():
+        for i in range(nframes):
+            received.append(recv(pull).sum())
+    t = threading.Thread(target=receiver)
+    t0 = time.time()
+    t.start()
+    for i in range(nframes):
+        send(push, images[i % len(images)], float(i))
+    t.join()
+    dt = time.time() - t0
+    print("%-14s %6.1f frames/s, %7.1f MB/s" % (label, nframes/dt, nframes*images[0].nbytes/dt/1024.**2))
+    push.close()
+    pull.close()
+    context.term()
+
+run("json + copy", send_json, recv_json)
+run("binary frames", send_frames, recv_frames)
@@ -9,26 +9,38 @@ from backend import add_record
 import h5py
 
 import analysis.cfel_geom
+import utils.array
 
 _nGains = 3
 _nPanels = 16
 _nCells = 64
 
 _agipd_calibrator = None
-def init_calib(filenames):
+def init_calib(filenames, nthreads=None):
     global _agipd_calibrator
-    _agipd_calibrator = AGIPD_Calibrator(filenames)
+    _agipd_calibrator = AGIPD_Calibrator(filenames, nthreads=nthreads)
 
 _agipd_yx         = None
 _agipd_slap_shape = None
 _agipd_img_shape  = None
 _agipd_rot180     = False
-def init_geom(filename, rot180=False):
-    global _agipd_yx, _agipd_slap_shape, _agipd_img_shape, _agipd_rot180
+_agipd_plan       = None
+def init_geom(filename, rot180=False, binning=1, mode='sample'):
+    """Reads the geometry and prepares the assembly of AGIPD frames.
+    With binning > 1 the assembled images are reduced for display (see :class:`utils.array.AssemblyPlan`)."""
+    global _agipd_yx, _agipd_slap_shape, _agipd_img_shape, _agipd_rot180, _agipd_plan
     _agipd_yx, _agipd_slap_shape, _agipd_img_shape = analysis.cfel_geom.pixel_maps_for_image_view(geometry_filename=filename)    
     _agipd_yx = np.asarray(_agipd_yx, dtype=np.int64)
     _agipd_yx = _agipd_yx.reshape((2, 16, _agipd_yx[0].size//16))
     _agipd_rot180 = rot180    
+    _agipd_plan = utils.array.AssemblyPlan(_agipd_yx[0], _agipd_yx[1], _agipd_img_shape, binning=binning, mode=mode)
+
+def _crop_and_rotate(img, crop):
+    if crop is not None:
+        img = img[..., crop[0][0]:crop[0][1], crop[1][0]:crop[1][1]]
+    if _agipd_rot180:
+        img = img[..., ::-1, ::-1]
+    return img
     
 def getAGIPD(evt, record, cellID=None, panelID=None, calibrate=True, assemble=False, copy=True, crop=None):
     """
@@ -76,38 +88,56 @@ def getAGIPD(evt, record, cellID=None, panelID=None, calibrate=True, assemble=Fa
             _agipd_calibrator.calibrate_panels(aduData=outData, gainData=gainData,
                                                panelID=panelID, cellID=cellID, write_to_data=outData)
         if assemble:
-            img = np.zeros(shape=_agipd_img_shape, dtype=outData.dtype)
-            if panelID is None:
-                p_list = range(_nPanels)
-            else:
-                p_list = panelID
-            for i, p in enumerate(p_list):
-                img[_agipd_yx[0][p], _agipd_yx[1][p]] = outData[i].ravel()
-            if crop is not None:
-                img = img[crop[0][0]:crop[0][1], crop[1][0]:crop[1][1]]
-            if _agipd_rot180:
-                img = img[::-1, ::-1]
+            img = _crop_and_rotate(_agipd_plan.assemble(outData, panels=panelID), crop)
             return add_record(evt['analysis'], 'analysis', 'AGIPD_assembled', img)
         else:
             return add_record(evt['analysis'], 'analysis', 'AGIPD', outData)
 
+def assembleAGIPDTrain(evt, record, panelID=None, crop=None):
+    """
+    Assembles a record with a stack of AGIPD frames (cells, panels, ss, fs), e.g. a calibrated train, and adds
+    the stack of images to ``evt["analysis"]["AGIPD_assembled_train"]``.
+
+    The images are written into one of two buffers that are used in turns, such that the result
+    stays valid while the next train is assembled. Make sure the geometry is initialised by
+    calling init_geom(filename=location_of_geometry_file) before.
+    """
+    imgs = _crop_and_rotate(_agipd_plan.assemble_batch(record.data, panels=panelID), crop)
+    return add_record(evt['analysis'], 'analysis', 'AGIPD_assembled_train', imgs)
+
 class AGIPD_Calibrator:
+    """Calibration of AGIPD data with the constants of Anton's calibration files, one file per panel.
 
-    def __init__(self, filenames):
+    The constants are kept in tables ordered by (gain, cell, panel, ss, fs), with the offsets as
+    float32, the relative gains already multiplied by the good pixel mask and the thresholds between
+    gain stage 0 and 1, such that a whole train of pulses can be calibrated by looking up the gain
+    stage of every pixel in the tables. Panel groups and pulses are optionally distributed over
+    a pool of nthreads threads."""
+
+    def __init__(self, filenames, nthreads=None):
         assert len(filenames) == _nPanels
         self._nCells = None
-        self._badpixData       = []
-        self._darkOffsetData   = []
-        self._relativeGainData = []
-        self._gainLevelData    = []
+        badpixData       = []
+        darkOffsetData   = []
+        relativeGainData = []
+        gainLevelData    = []
         for filename in sorted(filenames):
-            self._read_and_append_calibration_data(filename=filename)
-        self._badpixData       = np.asarray(self._badpixData)
-        self._darkOffsetData   = np.asarray(self._darkOffsetData)
-        self._relativeGainData = np.asarray(self._relativeGainData)
-        self._gainLevelData    = np.asarray(self._gainLevelData)
-
-    def _read_and_append_calibration_data(self, filename):
+            self._read_and_append_calibration_data(filename, badpixData, darkOffsetData,
+                                                   relativeGainData, gainLevelData)
+        # Tables with indices (gainID, cellID, panelID, pixcol, pixrow)
+        self._goodpix = np.stack(badpixData, axis=2) == 0
+        self._darkOffset = np.stack(darkOffsetData, axis=2).astype(np.float32)
+        self._gainFactor = np.stack(relativeGainData, axis=2).astype(np.float32)
+        self._gainFactor *= self._goodpix
+        # Thresholding for gain level 3 is dodgy - thresholds merge, only levels 0,1 are used
+        self._gainThreshold = np.stack([g[1] for g in gainLevelData], axis=1)
+        self._pool = None
+        self._nthreads = nthreads
+        if nthreads is not None and nthreads > 1:
+            from multiprocessing.pool import ThreadPool
+            self._pool = ThreadPool(nthreads)
+
+    def _read_and_append_calibration_data(self, filename, badpixData, darkOffsetData, relativeGainData, gainLevelData):
         # Meaning of indices: (gainID, cellID, pixcol, pixrow)
         # Anton's AGIPD calibration format
         #> h5ls calib/agipd/Cheetah-AGIPD00-calib.h5
@@ -115,92 +145,99 @@ class AGIPD_Calibrator:
         #Badpixel                 Dataset {3, 64, 512, 128} H5T_STD_U8LE
         #DigitalGainLevel         Dataset {3, 64, 512, 128} H5T_STD_U16LE
         #RelativeGain             Dataset {3, 64, 512, 128} H5T_IEEE_F32LE
-        with h5py.File(filename) as f:
-            self._badpixData.append(np.asarray(f["/Badpixel"]))
-            self._darkOffsetData.append(np.asarray(f["/AnalogOffset"]))
-            self._relativeGainData.append(np.asarray(f["/RelativeGain"]))
-            self._gainLevelData.append(np.asarray(f["/DigitalGainLevel"]))
+        with h5py.File(filename, 'r') as f:
+            badpixData.append(np.asarray(f["/Badpixel"]))
+            darkOffsetData.append(np.asarray(f["/AnalogOffset"]))
+            relativeGainData.append(np.asarray(f["/RelativeGain"]))
+            gainLevelData.append(np.asarray(f["/DigitalGainLevel"]))
             assert _nCells == f["/Badpixel"].shape[1]
             assert _nCells == f["/AnalogOffset"].shape[1]
             assert _nCells == f["/RelativeGain"].shape[1]
             assert _nCells == f["/DigitalGainLevel"].shape[1]
-            
-
-    def calibrate_panels(self, aduData, gainData, cellID, panelID=None, apply_gain_switch=False, write_to_mask=None, write_to_data=None):
 
+    def calibrate_train(self, aduData, gainData, cellIDs, panelID=None, apply_gain_switch=False, write_to_mask=None, write_to_data=None):
+        """Calibrates a stack of pulses with shape (cells, panels, ss, fs).
+        cellIDs gives the memory cell of every pulse and panelID the panels of the stack (default: all panels).
+        Returns the calibrated data (float32) and the mask of good pixels."""
+        cellIDs = np.asarray(cellIDs, dtype=np.intp).reshape(-1)
+        assert aduData.shape[0] == cellIDs.size
+        assert ((0 <= cellIDs) & (cellIDs < _nCells)).all()
         if panelID is None:
-            p_list = range(_nPanels)
-        else:
-            p_list = panelID
-        
+            panelID = range(_nPanels)
+        panels = np.asarray(panelID, dtype=np.intp).reshape(-1)
+        assert aduData.shape[1] == panels.size
+        assert ((0 <= panels) & (panels < _nPanels)).all()
+
         if write_to_data is not None:
             assert str(write_to_data.dtype) == 'float32'
             outData = write_to_data
         else:
-            outData = np.array(aduData, copy=True, dtype=np.float32)
+            outData = np.empty(shape=aduData.shape, dtype=np.float32)
 
         if write_to_mask is not None:
             assert str(write_to_mask.dtype) == 'bool'
             badpixMask = write_to_mask
         else:
-            badpixMask = np.ones(shape=aduData.shape, dtype=np.bool)
-            
-        for i, p in enumerate(p_list):
-            self.calibrate_panel(aduData=aduData[i],
-                                 gainData=gainData[i],
-                                 panelID=p,
-                                 cellID=cellID,
-                                 apply_gain_switch=apply_gain_switch,
-                                 write_to_data=outData[i],
-                                 write_to_mask=badpixMask[i])
+            badpixMask = np.ones(shape=aduData.shape, dtype=bool)
+
+        # Work is split into groups of panels that are contiguous in the tables
+        contiguous = (panels == panels[0] + np.arange(panels.size)).all()
+        if not contiguous:
+            ngroups = panels.size
+        elif self._pool is None:
+            ngroups = 1
+        else:
+            ngroups = min(self._nthreads, panels.size)
+        bounds = np.linspace(0, panels.size, ngroups+1).astype(int)
+        groups = [(slice(a, b), slice(panels[a], panels[a] + b - a)) for a, b in zip(bounds[:-1], bounds[1:])]
+
+        def calibrate(group):
+            data_panels, table_panels = group
+            for i, c in enumerate(cellIDs):
+                adu = aduData[i, data_panels]
+                out = outData[i, data_panels]
+                offset = self._darkOffset[:, c, table_panels]
+                if apply_gain_switch:
+                    # Option: bypass multi-gain calibration
+                    # In this case use only the gain0 offset
+                    np.subtract(adu, offset[0], out=out, dtype=np.float32)
+                    continue
+                # Determine the gain stage of every pixel by thresholding
+                stage = (gainData[i, data_panels] >= self._gainThreshold[c, table_panels]).astype(np.intp)[np.newaxis]
+                np.subtract(adu, np.take_along_axis(offset, stage, axis=0)[0], out=out, dtype=np.float32)
+                out *= np.take_along_axis(self._gainFactor[:, c, table_panels], stage, axis=0)[0]
+                badpixMask[i, data_panels] = np.take_along_axis(self._goodpix[:, c, table_panels], stage, axis=0)[0]
+
+        if self._pool is None:
+            for group in groups:
+                calibrate(group)
+        else:
+            self._pool.map(calibrate, groups)
 
         return outData, badpixMask
 
+    def calibrate_panels(self, aduData, gainData, cellID, panelID=None, apply_gain_switch=False, write_to_mask=None, write_to_data=None):
+        """Calibrates the panels (shape: panels, ss, fs) of a single pulse stored in memory cell cellID."""
+        if write_to_data is not None:
+            write_to_data = write_to_data[np.newaxis]
+        if write_to_mask is not None:
+            write_to_mask = write_to_mask[np.newaxis]
+        outData, badpixMask = self.calibrate_train(aduData[np.newaxis], gainData[np.newaxis], [cellID], panelID=panelID,
+                                                   apply_gain_switch=apply_gain_switch,
+                                                   write_to_mask=write_to_mask, write_to_data=write_to_data)
+        return outData[0], badpixMask[0]
+
     def calibrate_panel(self, aduData, gainData, cellID, panelID, apply_gain_switch=True, write_to_mask=None, write_to_data=None):
+        """Calibrates a single panel (shape: ss, fs) of a pulse stored in memory cell cellID."""
         assert aduData is not None
         assert gainData is not None
         assert (0 <= cellID < _nCells)
         assert (0 <= panelID < _nPanels)
-
         if write_to_data is not None:
-            assert str(write_to_data.dtype) == 'float32'
-            outData = write_to_data
-        else:
-            outData = np.array(aduData, copy=True, dtype=np.float32)
-
+            write_to_data = write_to_data[np.newaxis, np.newaxis]
         if write_to_mask is not None:
-            assert str(write_to_mask.dtype) == 'bool'
-            badpixMask = write_to_mask
-        else:
-            badpixMask = np.ones(shape=aduData.shape, dtype=np.bool)
-            
-        offset = 0
-        cellBadpix       = np.asarray([self._badpixData[panelID][g][cellID+offset] for g in range(_nGains)])
-        cellDarkOffset   = np.asarray([self._darkOffsetData[panelID][g][cellID+offset] for g in range(_nGains)])
-        cellRelativeGain = np.asarray([self._relativeGainData[panelID][g][cellID+offset] for g in range(_nGains)])
-        cellGainLevel    = np.asarray([self._gainLevelData[panelID][g][cellID+offset] for g in range(_nGains)])
-        
-        if apply_gain_switch:
-            # Option: bypass multi-gain calibration
-            # In this case use only the gain0 offset
-            outData -= cellDarkOffset[0]
-        else:
-	    # Determine which gain stage by thresholding
-            # Thresholding for gain level 3 is dodgy - thresholds merge
-            # Ignore gain level 3 for now and work on levels 0,1
-            pixGainLevel0 = gainData < cellGainLevel[1]
-            pixGainLevel1 = pixGainLevel0 == False
-            # Do not use last gain level
-            pixGainLevel2 = np.zeros(shape=aduData.shape, dtype='bool')
-
-            pixGainLevels = [pixGainLevel0, pixGainLevel1, pixGainLevel2]
-            
-            # Subtract the appropriate offset
-            for g, pixGain in enumerate(pixGainLevels):
-                if not pixGain.any():
-                    continue
-                outData[pixGain] = (outData[pixGain] - cellDarkOffset[g][pixGain]) * cellRelativeGain[g][pixGain]
-                outData[pixGain] *= (cellBadpix[g][pixGain] == 0)
-                badpixMask[pixGain] = (cellBadpix[g][pixGain] == 0)
-
-        return outData, badpixMask
+            write_to_mask = write_to_mask[np.newaxis, np.newaxis]
+        outData, badpixMask = self.calibrate_train(aduData[np.newaxis, np.newaxis], gainData[np.newaxis, np.newaxis],
+                                                   [cellID], panelID=[panelID], apply_gain_switch=apply_gain_switch,
+                                                   write_to_mask=write_to_mask, write_to_data=write_to_data)
+        return outData[0, 0], badpixMask[0, 0]
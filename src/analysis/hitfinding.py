@@ -100,6 +100,78 @@ def countLitPixels(evt, record, aduThreshold=20, hitscoreThreshold=200, hitscore
     add_record(v, "analysis", outkey + "isMiss", miss)
     add_record(v, "analysis", outkey + "hitscore", hitscore)
 
+def validPixels(mask):
+    """Returns the flat index of the valid pixels (mask == True or 1) of a frame, for :func:`countLitPixelsBatch`."""
+    return np.flatnonzero(np.asarray(mask).ravel())
+
+_valid_masks = {}
+def _validMask(valid, npixels):
+    """Returns the flat boolean mask of a flat index of valid pixels (cached for the last index)"""
+    key = (id(valid), valid.size, npixels)
+    if key not in _valid_masks:
+        mask = np.zeros(npixels, dtype=bool)
+        mask[valid] = True
+        # Keep a reference to valid, such that its id can not be reused
+        _valid_masks.clear()
+        _valid_masks[key] = (valid, mask)
+    return _valid_masks[key][1]
+
+_lit_buffers = {}
+def _countLit(frames, mask, aduThreshold, chunk):
+    """Returns the nr. of (valid) pixels above threshold for every frame, streaming through
+    the frames in chunks of about chunk pixels with a reused buffer"""
+    nframes, npixels = frames.shape
+    step = max(min(chunk // max(nframes, 1), npixels), 1)
+    if (nframes, step) not in _lit_buffers:
+        _lit_buffers.clear()
+        _lit_buffers[(nframes, step)] = np.empty((nframes, step), dtype=bool)
+    lit = _lit_buffers[(nframes, step)]
+    count = np.zeros(nframes, dtype='int')
+    for start in range(0, npixels, step):
+        stop = min(start + step, npixels)
+        chunk_lit = lit[:, :stop-start]
+        np.greater(frames[:, start:stop], aduThreshold, out=chunk_lit)
+        if mask is not None:
+            np.logical_and(chunk_lit, mask[start:stop], out=chunk_lit)
+        count += np.count_nonzero(chunk_lit, axis=1)
+    return count
+
+def countLitPixelsBatch(evt, record, aduThreshold=20, hitscoreThreshold=200, hitscoreDark=0, hitscoreMax=None, valid=None, chunk=2**20, outkey="litpixel: "):
+    """A simple hitfinder that counts the number of lit pixels for every frame in a stack of frames and
+    adds the results as arrays with one value per frame to ``evt["analysis"][outkey + "isHit"]``,
+    ``evt["analysis"][outkey + "isMiss"]``, and the hitscore to ``evt["analysis"][outkey + "hitscore"]``.
+    Pixels are counted in chunks of about chunk pixels (all frames together) in a reused buffer,
+    no temporary copies of the frames are made.
+
+    Args:
+        :evt:       The event variable
+        :record:    A pixel detector :func:`~backend.Record` object with a stack of frames (N, ...)
+
+    Kwargs:
+        :aduThreshold(int):      only pixels above this threshold (in ADUs) are valid, default=20
+        :hitscoreThreshold(int): frames with hitscore (Nr. of lit pixels) above this threshold are hits, default=200
+        :hitscoreMax(int):       frames with hitscore (Nr. of lit pixels) below this threshold (if not None) are hits, default=None
+        :hitscoreDark(int):      frames with hitscore (Nr. of lit pixels) above this threshold are not darks (so either hit or miss), default=0
+        :valid(int ndarray):     flat index of the pixels that are counted (see :func:`validPixels`), default=None (all pixels)
+        :outkey(str):            Prefix of data key of resulting :func:`~backend.Record` object, default is "litpixel: "
+
+    Returns the boolean array marking the hits, which can be used to select the frames for further analysis.
+    """
+    data = record.data
+    frames = data.reshape(data.shape[0], -1)
+    mask = None if valid is None else _validMask(valid, frames.shape[1])
+    hitscore = _countLit(frames, mask, aduThreshold, chunk)
+
+    hit = hitscore > hitscoreThreshold
+    if hitscoreMax is not None:
+        hit &= hitscore <= hitscoreMax
+    miss = ~hit & (hitscore > hitscoreDark)
+    v = evt["analysis"]
+    add_record(v, "analysis", outkey + "isHit", hit.astype('int'))
+    add_record(v, "analysis", outkey + "isMiss", miss.astype('int'))
+    add_record(v, "analysis", outkey + "hitscore", hitscore)
+    return hit
+
 def countTof(evt, record, signalThreshold=1, minWindow=0, maxWindow=-1, hitscoreThreshold=2, outkey="tof: "):
     """A simple hitfinder that performs a peak counting test on a time-of-flight detector signal, 
     in a specific subwindow and adds the result to ``evt["analysis"][outkey + "isHit"]``, 
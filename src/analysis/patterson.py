@@ -4,11 +4,45 @@
 # -------------------------------------------------------------------------
 from __future__ import print_function, absolute_import # Compatibility with python 2 and 3
 import numpy
+import scipy.ndimage
 import utils.io
+import utils.array
 from backend.record import add_record
 
+_exclusion_masks = {}
+def _exclusion_mask(shape, diameter_pix=None, xgap_pix=None, ygap_pix=None, frame_pix=None):
+    """Returns the (cached) mask of the Patterson map that is used for the multiple score,
+    excluding the center, the gaps and the frame"""
+    key = (shape, diameter_pix, xgap_pix, ygap_pix, frame_pix)
+    if key in _exclusion_masks:
+        return _exclusion_masks[key]
+    M = numpy.ones(shape, dtype=bool)
+    if diameter_pix is not None:
+        Y,X = numpy.indices(shape)
+        X -= shape[1]//2
+        Y -= shape[0]//2
+        Rsq = X**2+Y**2
+        M &= Rsq > (diameter_pix/2.)**2
+    if xgap_pix is not None:
+        cy = shape[0]//2
+        M[cy-xgap_pix//2:cy+xgap_pix//2,:] = False
+    if ygap_pix is not None:
+        cx = shape[1]//2
+        M[:,cx-ygap_pix//2:cx+ygap_pix//2] = False
+    if frame_pix is not None:
+        M[:frame_pix,:] = False
+        M[-frame_pix:,:] = False
+        M[:,:frame_pix] = False
+        M[:,-frame_pix:] = False
+    if len(_exclusion_masks) >= 8:
+        # The shape changes with crop, every mask has the size of a map
+        _exclusion_masks.clear()
+    _exclusion_masks[key] = M
+    return M
+
 def patterson(evt, type, key, mask=None, threshold=None, diameter_pix=None, crop=None, full_output=False, xgap_pix=None, ygap_pix=None, frame_pix=None, **params):
-    """TODO: missing docstring
+    """Patterson map of a diffraction pattern (normalised by its median), see :func:`pattersonFast` for the arguments.
+    Additional keyword arguments are passed on to spimage.patterson.
 
     .. note:: This feature depends on the python package `libspimage <https://github.com/FilipeMaia/libspimage>`_.
     """
@@ -25,11 +59,11 @@ def patterson(evt, type, key, mask=None, threshold=None, diameter_pix=None, crop
     if crop is not None:
         img = module.crop(img, crop)
         mask = module.crop(mask, crop)
-        
+
     out = module.patterson(numpy.float64(img), mask, full_output=full_output, normalize_median=False, **params)
-    
+
     v = evt["analysis"]
-    
+
     if full_output:
         P = abs(out[0])
         info = out[1]
@@ -38,36 +72,181 @@ def patterson(evt, type, key, mask=None, threshold=None, diameter_pix=None, crop
     else:
         P = abs(out)
 
-    m = numpy.median(P)
+    m = utils.array.partition_median(P.reshape(-1).copy())
     if not numpy.isclose(m, 0.):
         P = P / m
-    
+
     add_record(v, "analysis", "patterson", P, unit='')
 
     if threshold is not None:
         Minf = ~numpy.isfinite(P)
         if Minf.sum() > 0:
             P[Minf] = 0
-        M = P > threshold
-        if diameter_pix is not None:
-            Y,X = numpy.indices(P.shape)
-            X -= P.shape[1]/2
-            Y -= P.shape[0]/2
-            Rsq = X**2+Y**2
-            M *= Rsq > (diameter_pix/2)**2
-        if xgap_pix is not None:
-            cy = M.shape[0]/2 
-            M[cy-xgap_pix/2:cy+xgap_pix/2,:] = False
-        if ygap_pix is not None:
-            cx = M.shape[1]/2 
-            M[:,cx-ygap_pix/2:cx+ygap_pix/2] = False
-        if frame_pix is not None:
-            M[:frame_pix,:] = False
-            M[-frame_pix:,:] = False
-            M[:,:frame_pix] = False
-            M[:,-frame_pix:] = False
+        M = (P > threshold) & _exclusion_mask(P.shape, diameter_pix, xgap_pix, ygap_pix, frame_pix)
         if full_output:
             add_record(v, "analysis", "patterson multiples", M, unit='')
         multiple_score = M.sum()
         add_record(v, "analysis", "multiple score", multiple_score, unit='')
-    
+
+_scipy_fft = None
+def _rfft2(images, workers=None):
+    """Real FFT over the last two axes, with scipy.fft and the given number of threads where available (scipy >= 1.4),
+    with numpy.fft otherwise"""
+    global _scipy_fft
+    if _scipy_fft is None:
+        try:
+            import scipy.fft as _scipy_fft
+        except ImportError:
+            _scipy_fft = False
+    if _scipy_fft is False:
+        return numpy.fft.rfft2(images)
+    return _scipy_fft.rfft2(images, workers=workers)
+
+class PattersonScorer(object):
+    """Precomputed Patterson maps and multiple scores for images of the given shape.
+
+    The Patterson map is the absolute value of the Fourier transform of the image times a kernel
+    (the mask, optionally smoothed with a gaussian of width mask_smooth), normalised by its median.
+    The multiple score is the number of pixels of the map above threshold, outside of the central
+    disk of diameter_pix and the gaps and frame of the given widths.
+
+    As only the magnitude of the map is needed, the images are transformed with a real FFT and no
+    shifts, the exclusion mask is shifted instead. Where available, scipy.fft keeps the plans for the
+    transforms of recently used shapes, and transforms stacks of images in one call with the given number
+    of workers; with older versions of scipy numpy.fft is used.
+
+    Args:
+        :shape(tuple): Shape of an image
+
+    Kwargs:
+        :mask:                  Boolean mask of valid pixels (default = None, all pixels are valid)
+        :threshold(float):      Threshold of the normalised map for the multiple score (default = None, no score)
+        :diameter_pix(int):     Diameter of the excluded central disk (default = None)
+        :xgap_pix(int):         Width of the excluded horizontal gap (default = None)
+        :ygap_pix(int):         Width of the excluded vertical gap (default = None)
+        :frame_pix(int):        Width of the excluded frame (default = None)
+        :floor_cut(float):      Intensities at or below this value are set to zero (default = None)
+        :mask_smooth(float):    Width of the gaussian smoothing the edges of the mask in the kernel (default = None)
+        :single_precision(bool): Transform in single precision (default = True)
+        :workers(int):          Number of threads used by scipy.fft, ignored with numpy.fft (default = None, one thread)
+    """
+    def __init__(self, shape, mask=None, threshold=None, diameter_pix=None, xgap_pix=None, ygap_pix=None, frame_pix=None,
+                 floor_cut=None, mask_smooth=None, single_precision=True, workers=None):
+        self.shape = tuple(shape)
+        self.dtype = numpy.float32 if single_precision else numpy.float64
+        kernel = numpy.ones(self.shape) if mask is None else numpy.array(mask, dtype=numpy.float64)
+        if mask_smooth:
+            kernel = scipy.ndimage.gaussian_filter(kernel, mask_smooth) * kernel
+        self.kernel = kernel.astype(self.dtype)
+        self.threshold = threshold
+        self.floor_cut = floor_cut
+        self.workers = workers
+        self.exclusion = _exclusion_mask(self.shape, diameter_pix, xgap_pix, ygap_pix, frame_pix)
+        # Every pixel of the non-negative frequencies along x counts for itself and, if it appears twice
+        # in the full map, for its mirror image at the negative frequencies
+        ny, nx = self.shape
+        excluded = numpy.fft.ifftshift(self.exclusion)
+        mirror = excluded[numpy.ix_((-numpy.arange(ny)) % ny, (-numpy.arange(nx)) % nx)]
+        twice = numpy.zeros(nx//2+1, dtype=bool)
+        twice[1:(nx+1)//2] = True
+        self._counts = excluded[:, :nx//2+1].astype(numpy.int64) + (mirror[:, :nx//2+1] & twice)
+
+    def _half_maps(self, images):
+        """Magnitudes of the Fourier transforms of images (N x ny x nx) times the kernel, for the non-negative frequencies along x"""
+        intensities = numpy.array(images, dtype=self.dtype)
+        if self.floor_cut is not None:
+            intensities[intensities <= self.floor_cut] = 0.
+        intensities *= self.kernel
+        half = numpy.abs(_rfft2(intensities, workers=self.workers))
+        half /= self.shape[0]*self.shape[1]
+        return half
+
+    def _full_maps(self, half):
+        """Patterson maps in the layout of fftshift, given the magnitudes of the non-negative frequencies"""
+        n = self.shape[1]
+        full = numpy.empty(half.shape[:-1] + (n,), dtype=half.dtype)
+        full[..., :half.shape[-1]] = half
+        # |P(-k)| = |P(k)| for real images
+        negative = half[..., :, 1:(n+1)//2][..., ::-1]
+        full[..., half.shape[-1]:] = numpy.roll(negative[..., ::-1, :], 1, axis=-2)
+        return numpy.fft.fftshift(full, axes=(-2, -1))
+
+    def _medians(self, half):
+        """Medians of the full maps, repeating the columns that appear twice"""
+        n = self.shape[1]
+        values = numpy.concatenate([half.reshape(half.shape[:-2] + (-1,)),
+                                    half[..., :, 1:(n+1)//2].reshape(half.shape[:-2] + (-1,))], axis=-1)
+        return utils.array.partition_median(values)
+
+    def score(self, images):
+        """Returns the Patterson maps (lazily computed, a callable) and the multiple scores of an image or a stack of images"""
+        images = numpy.asarray(images)
+        single = images.ndim == 2
+        half = self._half_maps(images.reshape((-1,) + self.shape))
+        m = self._medians(half)
+        m = numpy.where(numpy.isclose(m, 0.), 1., m)
+        half /= m.astype(half.dtype)[:, numpy.newaxis, numpy.newaxis]
+        scores = None
+        if self.threshold is not None:
+            scores = ((half > self.threshold) * self._counts).sum(axis=(-2, -1))
+        def maps():
+            P = self._full_maps(half)
+            return P[0] if single else P
+        return maps, (scores[0] if single and scores is not None else scores)
+
+_patterson_scorers = {}
+def pattersonFast(evt, type, key, mask=None, threshold=None, diameter_pix=None, crop=None, full_output=False, xgap_pix=None, ygap_pix=None, frame_pix=None,
+                  floor_cut=None, mask_smooth=None, single_precision=True, workers=None):
+    """Computes the Patterson map (normalised by its median) of an image or a stack of images (e.g. all hits of a train)
+    and, if a threshold is given, the number of pixels of the map above the threshold as a score for multiple particles.
+    Adds the records ``evt["analysis"]["patterson"]`` (evaluated lazily) and ``evt["analysis"]["multiple score"]``,
+    arrays for stacks.
+
+    The kernel and the exclusion mask are precomputed for every shape, mask and set of parameters,
+    see :class:`PattersonScorer`.
+
+    Args:
+        :evt:       The event variable
+        :type(str): The event type of detectors, e.g. photonPixelDetectors
+        :key(str):  The event key of a detector, e.g. CCD
+
+    Kwargs:
+        :mask:                  Boolean mask of valid pixels (default = None, all pixels are valid)
+        :threshold(float):      Threshold of the normalised map for the multiple score (default = None, no score)
+        :diameter_pix(int):     Diameter of the central disk of the map that is excluded from the score (default = None)
+        :crop(int):             Only use the central crop x crop pixels of the images (default = None)
+        :full_output(bool):     Also add the kernel and the pixels of the map above threshold (default = False)
+        :xgap_pix(int):         Width of the horizontal gap excluded from the score (default = None)
+        :ygap_pix(int):         Width of the vertical gap excluded from the score (default = None)
+        :frame_pix(int):        Width of the frame excluded from the score (default = None)
+        :floor_cut(float):      Intensities at or below this value are set to zero (default = None)
+        :mask_smooth(float):    Width of the gaussian smoothing the edges of the mask (default = None)
+        :single_precision(bool): Transform in single precision (default = True)
+        :workers(int):          Number of threads of the FFT (default = None, one thread)
+    """
+    img = numpy.asarray(evt[type][key].data)
+    cropped = (slice(None), slice(None))
+    if crop is not None:
+        y0 = (img.shape[-2] - crop)//2
+        x0 = (img.shape[-1] - crop)//2
+        cropped = (slice(y0, y0+crop), slice(x0, x0+crop))
+        img = img[(Ellipsis,) + cropped]
+    shape = img.shape[-2:]
+    initkey = (shape, id(mask), threshold, diameter_pix, crop, xgap_pix, ygap_pix, frame_pix, floor_cut, mask_smooth, single_precision, workers)
+    if initkey not in _patterson_scorers or _patterson_scorers[initkey][0] is not mask:
+        if len(_patterson_scorers) > 100:
+            _patterson_scorers.clear()
+        _patterson_scorers[initkey] = (mask, PattersonScorer(shape, mask=None if mask is None else numpy.asarray(mask)[cropped],
+                                                             threshold=threshold, diameter_pix=diameter_pix,
+                                                             xgap_pix=xgap_pix, ygap_pix=ygap_pix, frame_pix=frame_pix, floor_cut=floor_cut,
+                                                             mask_smooth=mask_smooth, single_precision=single_precision, workers=workers))
+    scorer = _patterson_scorers[initkey][1]
+    maps, scores = scorer.score(img)
+    v = evt["analysis"]
+    P = add_record(v, "analysis", "patterson", maps, unit='')
+    if full_output:
+        add_record(v, "analysis", "patterson kernel", scorer.kernel, unit='')
+    if threshold is not None:
+        if full_output:
+            add_record(v, "analysis", "patterson multiples", lambda: (P.data > threshold) & scorer.exclusion, unit='')
+        add_record(v, "analysis", "multiple score", scores, unit='')
@@ -3,12 +3,14 @@
 # Hummingbird is distributed under the terms of the Simplified BSD License.
 # -------------------------------------------------------------------------
 from __future__ import print_function, absolute_import # Compatibility with python 2 and 3
+import logging
 from numpy import sum, mean, min, max, std
 import numpy as np
 from backend import ureg
 from backend import add_record
 import utils.io
 import utils.array
+import utils.common_mode
 
 def printStatistics(detectors):
     for k,r in detectors.iteritems():
@@ -148,8 +150,12 @@ def threshold(evt, record, threshold, outkey=None):
     return rec
 
 initialized = {}
+def _subset_of_asics(data, subset):
+    return np.hstack([data[i // 2,:,((i % 2)*194):((i % 2 + 1)*194)] for i in subset])
+
 def assemble(evt, type, key, x, y, nx=None, ny=None, subset=None, outkey=None, initkey=None):
     """Asesembles a detector image given some geometry and adds assembled image to ``evt["analysis"]["assembled - " + key]``.
+    The assembly plan is computed once for every initkey and a new image is assembled for every event.
 
     Args:
         :evt:        The event variable
@@ -170,45 +176,22 @@ def assemble(evt, type, key, x, y, nx=None, ny=None, subset=None, outkey=None, i
     
     if not initkey in initialized:
         if subset is not None:
-            x_ss = []
-            y_ss = []
-            for i in subset:
-                panel = i / 2
-                asic = i % 2
-                x_ss.append(x[panel,:,(asic*194):((asic+1)*194)])
-                y_ss.append(y[panel,:,(asic*194):((asic+1)*194)])
-            x_ss = np.hstack(x_ss)
-            y_ss = np.hstack(y_ss)
+            x_ss = _subset_of_asics(x, subset)
+            y_ss = _subset_of_asics(y, subset)
         else:
             x_ss = x
             y_ss = y
         assembled, height, width, shape, y_ss, x_ss = utils.array.assembleImage(x_ss, y_ss ,nx=nx, ny=ny, return_indices=True)
-        initialized[initkey] = {
-            'assembled':assembled,
-            'height':height,
-            'width':width,
-            'shape':shape,
-            'y':y_ss,
-            'x':x_ss
-        }
-    assembled = initialized[initkey]['assembled']
-    height = initialized[initkey]['height']
-    width = initialized[initkey]['width']
-    shape = initialized[initkey]['shape']
-    y = initialized[initkey]['y']
-    x = initialized[initkey]['x']
+        initialized[initkey] = utils.array.AssemblyPlan(y_ss + (height-shape[0]), x_ss, (height, width),
+                                                        dtype=assembled.dtype)
+    plan = initialized[initkey]
 
     if subset is not None:
-        data = []
-        for i in subset:
-            panel = i / 2
-            asic = i % 2
-            data.append(evt[type][key].data[panel,:,(asic*194):((asic+1)*194)])
-        data = np.hstack(data)
+        data = _subset_of_asics(evt[type][key].data, subset)
     else:
         data = evt[type][key].data
     
-    assembled[height-shape[0]:, :shape[1]][y,x] = data
+    assembled = plan.assemble(data)
 
     if outkey is None:
         add_record(evt["analysis"], "analysis", "assembled - "+key, assembled)
@@ -245,44 +228,49 @@ def bin(evt, type, key, binning, mask=None):
     if binned_mask is not None:
         add_record(evt["analysis"], "analysis", "binned mask - "+key, binned_mask)
 
-def radial(evt, record, mask=None, cx=None, cy=None, key=''):
-    """Compute the radial average of a detector image given the center position (and a mask). 
+_radial_integrators = {}
+def radial(evt, record, mask=None, cx=None, cy=None, key='', bin_width=1., subpixel=False, weights=None):
+    """Compute the radial average of a detector image (or a stack of images) given the center position (and a mask). 
     Adds the records ``evt["analysis"]["radial average - " + key]`` and ``evt["analysis"]["radial distance - " + key]``.
 
-    .. note:: This feature depends on the python package `libspimage <https://github.com/FilipeMaia/libspimage>`_.
-
-    TODO: Updated docstring
+    The radial bins are precomputed once for every shape, center, mask, bin width and weighting
+    (see :class:`utils.array.RadialIntegrator`).
 
     Args:
         :evt:        The event variable
-        :type(str):  The event type (e.g. photonPixelDetectors)
-        :key(str):   The event key (e.g. CCD)
+        :record:     A pixel detector ``Record``
 
     Kwargs:
         :mask:    Binary mask, pixels that are masked out are not counted into the radial average.
         :cx(float):  X-coordinate of the center position. If None the center will be in the middle.
         :cy(float):  Y-coordinate of the center position. If None the center will be in the middle.
+        :key(str):   Suffix of the keys of the output records
+        :bin_width(float): Width of the radial bins in pixels (default = 1)
+        :subpixel(bool):   Share every pixel between the two nearest radial bins (default = False)
+        :weights:          Array multiplied with the image before averaging, e.g. a polarisation correction (default = None)
 
     :Authors:
         Max F. Hantke (hantke@xray.bmc.uu.se)
     """
-    success, spimage = utils.io.load_spimage()
-    if not success:
-        print("Skipping analysis.pixel_detector.radial")
-        return
     image = record.data
-    r, img_r = spimage.radialMeanImage(image, msk=mask, cx=cx, cy=cy, output_r=True)
-    valid = np.isfinite(img_r)
+    initkey = (image.shape[-2:], cx, cy, id(mask), bin_width, subpixel, id(weights))
+    if initkey not in _radial_integrators or _radial_integrators[initkey][0] is not mask or _radial_integrators[initkey][1] is not weights:
+        if len(_radial_integrators) > 100:
+            # The center may change from event to event
+            _radial_integrators.clear()
+        _radial_integrators[initkey] = (mask, weights, utils.array.RadialIntegrator(image.shape[-2:], cx=cx, cy=cy, mask=mask, bin_width=bin_width,
+                                                                                   subpixel=subpixel, weights=weights))
+    integrator = _radial_integrators[initkey][2]
+    img_r = integrator.integrate(image)
+    r = integrator.radii
+    valid = np.isfinite(img_r).reshape((-1, r.size)).all(axis=0)
     if valid.sum() > 0:
         r = r[valid]
-        img_r = img_r[valid]
+        img_r = img_r[..., valid]
     r_rec = add_record(evt["analysis"], "analysis", "radial distance - " + key, r)
     img_rec = add_record(evt["analysis"], "analysis", "radial average - "  + key, img_r)
     return r_rec, img_rec
 
-
-
-
 def commonModeCSPAD2x2(evt, type, key, mask=None):
     """Subtraction of common mode using median value of masked pixels (left and right half of detector are treated separately). 
     Adds a record ``evt["analysis"]["cm_corrected - " + key]``.
@@ -301,18 +289,18 @@ def commonModeCSPAD2x2(evt, type, key, mask=None):
     """
     data = evt[type][key].data
     dataCorrected = np.copy(data)
-    lData = data[:,:data.shape[1]/2]
-    rData = data[:,data.shape[1]/2:]
+    lData = data[:,:data.shape[1]//2]
+    rData = data[:,data.shape[1]//2:]
     if mask is None:
         lMask = np.ones(shape=lData.shape, dtype="bool")
         rMask = np.ones(shape=rData.shape, dtype="bool")
     else:
-        lMask = mask[:,:data.shape[1]/2] == False
-        rMask = mask[:,data.shape[1]/2:] == False
+        lMask = mask[:,:data.shape[1]//2] == False
+        rMask = mask[:,data.shape[1]//2:] == False
     if lMask.sum() > 0:
-        dataCorrected[:,:data.shape[1]/2] -= np.median(lData[lMask])
+        dataCorrected[:,:data.shape[1]//2] -= np.median(lData[lMask])
     if rMask.sum() > 0:
-        dataCorrected[:,data.shape[1]/2:] -= np.median(rData[rMask])    
+        dataCorrected[:,data.shape[1]//2:] -= np.median(rData[rMask])    
     add_record(evt["analysis"], "analysis", "cm_corrected - " + key, dataCorrected)
 
 
@@ -389,10 +377,23 @@ def _cmc(img, msk=None, axis=1, signal_threshold=None, min_nr_pixels_per_median=
     else:
         img -= cm
     
+_common_mode = {}
+def _common_mode_correction(data, grid, axes, signal_threshold, mask, min_nr_pixels_per_median, outkey=''):
+    """Returns a corrected copy of a frame or a stack of frames, reusing the precomputed correction
+    for the same output, shape, layout and mask (only the last mask is kept for every output)"""
+    key = (outkey, data.shape[-2:], grid, axes, signal_threshold, min_nr_pixels_per_median)
+    if key not in _common_mode or _common_mode[key][0] is not mask:
+        _common_mode[key] = (mask, utils.common_mode.CommonMode(data.shape[-2:], grid=grid, axes=axes, mask=mask,
+                                                                 signal_threshold=signal_threshold,
+                                                                 min_nr_pixels_per_median=min_nr_pixels_per_median))
+    dataCorrected = np.array(data, dtype=np.result_type(data.dtype, np.float32), order='C')
+    return _common_mode[key][1].correct(dataCorrected)
+
 def commonModePNCCD(evt, type, key, outkey=None, transpose=False, signal_threshold=None, mask=None, min_nr_pixels_per_median=1):
     """Common mode correction for PNCCDs.
 
     For each row its median value is subtracted (left and right half of detector are treated separately).
+    Works for single frames and stacks of frames.
     Adds a record ``evt["analysis"][outkey]``.
     
     Args:
@@ -414,25 +415,14 @@ def commonModePNCCD(evt, type, key, outkey=None, transpose=False, signal_thresho
     if outkey is None:
         outkey = "corrected - " + key
     data = evt[type][key].data
-
-    dataCorrected = np.copy(data)
-    lData = dataCorrected[:,:data.shape[1]/2]
-    rData = dataCorrected[:,data.shape[1]/2:]
-    if mask is not None:
-        lMask = mask[:,:data.shape[1]/2]
-        rMask = mask[:,data.shape[1]/2:]
-    else:
-        lMask = None
-        rMask = None
-    _cmc(lData, msk=lMask, axis=1 if not transpose else 0, signal_threshold=signal_threshold, min_nr_pixels_per_median=min_nr_pixels_per_median)
-    _cmc(rData, msk=rMask, axis=1 if not transpose else 0, signal_threshold=signal_threshold, min_nr_pixels_per_median=min_nr_pixels_per_median)
-    
+    dataCorrected = _common_mode_correction(data, (1, 2), (0,) if transpose else (1,), signal_threshold, mask, min_nr_pixels_per_median, outkey)
     add_record(evt["analysis"], "analysis", outkey, dataCorrected)
 
 def commonModePNCCD2(evt, type, key, outkey=None, signal_threshold=None, mask=None, min_nr_pixels_per_median=1):
     """Common mode correction for PNCCDs.
 
-    For each row its median value is subtracted (left and right half of detector are treated separately).
+    For each column and then for each row its median value is subtracted (the four quadrants of the detector are treated separately).
+    Works for single frames and stacks of frames.
     Adds a record ``evt["analysis"][outkey]``.
     
     Args:
@@ -442,7 +432,6 @@ def commonModePNCCD2(evt, type, key, outkey=None, signal_threshold=None, mask=No
 
     Kwargs:
       :outkey(str):             The event key for the corrected image, default is "corrected - " + key
-      :transpose(bool):         Apply procedure on transposed image
       :signal_threshold(float): Apply procedure by using only pixels below given value
       :mask:                    You may provide a boolean mask with values that shall be excluded from common mode correction
       :min_nr_pixels_per_median(int): Common mode correction will be skipped for pixel lines that do not contain as much as this number of values
@@ -454,23 +443,7 @@ def commonModePNCCD2(evt, type, key, outkey=None, signal_threshold=None, mask=No
     if outkey is None:
         outkey = "corrected - " + key
     data = evt[type][key].data
-
-    dataCorrected = np.copy(data)
-    quads = [dataCorrected[:data.shape[0]/2,:data.shape[1]/2],
-             dataCorrected[data.shape[0]/2:,:data.shape[1]/2],
-             dataCorrected[:data.shape[0]/2,data.shape[1]/2:],
-             dataCorrected[data.shape[0]/2:,data.shape[1]/2:]]
-    if mask is not None:
-        mquads = [mask[:data.shape[0]/2,:data.shape[1]/2],
-                  mask[data.shape[0]/2:,:data.shape[1]/2],
-                  mask[:data.shape[0]/2,data.shape[1]/2:],
-                  mask[data.shape[0]/2:,data.shape[1]/2:]]
-    else:
-        mquads = [None, None, None, None]
-    for quad,mquad in zip(quads,mquads):
-        _cmc(quad, msk=mquad, axis=0, signal_threshold=signal_threshold, min_nr_pixels_per_median=min_nr_pixels_per_median)
-        _cmc(quad, msk=mquad, axis=1, signal_threshold=signal_threshold, min_nr_pixels_per_median=min_nr_pixels_per_median)
-    
+    dataCorrected = _common_mode_correction(data, (2, 2), (0, 1), signal_threshold, mask, min_nr_pixels_per_median, outkey)
     add_record(evt["analysis"], "analysis", outkey, dataCorrected)
 
     
@@ -6,6 +6,7 @@ from __future__ import print_function, absolute_import # Compatibility with pyth
 from backend import add_record
 import ipc
 import utils.io
+import utils.sphere_model
 import numpy as np
 
 def findCenter(evt, type, key, mask=None, x0=0, y0=0, maxshift=10, threshold=0.5, blur=4):
@@ -91,7 +92,7 @@ def fitSphere(evt, type, key, mask=None, x0=0, y0=0, d0=100, i0=1.,
     
     img = evt[type][key].data
     if mask is None:
-        mask = np.ones(shape=img.shape, dtypt="bool")
+        mask = np.ones(shape=img.shape, dtype="bool")
     else:
         mask = np.array(mask, dtype="bool")
 
@@ -138,6 +139,80 @@ def fitSphere(evt, type, key, mask=None, x0=0, y0=0, d0=100, i0=1.,
     add_record(v, "analysis", "intensity", intensity / (1e-3 / 1e-12), unit='mJ/um**2')
     add_record(v, "analysis", "error", info["error"], unit='')
 
+_sphere_sizers = {}
+def fitSphereFast(evt, type, key, mask=None, x0=0, y0=0, d0=100, wavelength=1., pixelsize=110, distance=1000,
+                  adu_per_photon=1, quantum_efficiency=1, material='virus', mask_radius=100, photon_counting=True,
+                  dmin=None, dmax=None, nr_diameters=500, newton_steps=3, refine_steps=3):
+    """Estimating the size of particles based on diffraction data by fitting the radial average with a sphere model,
+    for a single image or a stack of images (e.g. all hits of a train) at once.
+    Adds results to ``evt['analysis'][RESULT]`` where RESULT is 'offCenterX', 'offCenterY', 'cx', 'cy',
+    'diameter', 'intensity', 'error' and 'correlation', as arrays for stacks.
+
+    The radial average around x0 and y0 is correlated with a table of sphere models for a grid of diameters, which
+    is computed once for every geometry, center and mask, and the best diameter is refined with a few Newton steps.
+    As in :func:`fitSphere`, the center, diameter and intensity are then refined on the full model of the valid
+    pixels and the error is the reduced chi-squared of this model (see :class:`utils.sphere_model.SphereSizer`).
+    The 'correlation' is the Pearson correlation of the radial average around x0 and y0.
+    The refinement only converges for centers within about half a pixel of x0 and y0,
+    use :func:`findCenter` for finding them.
+
+    Args:
+        :evt:       The event variable
+        :type(str): The event type of detectors, e.g. photonPixelDetectors
+        :key(str):  The event key of a detector, e.g. CCD 
+
+    Kwargs:
+        :mask:      Only valid pixels (mask == True or 1) are used (default: all pixels are valid)
+        :x0(float): Initial guess for off center shift in x (default = 0)
+        :y0(float): Initial guess for off center shift in y (default = 0)
+        :d0(int):   Guess for the diameter [nm], the middle of the default range of diameters (default = 100)
+        :wavelength(float):   Photon wavelength [nm] (default = 1)
+        :pixelsize(int):      Side length of a pixel [um] (default=110)
+        :distance(int):       Distance from interaction to detector [mm] (default = 1000)
+        :adu_per_photon(int): ADUs per photon (default = 1)
+        :quantum_efficiency(float):  Quantum efficiency of the detector (default = 1)
+        :material(str):       Material of particle, e.g. virus, protein, water, ... (default = virus)
+        :mask_radius(int):    Radius in pixels used for circular mask defining valid pixels for fitting (default=100)
+        :photon_counting(bool): If True, Do photon conversion (discretization)  before fitting (default = True)
+        :dmin(float):         Smallest diameter [nm] of the table of models (default = d0/4)
+        :dmax(float):         Largest diameter [nm] of the table of models (default = 4*d0)
+        :nr_diameters(int):   Number of diameters of the table of models (default = 500)
+        :newton_steps(int):   Number of Newton steps refining the diameter of the radial fit (default = 3)
+        :refine_steps(int):   Number of Gauss-Newton steps refining the full model, 0 keeps x0 and y0 (default = 3)
+    """
+    img = np.asarray(evt[type][key].data)
+    shape = img.shape[-2:]
+    cx = (shape[1]-1)/2. + x0
+    cy = (shape[0]-1)/2. + y0
+    dmin = d0/4. if dmin is None else dmin
+    dmax = d0*4. if dmax is None else dmax
+    initkey = (shape, cx, cy, id(mask), wavelength, pixelsize, distance, quantum_efficiency, material, mask_radius, dmin, dmax, nr_diameters)
+    if initkey not in _sphere_sizers or _sphere_sizers[initkey][0] is not mask:
+        if len(_sphere_sizers) > 100:
+            # The center may change from event to event
+            _sphere_sizers.clear()
+        _sphere_sizers[initkey] = (mask, utils.sphere_model.SphereSizer(shape, np.linspace(dmin, dmax, nr_diameters)*1e-9, cx=cx, cy=cy,
+                                                                          mask=mask, mask_radius=mask_radius, wavelength=wavelength*1e-9,
+                                                                          pixelsize=pixelsize*1e-6, distance=distance*1e-3,
+                                                                          material=material, quantum_efficiency=quantum_efficiency))
+    sizer = _sphere_sizers[initkey][1]
+    photons = img / float(adu_per_photon)
+    if photon_counting:
+        photons = np.round(photons)
+    diameter, intensity, correlation, _ = sizer.fit(photons, newton_steps=newton_steps)
+    shift_x, shift_y, diameter, intensity, error = sizer.refine(photons, diameter, intensity, steps=refine_steps)
+    if img.ndim == 2:
+        shift_x, shift_y, diameter, intensity, correlation, error = shift_x[0], shift_y[0], diameter[0], intensity[0], correlation[0], error[0]
+    v = evt["analysis"]
+    add_record(v, "analysis", "offCenterX", x0 + shift_x, unit='')
+    add_record(v, "analysis", "offCenterY", y0 + shift_y, unit='')
+    add_record(v, "analysis", "cx", cx + shift_x, unit='px')
+    add_record(v, "analysis", "cy", cy + shift_y, unit='px')
+    add_record(v, "analysis", "diameter", diameter / 1E-9, unit='nm')
+    add_record(v, "analysis", "intensity", intensity / (1e-3 / 1e-12), unit='mJ/um**2')
+    add_record(v, "analysis", "error", error, unit='')
+    add_record(v, "analysis", "correlation", correlation, unit='')
+
 def sphereModel(evt, type, key_centerx, key_centery, key_diameter, key_intensity, 
                 shape, wavelength=1., pixelsize=110, distance=1000, adu_per_photon=1,
                 quantum_efficiency=1, material='virus', poisson=False):
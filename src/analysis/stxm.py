@@ -5,74 +5,167 @@
 from __future__ import print_function, absolute_import # Compatibility with python 2 and 3
 import numpy as np
 from backend import add_record
-import beamline
-import scipy.ndimage.measurements
+
+class STXMProcessor(object):
+    """Precomputed STXM values of detector frames of a given shape.
+
+    All values are linear in the frame: the sums over the bright field (pixels within r of the center or in mask),
+    the dark field (the other pixels), all pixels, the differences of the two halves along x and y and the moments
+    for the center of mass. Every pixel is labelled by the field and the halves it belongs to, such that the sums of
+    all labels of a frame are computed with a single ``bincount`` and the values are sums of these. The moments are
+    computed from the sums of the rows and columns. Pixels that are False in badmask are left out, also if they
+    are not finite, and a non-finite pixel only spoils the values it belongs to.
+
+    Args:
+        :shape(tuple):  Shape of a frame
+
+    Kwargs:
+        :cx(float):     Center in x, rounded to .0 or .5 (default = middle)
+        :cy(float):     Center in y, rounded to .0 or .5 (default = middle)
+        :r(float):      Radius of the bright field (default = 20)
+        :mask:          Boolean mask of the bright field, instead of the radius (default = None)
+        :badmask:       Boolean mask of the good pixels (default = None, all pixels are good)
+        :modes(tuple):  Any of 'bf', 'df', 'sum', 'diff' and 'com' (default = all)
+    """
+    def __init__(self, shape, cx=None, cy=None, r=20, mask=None, badmask=None, modes=('bf', 'df', 'sum', 'diff', 'com')):
+        Ny, Nx = shape
+        self.shape = tuple(shape)
+        if cx is None:
+            cx = (Nx-1)/2.
+        if cy is None:
+            cy = (Ny-1)/2.
+        # Round to .0 / .5
+        cx = np.round(cx * 2)/2.
+        cy = np.round(cy * 2)/2.
+        self.modes = tuple(modes)
+        good = np.ones(self.shape, dtype=bool) if badmask is None else np.asarray(badmask, dtype=bool)
+        self._labels = None
+        if set(self.modes) & set(['bf', 'df', 'sum', 'diff']):
+            # Field: 0 for neither (on the radius), 1 for the bright field and 2 for the dark field
+            field = np.zeros(self.shape, dtype=np.intp)
+            if mask is None:
+                xx, yy = np.meshgrid(np.arange(Nx)-cx, np.arange(Ny)-cy)
+                rr = np.sqrt(xx**2 + yy**2)
+                field[rr < r] = 1
+                field[rr > r] = 2
+            else:
+                field += np.where(np.asarray(mask, dtype=bool), 1, 2)
+            # Halves: 0 for neither, 1 for the left/upper and 2 for the right/lower half,
+            # two halves of equal size around the center, the center row/column is left out for integer centers
+            Nx_half = min([cx, Nx-1-cx])
+            Ny_half = min([cy, Ny-1-cy])
+            x1_min = int(cx - Nx_half)
+            y1_min = int(cy - Ny_half)
+            x2_max = int(cx + Nx_half + 1)
+            y2_max = int(cy + Ny_half + 1)
+            Nx_half = int(np.ceil(Nx_half))
+            Ny_half = int(np.ceil(Ny_half))
+            halfx = np.zeros(self.shape, dtype=np.intp)
+            halfx[y1_min:y2_max, x1_min:x1_min+Nx_half] = 1
+            halfx[y1_min:y2_max, x2_max-Nx_half:x2_max] = 2
+            halfy = np.zeros(self.shape, dtype=np.intp)
+            halfy[y1_min:y1_min+Ny_half, x1_min:x2_max] = 1
+            halfy[y2_max-Ny_half:y2_max, x1_min:x2_max] = 2
+            # Labels 0..26 for the good pixels, 27 for the bad ones
+            labels = field + 3*halfx + 9*halfy
+            labels[~good] = 27
+            self._labels = labels.ravel()
+        self._good = good if 'com' in self.modes else None
+        # Positions relative to the middle of the frame for the moments
+        self._x = np.arange(Nx) - (Nx/2. - 0.5)
+        self._y = np.arange(Ny) - (Ny/2. - 0.5)
+
+    def process(self, data, pulse_energy=1.):
+        """Returns a dictionary with the values of the modes for a frame, or arrays of them for a stack of frames.
+        The values are divided by the pulse energy (or by the pulse energies of the frames), except for 'com'."""
+        data = np.asarray(data)
+        frames = data.reshape((-1,) + self.shape)
+        nframes = frames.shape[0]
+        values = {}
+        if self._labels is not None:
+            # Sums over the labels with shape (frames, halfy, halfx, field)
+            bins = np.empty((nframes, 27))
+            for i in range(nframes):
+                bins[i] = np.bincount(self._labels, weights=frames[i].ravel(), minlength=28)[:27]
+            bins = bins.reshape((nframes, 3, 3, 3)) / np.reshape(pulse_energy, (-1, 1, 1, 1))
+            if 'bf' in self.modes:
+                values['bf'] = bins[..., 1].sum(axis=(1, 2))
+            if 'df' in self.modes:
+                values['df'] = bins[..., 2].sum(axis=(1, 2))
+            if 'sum' in self.modes:
+                values['sum'] = bins.sum(axis=(1, 2, 3))
+            if 'diff' in self.modes:
+                diffx = bins[:, :, 1].sum(axis=(1, 2)) - bins[:, :, 2].sum(axis=(1, 2))
+                diffy = bins[:, 1].sum(axis=(1, 2)) - bins[:, 2].sum(axis=(1, 2))
+                values['diff'] = np.sqrt(diffx**2 + diffy**2)
+        if self._good is not None:
+            com = np.empty(nframes)
+            for i in range(nframes):
+                good = np.where(self._good, frames[i], 0.)
+                columns = good.sum(axis=0)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    comx = columns.dot(self._x) / columns.sum()
+                    comy = good.sum(axis=1).dot(self._y) / columns.sum()
+                com[i] = np.sqrt(comx**2 + comy**2)
+            values['com'] = com
+        if data.ndim == 2:
+            for mode in values:
+                values[mode] = values[mode][0]
+        return values
+
+_processors = {}
+def _processor(shape, cx, cy, r, mask, badmask, modes):
+    """Returns the cached processor for a geometry, masks and modes"""
+    key = (shape, cx, cy, r, id(mask), id(badmask), tuple(modes))
+    if key not in _processors or _processors[key][0] is not mask or _processors[key][1] is not badmask:
+        if len(_processors) >= 8:
+            # Every processor holds labels of the pixels several times the size of a frame
+            _processors.clear()
+        _processors[key] = (mask, badmask, STXMProcessor(shape, cx=cx, cy=cy, r=r, mask=mask, badmask=badmask, modes=modes))
+    return _processors[key][2]
 
 def stxm(evt, data_rec, pulse_energy=1., mode='bf', cx=None, cy=None, r=20, mask=None, badmask=None):
+    """Scanning transmission value of a frame, or of every frame of a stack, divided by the pulse energy.
+    Adds the record ``evt["analysis"]["stxm " + mode]``.
+
+    Args:
+        :evt:       The event variable
+        :data_rec:  A pixel detector ``Record``
+
+    Kwargs:
+        :pulse_energy(float): Pulse energy, or pulse energies of a stack of frames (default = 1)
+        :mode(str):     'bf' (bright field), 'df' (dark field), 'sum' or 'diff' (difference of the halves)
+        :cx(float):     Center in x (default = middle)
+        :cy(float):     Center in y (default = middle)
+        :r(float):      Radius of the bright field (default = 20)
+        :mask:          Boolean mask of the bright field, instead of the radius (default = None)
+        :badmask:       Boolean mask of the good pixels (default = None, all pixels are good)
+    """
     data = data_rec.data
-    if badmask is None:
-        badmask = np.ones_like(data).astype(np.bool8)
-    else:
-        badmask = np.bool8(badmask)
-    Ny, Nx = data.shape
-    if cx is None:
-        cx = (Nx-1)/2.
-    if cy is None:
-        cy = (Ny-1)/2.
-    # Round to .0 / .5    
-    cx = np.round(cx * 2)/2.
-    cy = np.round(cy * 2)/2.
-    xx, yy = np.meshgrid(np.arange(Nx)-cx, np.arange(Ny)-cy)
-    rr = np.sqrt(xx**2 + yy**2)
-    if mode == 'bf':
-        if mask is None:
-            mask = rr < r
-        else:
-            mask = np.bool8(mask)
-        v = data[mask & badmask].sum() / pulse_energy
-    elif mode == 'df':
-        if mask is None:
-            mask = rr > r
-        else:
-            mask = ~np.bool8(mask)
-        v = data[mask & badmask].sum() / pulse_energy
-    elif mode == 'sum':
-        v = data[badmask].sum() / pulse_energy
-    elif mode == 'diff':
-        # Calc crop coordinates
-        Nx_half = min([cx, Nx-1-cx])
-        Ny_half = min([cy, Ny-1-cy])
-        x1_min = cx - Nx_half
-        y1_min = cy - Ny_half
-        x2_max = cx + Nx_half + 1
-        y2_max = cy + Ny_half + 1
-        Nx_half = int(np.ceil(Nx_half))
-        Ny_half = int(np.ceil(Ny_half))
-        x1_max = x1_min + Nx_half
-        y1_max = y1_min + Ny_half
-        x2_min = x2_max - Nx_half
-        y2_min = y2_max - Ny_half
-        # Calc diff
-        # Original type might be unsigned integer
-        #
-        # Casting is done to doubles for accumulation.
-        tmp = data*badmask
-        diffx = (tmp[y1_min:y2_max, x1_min:x1_max].sum(dtype=np.float64) - tmp[y1_min:y2_max, x2_min:x2_max].sum(dtype=np.float64)) / pulse_energy
-        diffy = (tmp[y1_min:y1_max, x1_min:x2_max].sum(dtype=np.float64) - tmp[y2_min:y2_max, x1_min:x2_max].sum(dtype=np.float64)) / pulse_energy
-        # Combine diff
-        v = np.sqrt(diffx**2+diffy**2)
+    v = _processor(data.shape[-2:], cx, cy, r, mask, badmask, (mode,)).process(data, pulse_energy)[mode]
     rec = add_record(evt["analysis"], "analysis", "stxm %s" %mode, v)
     return rec
 
+def stxmAll(evt, data_rec, pulse_energy=1., modes=('bf', 'df', 'sum', 'diff', 'com'), cx=None, cy=None, r=20, mask=None, badmask=None):
+    """Computes several STXM values of a frame, or of every frame of a stack, with one pass over the data.
+    Adds the records ``evt["analysis"]["stxm " + mode]`` for 'bf', 'df', 'sum' and 'diff' (see :func:`stxm`)
+    and ``evt["analysis"]["stxm center of mass"]`` for 'com' (see :func:`stxmCenterOfMass`).
+
+    Returns a dictionary of the records, see :func:`stxm` for the arguments.
+    """
+    data = data_rec.data
+    values = _processor(data.shape[-2:], cx, cy, r, mask, badmask, modes).process(data, pulse_energy)
+    records = {}
+    for mode in values:
+        key = "stxm center of mass" if mode == 'com' else "stxm %s" %mode
+        records[mode] = add_record(evt["analysis"], "analysis", key, values[mode])
+    return records
+
 def stxmCenterOfMass(evt, data_rec):
-    center_of_mass_y, center_of_mass_x = scipy.ndimage.measurements.center_of_mass(data_rec.data)
+    """Distance of the center of mass of a frame (or of every frame of a stack) from the middle of the frame.
+    Adds the record ``evt["analysis"]["stxm center of mass"]``.
+    """
     # this assumes that the image is centered already.
-    center_of_mass_y -= data_rec.data.shape[0]/2. - 0.5
-    center_of_mass_x -= data_rec.data.shape[1]/2. - 0.5
-    diff = np.sqrt(center_of_mass_x**2 + center_of_mass_x**2)
-    # x_rec = add_record(evt["analysis"], "analysis", "stxm center of mass x", center_of_mass_x)
-    # y_rec = add_record(evt["analysis"], "analysis", "stxm center of mass y", center_of_mass_y)
-    # return y_rec, x_rec
+    diff = _processor(data_rec.data.shape[-2:], None, None, 20, None, None, ('com',)).process(data_rec.data)['com']
     rec = add_record(evt["analysis"], "analysis", "stxm center of mass", diff)
     return rec
-    
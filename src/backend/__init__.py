@@ -7,6 +7,7 @@ from pint import UnitRegistry
 from .worker import Worker # pylint: disable=unused-import
 from .event_translator import EventTranslator # pylint: disable=unused-import
 from .record import Record, add_record # pylint: disable=unused-import
+from .pipeline import Pipeline # pylint: disable=unused-import
 
 ureg = UnitRegistry()
 ureg.enable_contexts('spectroscopy')
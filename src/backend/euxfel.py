@@ -14,7 +14,6 @@ from backend import Worker
 from . import ureg
 import logging
 import ipc
-import karabo_bridge
 import numpy
 
 from hummingbird import parse_cmdline_args
@@ -103,6 +102,8 @@ class EUxfelTranslator(object):
             self._cell_filter[cell] = False
 
         # Start Karabo client for data source
+        # (karabo_bridge is only imported here, such that the pulse views can be used without it)
+        import karabo_bridge
         self._data_client = karabo_bridge.Client(dsrc)
         
         
@@ -348,60 +349,145 @@ class EUxfelTrainTranslator(EUxfelTranslator):
             data = obj[trace_dict[k]]
             add_record(values, 'trace', k, data, ureg.ADU)
 
+class _PulseSource(object):
+    """View of a source of a train for a pulse (or several pulses), slicing arrays of the train only when they are accessed"""
+    def __init__(self, arrays, meta, index):
+        self._arrays = arrays
+        self._meta = meta
+        self._index = index
+        self._cache = {}
+
+    def __getitem__(self, key):
+        if key in self._meta:
+            return self._meta[key]
+        if key not in self._cache:
+            v = self._arrays[key]
+            if type(v) is list:
+                raise KeyError(key)
+            self._cache[key] = v[..., self._index]
+        return self._cache[key]
+
+    def __contains__(self, key):
+        return key in self._meta or (key in self._arrays and type(self._arrays[key]) is not list)
+
+    def keys(self):
+        return [k for k, v in self._arrays.items() if type(v) is not list and k not in self._meta] + list(self._meta.keys())
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+class _Pulse(object):
+    """Event of a pulse (or several pulses) of a train, with a lazy view of every source"""
+    def __init__(self, train, meta, index):
+        self._train = train
+        self._meta = meta
+        self.index = index
+        self._sources = {}
+
+    def __getitem__(self, source):
+        if source not in self._sources:
+            self._sources[source] = _PulseSource(self._train[source], self._meta[source], self.index)
+        return self._sources[source]
+
+    def __setitem__(self, source, value):
+        self._sources[source] = value
+
+    def __contains__(self, source):
+        return source in self._meta or source in self._sources
+
+    def keys(self):
+        return list(self._meta.keys()) + [k for k in self._sources if k not in self._meta]
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
 class EUxfelPulseTranslator(EUxfelTranslator):
-    """Translate between EUxfel pulse events and Hummingbird ones"""
+    """Translate between EUxfel pulse events and Hummingbird ones.
+
+    The good cells of a train are determined once per train and events are lightweight
+    views of the train, arrays are only sliced when they are translated. With
+    'EuXFEL/PulsesPerEvent' > 1, every event holds that many pulses (the last axis
+    of the arrays), such that the analysis can run over several pulses at once."""
     def __init__(self, state):
         EUxfelTranslator.__init__(self, state)
         self._train_buffer = None
         self._train_meta = None
-        self._remaining_pulses = 0
+        self._train_length = None
         self._good_cells = None
+        self._pulses = []
+        self._next_pulse = 0
 
         # Option to skip pulses within a train
         self._skip_n_pulses = 0
         if 'EuXFEL/SkipNrPulses' in state:
             self._skip_n_pulses = state['EuXFEL/SkipNrPulses']
 
+        # Option to put several pulses into one event
+        self._pulses_per_event = 1
+        if 'EuXFEL/PulsesPerEvent' in state:
+            self._pulses_per_event = int(state['EuXFEL/PulsesPerEvent'])
+
+    def _find_train_length(self, buf):
+        """Returns the number of pulses of a train"""
+        for source in buf.values():
+            if 'image.pulseId' in source:
+                return numpy.array(source['image.pulseId']).shape[-1]
+        for source in buf.values():
+            for v in source.values():
+                if type(v) is not list and numpy.ndim(v) > 0:
+                    return numpy.shape(v)[-1]
+        return 0
+
+    def _pulse_indices(self, good_cells):
+        """Returns the indices of the good pulses of a train, skipping pulses after every good one if requested,
+        as integers or arrays of pulses_per_event indices"""
+        indices = []
+        i = 0
+        while i < len(good_cells):
+            if good_cells[i]:
+                indices.append(i)
+                i += 1 + self._skip_n_pulses
+            else:
+                i += 1
+        if self._pulses_per_event == 1:
+            return indices
+        indices = numpy.array(indices, dtype='int')
+        return [indices[i:i+self._pulses_per_event] for i in range(0, len(indices), self._pulses_per_event)]
+
     def next_event(self):
         """Grabs the next event returns the translated version."""
         # If no remaining pulses in the buffer:
         #   Gets next train from Karabo Bridge
-        #   Resets number of remaining pulses
-        if not self._remaining_pulses:
+        #   Determines the good pulses of the train
+        while self._next_pulse >= len(self._pulses):
             self._train_buffer, self._train_meta = self.next_train()
-            # self._train_id = self._train_buffer[list(self._train_buffer.keys())[0]]['image.trainId']
-            # self._train_id = self._train_buffer["SQS_NQS_PNCCD1MP/CAL/PNCCD_FMT-1:output"]['data.trainId']
-            # self._train_length = len(self._train_id)
-            self._remaining_pulses = self._train_length
+            self._train_length = self._find_train_length(self._train_buffer)
             self._good_cells = self._cell_filter[:self._train_length]
+            self._pulses = self._pulse_indices(self._good_cells)
+            self._next_pulse = 0
 
-        # If pulses still remaining in the buffer:
-        #   Sets current event to first remaining pulse
-        #   Populates event dictionary
-        
-        if self._remaining_pulses:
-            index = self._train_length - self._remaining_pulses
-            if not self._good_cells[index]:
-                self._remaining_pulses -= 1
-                return self.next_event()
-            evt = {}
-            for source, d in self._train_meta.items():
-                evt[source] = {}
-                for k,v in self._train_buffer[source].items():
-                    if type(v) is list:
-                        continue
-                    evt[source][k] = v[...,index]
-                for k,v in d.items():
-                    evt[source][k] = v
-            # Update remaining pulses, skipping some pulses if requested
-            self._remaining_pulses = max(0, self._remaining_pulses - (1 + self._skip_n_pulses))
-
+        # Sets current event to the next good pulse
+        evt = _Pulse(self._train_buffer, self._train_meta, self._pulses[self._next_pulse])
+        self._next_pulse += 1
         return EventTranslator(evt, self)
 
+    def translate_core(self, evt, key):
+        """Returns a dict of Records that matchs a core Hummingbird key."""
+        values = {}
+        for k in self._c2n[key]:
+            if k in evt:
+                if key == 'eventID':
+                    self._tr_event_id(values, evt[k])
+                elif key == 'photonPixelDetectors':
+                    self._tr_photon_detector(values, evt[k], k)
+                else:
+                    raise RuntimeError('%s not yet supported with key %s' % (k, key))
+        return values
+
     def event_id(self, evt):
         """Returns an id which should be unique for each
         shot and increase monotonically"""
-        return self.translate(evt, 'eventID')['Timestamp'].timestamp
+        return numpy.min(self.translate(evt, 'eventID')['Timestamp'].timestamp)
     
     def _tr_photon_detector(self, values, obj, evt_key):
         """Translates pixel detector into Humminbird ADU array"""
@@ -423,11 +509,15 @@ class EUxfelPulseTranslator(EUxfelTranslator):
         
     def _tr_event_id(self, values, obj):
         """Translates euxfel event ID from some source into a hummingbird one"""
-        pulseid = int(obj["image.pulseId"])
+        pulseid = numpy.array(obj["image.pulseId"], dtype='int')
         # timestamp = int(obj['timestamp.sec']) + int(obj['timestamp.frac']) * 1e-18 + pulseid * 1e-2
         timestamp = int(obj['timestamp.tid']) + pulseid * 1e-2
-        time = datetime.datetime.fromtimestamp(timestamp, tz=timezone('utc'))
-        time = time.astimezone(tz=timezone('CET'))
+        if pulseid.ndim == 0:
+            timestamp = float(timestamp)
+            time = datetime.datetime.fromtimestamp(timestamp, tz=timezone('utc')).astimezone(tz=timezone('CET'))
+        else:
+            # Several pulses per event
+            time = numpy.array([datetime.datetime.fromtimestamp(t, tz=timezone('utc')).astimezone(tz=timezone('CET')) for t in timestamp])
         rec = Record('Timestamp', time, ureg.s)
         # rec.pulseId = int(obj['image.pulseId'])
         # rec.cellId  = int(obj['image.cellId'])
@@ -15,6 +15,9 @@ import ipc
 import backend.flash_utils.convert_frms6 as convert
 import backend.flash_utils.tomas_motors as motors
 import backend.flash_utils.read_daq_offline as read_daq
+import backend.flash_utils.file_index as file_index
+import backend.flash_utils.metadata_index as metadata_index
+import backend.flash_utils.offline_scheduler as offline_scheduler
 import glob
 import sys
 import os
@@ -37,9 +40,13 @@ class FLASHTranslator(object):
         self.num = None
         self.fnum = None
         self.reader = None
+        self.scheduler = None
         self._current_event_id = None
         self.get_dark()
-        self.motors = motors.MotorPositions(state['FLASH/MotorFolder'])
+        # Parsed DAQ and motor files are cached on disk
+        self.metadata_cache_dir = state.get('FLASH/MetadataCacheDir', metadata_index.default_cache_dir)
+        self.daq_index = None
+        self.motors = motors.MotorPositions(state['FLASH/MotorFolder'], cache_dir=self.metadata_cache_dir)
         self.daq = None
         if 'do_offline' in state:
             self.do_offline = state['do_offline']
@@ -53,11 +60,20 @@ class FLASHTranslator(object):
             print('Running offline i.e. on all files in glob')
         if not self.do_offline and self._online_start_from_run:
             print('Running online and starting with all files from run', self._online_start_from_run)
+        # Only the main event reader looks for new files, all others get the index from it
+        accept = None
+        if self._online_start_from_run:
+            accept = lambda f: self.file_filter(f, self._online_start_from_run)
+        self.files = file_index.FileIndex(state['FLASH/DataGlob'], accept=accept,
+                                          interval=state.get('FLASH/FileCheckInterval', 1.),
+                                          comm=ipc.mpi.event_reader_comm if ipc.mpi.use_mpi else None)
 
     def next_event(self):
         """Generates and returns the next event"""
         evt = {}
         
+        if self.do_offline:
+            return self.next_offline_event(evt)
         self.new_file_check()
         
         # Check if we need to sleep
@@ -109,6 +125,38 @@ class FLASHTranslator(object):
         self.num += 1
         return EventTranslator(evt, self)
 
+    def next_offline_event(self, evt):
+        """Returns the next event of all files in the glob, frames are handed out to
+        the event readers in chunks by an OfflineScheduler"""
+        if self.scheduler is None:
+            self.files.update()
+            self.scheduler = offline_scheduler.OfflineScheduler(self.files.files, self._count_frames,
+                                                                chunk_size=self.state.get('FLASH/OfflineChunkSize', 16),
+                                                                comm=ipc.mpi.event_reader_comm if ipc.mpi.use_mpi else None)
+            # Freeing the counter is collective, all event readers do it when they are done
+            ipc.mpi.at_shutdown(self.scheduler.close)
+            if ipc.mpi.is_main_event_reader():
+                print('Found %d files with %d frames' % (len(self.scheduler.files), self.scheduler.nframes))
+        item = self.scheduler.next()
+        if item is None:
+            print('Rank %d is closing' % ipc.mpi.rank)
+            return None
+        fname, num = item
+        if fname != self.current_fname:
+            self.get_dark()
+            self.reader = convert.Frms6_reader(fname, offset=self.offset)
+            self.current_fname = fname
+        self.reader.parse_frames(start_num=num, num_frames=1)
+        evt['pnCCD'] = self.reader.frames[0]
+        self.keys.add('photonPixelDetectors')
+        self._current_event_id = self.reader.frame_headers[0].external_id
+        return EventTranslator(evt, self)
+
+    def _count_frames(self, fname):
+        if os.path.getsize(fname) < 1024:
+            return 0
+        return convert.Frms6_reader(fname).nframes
+
     def event_keys(self, _):
         """Returns the translated keys available"""
         return list(self.keys)
@@ -127,7 +175,7 @@ class FLASHTranslator(object):
             val = self.motors.get(self.get_bunch_time()[0])
             if val is None:
                 raise RuntimeError('%s not found in event' % key)
-            for motorname,motorpos in val.iteritems():
+            for motorname,motorpos in val.items():
                 add_record(values, key, motorname, motorpos, ureg.mm)
         elif key == 'ID':
             add_record(values, key, 'DataSetID', self.reader.file_header.dataSetID.rstrip('\0'))
@@ -187,10 +235,8 @@ class FLASHTranslator(object):
                 return False
 
     def new_file_check(self, force=False):
-        flist = glob.glob(self.state['FLASH/DataGlob'])
-        if self._online_start_from_run:
-            flist = [f for f in flist if self.file_filter(f,self._online_start_from_run)]
-        flist.sort()
+        self.files.update()
+        flist = self.files.files
         if self.do_offline or self._online_start_from_run:
             if self.fnum is None:
                 self.fnum = 0
@@ -206,11 +252,11 @@ class FLASHTranslator(object):
                     print("No more files to process", force, self.fnum)
                     return False
             latest_fname = flist[self.fnum]
-            file_size = os.path.getsize(latest_fname)
+            file_size = self.files.size(latest_fname)
         else:
             #latest_fname = max(flist, key=os.path.getmtime)
-            latest_fname = sorted(flist, key=os.path.getmtime)[-2]
-            file_size = os.path.getsize(latest_fname) 
+            latest_fname = self.files.by_mtime()[-2]
+            file_size = self.files.size(latest_fname)
             #if ipc.mpi.slave_rank() == 0:
             #    print('Glob in rank %d: latest: %s/%d' % (ipc.mpi.slave_rank(), latest_fname, file_size))
                 
@@ -264,32 +310,20 @@ class FLASHTranslator(object):
         filename = self.state['FLASH/DAQFolder']+'/daq-%.4d-%.2d-%.2d-%.2d.txt' % (tmp_time.tm_year, tmp_time.tm_mon, tmp_time.tm_mday, tmp_time.tm_hour)
         if filename != self.daq_fname:
             self.daq_fname = filename
-            with open(filename, 'r') as f:
-                lines = list(set(f.readlines()))
-            self.daq_lines = [l.split() for l in lines]
-            self.bunch_ids = numpy.array([int(l[1]) for l in self.daq_lines])
-            self.wavelengths = numpy.array([float(l[2]) for l in self.daq_lines])
-            try:
-                self.gmds = numpy.array([float(l[3]) for l in self.daq_lines])
-            except ValueError:
-                self.gmds = None
-            #print('DAQ file:', filename, 'max id = %d, min id = %d' % (self.bunch_ids.max(), self.bunch_ids.min()))
-        locations = numpy.where(self.bunch_ids == self.reader.frame_headers[-1].external_id)[0]
-        if len(locations) < 1:
+            self.daq_index = metadata_index.DAQIndex(filename, cache_dir=self.metadata_cache_dir)
+            #print('DAQ file:', filename, 'max id = %d, min id = %d' % (self.daq_index.columns['bunch_id'].max(), self.daq_index.columns['bunch_id'].min()))
+        location = self.daq_index.find(self.reader.frame_headers[-1].external_id)
+        if location is None:
             return self.reader.frame_headers[-1].tv_sec, None
         else:
-            return int(self.daq_lines[locations[0]][0]), locations[0]
+            return int(self.daq_index.columns['time'][location]), location
 
     def get_wavelength(self, daq_index):
         if daq_index is not None:
-            return self.wavelengths[daq_index]
+            return self.daq_index.columns['wavelength'][daq_index]
         
     def get_gmd(self, daq_index):
         if daq_index is not None:
-            if self.gmds is not None:
-                return self.gmds[daq_index]
-        
-        
-
-        
-         
+            gmd = self.daq_index.columns['gmd'][daq_index]
+            if not numpy.isnan(gmd):
+                return gmd
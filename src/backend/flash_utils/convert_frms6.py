@@ -5,6 +5,7 @@ import h5py
 import sys
 import os
 import argparse
+import re
 
 class Frms6_file_header():
     def __init__(self, length=1024):
@@ -41,12 +42,30 @@ class Frms6_file_header():
         print('the_max_height', self.the_max_height)
 
 class Frms6_frame_header():
+    names = ('start', 'info', 'id', 'height', 'tv_sec', 'tv_usec', 'index', 'temp',
+             'the_start', 'the_height', 'external_id', 'bunch_id', 'fill')
     def __init__(self, length=64):
         self.fmt = '4B3Id2HIL24s'
         self.length = length
         self._time_offset = 208
         if length != 64:
             self.fmt = self.fmt[:-3]+str(length-40)+'s'
+
+    def dtype(self):
+        """Numpy dtype of a header, with the same (native) layout as its struct format"""
+        codes = re.findall(r'(\d*)([a-zA-Z])', self.fmt)
+        codes = sum([[c]*int(n or 1) if c != 's' else [n+c] for n, c in codes], [])
+        formats = [('S'+c[:-1]) if c.endswith('s') else c for c in codes]
+        # The offset of a field is the size of the preceding fields plus the alignment of the field
+        offsets = [struct.calcsize(''.join(codes[:i+1])) - struct.calcsize(codes[i]) for i in range(len(codes))]
+        return np.dtype({'names': self.names, 'formats': formats, 'offsets': offsets, 'itemsize': self.length})
+
+    def set(self, record):
+        """Sets the header from a record of :func:`dtype`"""
+        for name in self.names:
+            setattr(self, name, record[name])
+        self.tv_sec = int(self.tv_sec) + self._time_offset
+        return self
     
     def parse(self, fname, curr_pos):
         f = open(fname, 'rb')
@@ -78,6 +97,14 @@ class Frms6_frame_header():
         print('bunch_id',self.bunch_id)
 
 class Frms6_reader():
+    """Reader of the frames of an frms6 file.
+
+    The file is mapped into memory as an array of records of a frame header and a raw frame,
+    such that any frame can be read without parsing the file. The headers of all frames are
+    available as columns with :func:`header_table`. Frames are rearranged into the requested
+    shape through precomputed views of the raw frame and the offset is subtracted on the way.
+    A file that is still being written is mapped again when frames beyond its end are requested.
+    """
     def __init__(self, fname, shape_str='assem', offset=None, verbose=False):
         self.fname = fname
         self.verbose = verbose
@@ -96,48 +123,111 @@ class Frms6_reader():
         self.nx = self.file_header.the_width
         self.ny = self.file_header.the_max_height
         #print('nx ny =', self.nx, self.ny)
+        self.header_dtype = Frms6_frame_header(length=self.file_header.fh_length).dtype()
+        self.record_dtype = np.dtype([('header', self.header_dtype), ('data', '=i2', (self.nx, self.ny))])
+        self._blocks = self._layout()
+        self.shape = self.arg_reshape(np.zeros((self.nx, self.ny), dtype='=i2')).shape
         if offset is None:
-            self.offset = self.arg_reshape(np.zeros((self.nx, self.ny)))
+            self.offset = None
+            self.dtype = np.dtype(np.float64)
         else:
-            self.offset = offset
+            self.offset = np.asarray(offset)
+            self.dtype = np.result_type(np.int16, self.offset.dtype)
+        self._buffer = np.empty(self.shape, dtype=self.dtype)
+        self._records = None
+        self._size = None
+        self._table = None
+        self.frame_headers = []
+        self.frames = []
+        self.refresh()
+
+    def refresh(self):
+        """Maps the file again if it has grown, returns the number of complete frames"""
+        size = os.path.getsize(self.fname)
+        if size != self._size:
+            self._size = size
+            n = max(size - self.file_header.my_length, 0) // self.record_dtype.itemsize
+            if n == 0:
+                self._records = None
+            elif self._records is None or n != self._records.shape[0]:
+                self._records = np.memmap(self.fname, dtype=self.record_dtype, mode='r',
+                                          offset=self.file_header.my_length, shape=(n,))
+                self._table = None
+        return self.nframes
+
+    @property
+    def nframes(self):
+        """Number of complete frames in the file when it was last mapped"""
+        return 0 if self._records is None else self._records.shape[0]
+
+    def header_table(self):
+        """Returns a dictionary with the columns of the headers of all frames"""
+        if self._table is None:
+            self._table = {}
+            if self._records is not None:
+                headers = self._records['header']
+                for name in self.header_dtype.names:
+                    self._table[name] = np.array(headers[name])
+                self._table['tv_sec'] = self._table['tv_sec'].astype(np.int64) + Frms6_frame_header()._time_offset
+        return self._table
+
+    def frame_header(self, num):
+        """Returns the header of frame num"""
+        return Frms6_frame_header(length=self.file_header.fh_length).set(self._records[num]['header'])
+
+    def frame(self, num, out=None):
+        """Returns frame num in the requested shape minus the offset. Unless out is given, the frame is
+        written to a buffer of the reader, which is overwritten when the next frame is read."""
+        if out is None:
+            out = self._buffer
+        raw = self._records[num]['data']
+        for destination, source in self._blocks:
+            if self.offset is None:
+                np.copyto(out[destination], source(raw), casting='unsafe')
+            else:
+                np.subtract(source(raw), self.offset[destination], out=out[destination], casting='unsafe')
+        return out
     
-    def parse_frames(self, start_num=0, num_frames=-1):
-        curr_pos = self.file_header.my_length + start_num*(self.file_header.fh_length + self.nx*self.ny*2)
+    def parse_frames(self, start_num=0, num_frames=-1, copy=True):
+        """Reads the headers and frames (see :func:`frame`) from frame start_num into frame_headers and frames,
+        all frames until the end of the file for num_frames=-1. With copy=False a single frame
+        is left in the buffer of the reader, it must not be kept beyond the next call."""
         self.frame_headers = []
         self.frames = []
-        i = 0
         if num_frames == 0:
             return
-        
-        while True:
-            self.frame_headers.append(Frms6_frame_header(length=self.file_header.fh_length))
-            ret = self.frame_headers[-1].parse(self.fname, curr_pos)
-
-            if ret != 0:
-                print('Frame header parsing failed:', ret)
-                self.frame_headers = self.frame_headers[:-1]
-                break
-            
-            f = open(self.fname, 'rb')
-            f.seek(curr_pos + self.file_header.fh_length, 0)
-            raw_frame = np.fromfile(f, '=i2', count=self.nx*self.ny)
-            f.close()
-            curr_pos += self.file_header.fh_length + 2*self.nx*self.ny
-            
-            if raw_frame.size < self.nx*self.ny:
-                #print('Frame size = %d < %d' % (raw_frame.size, self.nx*self.ny))
-                self.frame_headers = self.frame_headers[:-1]
-                break
-            self.frames.append(self.arg_reshape(raw_frame)-self.offset)
-            
-            i += 1
+        end = self.nframes if num_frames < 0 else start_num + num_frames
+        if end > self.nframes or num_frames < 0:
+            self.refresh()
+            end = self.nframes if num_frames < 0 else min(end, self.nframes)
+        for i in range(start_num, end):
+            self.frame_headers.append(self.frame_header(i))
+            if copy or num_frames != 1:
+                # Every frame gets its own array, it stays valid when the next frame is read
+                self.frames.append(self.frame(i, out=np.empty_like(self._buffer)))
+            else:
+                self.frames.append(self.frame(i))
             if self.verbose:
-                sys.stderr.write('\rParsed %d frames' % i)
-            if num_frames > 0 and i >= num_frames:
-                break
+                sys.stderr.write('\rParsed %d frames' % (i - start_num + 1))
         if self.verbose:
             sys.stderr.write('\n')
 
+    def _layout(self):
+        """Precomputes the blocks of a frame in the requested shape, as destination slices
+        and functions returning the corresponding views of the raw frame"""
+        if self.shape_arg == 2:
+            return [((slice(None), slice(None)), lambda a: a)]
+        elif self.shape_arg == 1:
+            return [((slice(None), slice(None), slice(None)), self.frms6_to_psana)]
+        # The quadrants of the assembled frame, the second and third are rotated by 180 degrees
+        quadrants = [(0, 0, 0, False), (1, 512, 0, True), (3, 0, 512, False), (2, 512, 512, True)]
+        blocks = []
+        for q, y, x, rotated in quadrants:
+            step = -1 if rotated else 1
+            view = lambda a, q=q, step=step: self.frms6_to_psana(a)[q, ::step, ::step]
+            blocks.append(((slice(y, y+512), slice(x, x+512)), view))
+        return blocks
+
     def frms6_to_psana(self, a):
         return a.reshape(512,4,512).transpose(1,0,2)
     
@@ -149,7 +239,7 @@ class Frms6_reader():
         if self.shape_arg == 2:
             return a
         elif self.shape_arg == 1:
-            return self.frms_to_psana(a)
+            return self.frms6_to_psana(a)
         elif self.shape_arg == 0:
             return self.psana_to_assem(self.frms6_to_psana(a))
 
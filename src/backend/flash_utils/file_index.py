@@ -0,0 +1,201 @@
+"""Incremental index of the data files of a run that are being written.
+
+The index lists the files matching a glob pattern with their modification times
+and sizes. Only one process (rank 0 of the given communicator) looks at the
+file system, all others receive the changes of the index from it. Files are not
+stat'ed again once they have settled, i.e. once their modification time is
+more than settle seconds older than that of the newest file (the mtime cursor).
+Where inotify is available, the directories are watched and only the files
+with events are stat'ed in between full scans of the directories."""
+from __future__ import print_function, absolute_import # Compatibility with python 2 and 3
+import os
+import glob
+import fnmatch
+import time
+import errno
+import struct
+import ctypes
+import logging
+
+class _Inotify(object):
+    """Minimal inotify through ctypes, watching directories for created, moved in and modified files"""
+    _IN_MODIFY = 0x2
+    _IN_CLOSE_WRITE = 0x8
+    _IN_MOVED_TO = 0x80
+    _IN_CREATE = 0x100
+    _IN_Q_OVERFLOW = 0x4000
+    def __init__(self, directories):
+        libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.directories = {}
+        mask = self._IN_MODIFY | self._IN_CLOSE_WRITE | self._IN_MOVED_TO | self._IN_CREATE
+        for d in directories:
+            wd = libc.inotify_add_watch(self.fd, d.encode(), mask)
+            if wd < 0:
+                os.close(self.fd)
+                raise OSError(ctypes.get_errno(), 'inotify_add_watch failed for %s' % d)
+            self.directories[wd] = d
+
+    def read(self):
+        """Returns the paths of the files with events since the last call, None if events have been lost"""
+        paths = set()
+        overflow = False
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                    break
+                raise
+            if not buf:
+                break
+            i = 0
+            while i < len(buf):
+                wd, mask, cookie, length = struct.unpack_from('iIII', buf, i)
+                name = buf[i+16:i+16+length].rstrip(b'\0').decode()
+                i += 16 + length
+                if mask & self._IN_Q_OVERFLOW:
+                    overflow = True
+                elif wd in self.directories and name:
+                    paths.add(os.path.join(self.directories[wd], name))
+        return None if overflow else paths
+
+    def close(self):
+        os.close(self.fd)
+
+class FileIndex(object):
+    """Sorted index of the files matching a glob pattern, with their modification times and sizes.
+
+    Args:
+        :pattern(str):  Glob pattern of the files
+
+    Kwargs:
+        :accept:                Function f(filename) returning False for matching files that are ignored (default = None)
+        :interval(float):       Minimal time between two looks at the file system [s] (default = 1)
+        :settle(float):         Files modified this much before the newest file are not stat'ed again [s] (default = 60)
+        :rescan_interval(float): Time between full scans of the directories when using inotify [s] (default = 30)
+        :comm:                  MPI communicator of the processes sharing the index, rank 0 looks at the
+                                file system (default = None, no sharing)
+        :use_inotify(bool):     Watch the directories with inotify where available (default = True)
+    """
+    _TAG = 5
+    def __init__(self, pattern, accept=None, interval=1., settle=60., rescan_interval=30., comm=None, use_inotify=True):
+        self.pattern = pattern
+        self.accept = accept
+        self.interval = interval
+        self.settle = settle
+        self.rescan_interval = rescan_interval
+        self.comm = None if comm is None else comm.Dup()
+        self.root = self.comm is None or self.comm.Get_rank() == 0
+        self.files = []
+        self._stat = {}
+        self._ignored = set()
+        self._by_mtime = None
+        self._last_update = None
+        self._last_scan = None
+        self._received = False
+        self._sent = False
+        self._requests = []
+        self._inotify = None
+        if self.root and use_inotify:
+            try:
+                directories = [d for d in glob.glob(os.path.dirname(pattern) or '.') if os.path.isdir(d)]
+                self._inotify = _Inotify(directories)
+            except (OSError, AttributeError) as e:
+                logging.info("No inotify for %s, polling instead (%s)" % (pattern, e))
+
+    def update(self):
+        """Updates the index, at most every interval seconds. Returns True if the index has changed."""
+        now = time.time()
+        if not self.root:
+            return self._receive()
+        if self._last_update is not None and now - self._last_update < self.interval:
+            return False
+        self._last_update = now
+        paths = None
+        if self._inotify is not None and self._last_scan is not None and now - self._last_scan < self.rescan_interval:
+            paths = self._inotify.read()
+        if paths is None:
+            self._last_scan = now
+            changes = self._scan()
+        else:
+            changes = self._stat_files(p for p in paths if fnmatch.fnmatch(p, self.pattern))
+        if self.comm is not None and (changes or not self._sent):
+            self._send(changes)
+        return self._apply(changes)
+
+    def _scan(self):
+        """Lists the directories and stats the new files and those that have not settled"""
+        names = set(glob.glob(self.pattern))
+        changes = dict((name, None) for name in self._stat if name not in names)
+        candidates = [name for name in names if name not in self._stat and name not in self._ignored]
+        if self._stat:
+            cursor = max(m for m, s in self._stat.values()) - self.settle
+            candidates += [name for name in names if name in self._stat and self._stat[name][0] >= cursor]
+            # The newest files are always checked
+            candidates += [name for name in self.by_mtime()[-2:] if name in names]
+        changes.update(self._stat_files(candidates))
+        return changes
+
+    def _stat_files(self, names):
+        """Returns the changed modification times and sizes of files, None for removed files"""
+        changes = {}
+        for name in set(names):
+            if name in self._ignored:
+                continue
+            if name not in self._stat and self.accept is not None and not self.accept(name):
+                self._ignored.add(name)
+                continue
+            try:
+                st = os.stat(name)
+                value = (st.st_mtime, st.st_size)
+            except OSError:
+                value = None
+            if self._stat.get(name) != value:
+                changes[name] = value
+        return changes
+
+    def _send(self, changes):
+        """Sends the changes to all other processes, without waiting for them"""
+        self._requests = [r for r in self._requests if not r.Test()]
+        for i in range(1, self.comm.Get_size()):
+            self._requests.append(self.comm.isend(changes, i, tag=self._TAG))
+        self._sent = True
+
+    def _receive(self):
+        """Applies the changes sent by rank 0, waits for the first ones"""
+        changed = False
+        if not self._received:
+            changed = self._apply(self.comm.recv(source=0, tag=self._TAG))
+            self._received = True
+        while self.comm.Iprobe(source=0, tag=self._TAG):
+            changed |= self._apply(self.comm.recv(source=0, tag=self._TAG))
+        return changed
+
+    def _apply(self, changes):
+        if not changes:
+            return False
+        for name, value in changes.items():
+            if value is None:
+                self._stat.pop(name, None)
+            else:
+                self._stat[name] = value
+        self.files = sorted(self._stat)
+        self._by_mtime = None
+        return True
+
+    def by_mtime(self):
+        """Returns the files sorted by their modification times"""
+        if self._by_mtime is None:
+            self._by_mtime = sorted(self._stat, key=lambda name: self._stat[name][0])
+        return self._by_mtime
+
+    def mtime(self, name):
+        """Returns the modification time of a file in the index"""
+        return self._stat[name][0]
+
+    def size(self, name):
+        """Returns the size of a file in the index"""
+        return self._stat[name][1]
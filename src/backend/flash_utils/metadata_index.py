@@ -0,0 +1,190 @@
+"""Indexes of the text files with metadata written during a FLASH beamtime (DAQ and motor positions).
+
+The files grow by appending lines. Every line is parsed only once into numpy
+columns, the position in the file up to which it has been parsed is kept, and
+both are cached on disk, such that restarted workers and new ranks continue
+where the cache left off instead of parsing the whole file again."""
+from __future__ import print_function, absolute_import # Compatibility with python 2 and 3
+import os
+import time
+import hashlib
+import logging
+import tempfile
+import numpy
+
+default_cache_dir = os.path.join(tempfile.gettempdir(), 'hummingbird_flash_metadata')
+
+class TextIndex(object):
+    """Columns parsed incrementally from the complete lines of a text file, see :func:`parse`.
+
+    Args:
+        :filename(str):  Path of the text file
+
+    Kwargs:
+        :cache_dir(str):        Directory of the cache files, None for no cache (default = default_cache_dir)
+        :cache_interval(float): Minimal time between two writes of the cache [s] (default = 10)
+    """
+    _version = 1
+    def __init__(self, filename, cache_dir=default_cache_dir, cache_interval=10.):
+        self.filename = filename
+        self.cache_dir = cache_dir
+        self.cache_interval = cache_interval
+        self._last_save = 0.
+        self._reset()
+        if cache_dir is not None:
+            self._load()
+        self.update()
+
+    def _reset(self):
+        self.offset = 0
+        self.rows = 0
+        self.columns = {}
+        self._head = b''
+        self._size = None
+
+    def parse(self, lines):
+        """Returns a dictionary of numpy arrays with the values of the given lines, to be implemented by subclasses"""
+        raise NotImplementedError
+
+    def update(self):
+        """Parses the lines appended to the file since the last update. Returns True if there were new lines."""
+        size = os.path.getsize(self.filename)
+        if size == self._size:
+            return False
+        with open(self.filename, 'rb') as f:
+            head = f.read(len(self._head))
+            if size < self.offset or head != self._head:
+                # The file has been replaced
+                self._reset()
+            f.seek(self.offset)
+            data = f.read(size - self.offset)
+        self._size = size
+        end = data.rfind(b'\n') + 1
+        if end == 0:
+            return False
+        if self.offset == 0:
+            self._head = data[:min(end, 64)]
+        self.offset += end
+        lines = [l for l in data[:end].decode('latin-1').splitlines() if l.strip()]
+        if not lines:
+            return False
+        first = self.rows
+        self._append(self.parse(lines))
+        self._added(first)
+        if self.cache_dir is not None and time.time() - self._last_save > self.cache_interval:
+            self._save()
+        return True
+
+    def _append(self, new):
+        """Appends columns of new rows, filling columns missing on either side with NaN"""
+        n = len(next(iter(new.values()))) if new else 0
+        for name in set(self.columns) | set(new):
+            old = self.columns.get(name)
+            if old is None:
+                old = numpy.full(self.rows, numpy.nan)
+            values = new.get(name)
+            if values is None:
+                values = numpy.full(n, numpy.nan)
+            self.columns[name] = numpy.concatenate([old, values])
+        self.rows += n
+
+    def _added(self, first):
+        """Called with the index of the first new row after new rows have been appended"""
+        pass
+
+    def _cache_filename(self):
+        key = hashlib.md5(os.path.abspath(self.filename).encode()).hexdigest()
+        return os.path.join(self.cache_dir, '%s-%s.npz' % (self.__class__.__name__, key))
+
+    def _load(self):
+        filename = self._cache_filename()
+        if not os.path.isfile(filename):
+            return
+        try:
+            with numpy.load(filename) as cache:
+                if int(cache['__version__']) != self._version:
+                    return
+                self.offset = int(cache['__offset__'])
+                self._head = cache['__head__'].tobytes()
+                self.columns = dict((name, cache[name]) for name in cache.files if not name.startswith('__'))
+        except (IOError, OSError, KeyError, ValueError) as e:
+            logging.warning("Could not read the cache %s of %s: %s" % (filename, self.filename, e))
+            self._reset()
+            return
+        self.rows = len(next(iter(self.columns.values()))) if self.columns else 0
+        self._added(0)
+
+    def _save(self):
+        """Writes the cache, through a temporary file such that readers never see a partial cache"""
+        self._last_save = time.time()
+        filename = self._cache_filename()
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            tmp = '%s.%d.tmp' % (filename, os.getpid())
+            with open(tmp, 'wb') as f:
+                numpy.savez(f, __version__=self._version, __offset__=self.offset,
+                            __head__=numpy.frombuffer(self._head, dtype=numpy.uint8), **self.columns)
+            os.rename(tmp, filename)
+        except (IOError, OSError) as e:
+            logging.warning("Could not write the cache %s of %s: %s" % (filename, self.filename, e))
+
+class DAQIndex(TextIndex):
+    """Index of an hourly DAQ file with lines of time, bunch ID, wavelength and GMD,
+    with a hash table from the bunch IDs to the rows (the first row of every bunch ID)."""
+    def _reset(self):
+        TextIndex._reset(self)
+        self._rows = {}
+
+    def parse(self, lines):
+        lines = [l.split() for l in lines]
+        lines = [l for l in lines if len(l) >= 3]
+        def number(s):
+            try:
+                return float(s)
+            except ValueError:
+                return numpy.nan
+        return {'time': numpy.array([int(l[0]) for l in lines], dtype=numpy.int64),
+                'bunch_id': numpy.array([int(l[1]) for l in lines], dtype=numpy.int64),
+                'wavelength': numpy.array([float(l[2]) for l in lines]),
+                'gmd': numpy.array([number(l[3]) if len(l) > 3 else numpy.nan for l in lines])}
+
+    def _added(self, first):
+        if 'bunch_id' not in self.columns:
+            return
+        for i, bunch_id in enumerate(self.columns['bunch_id'][first:].tolist()):
+            self._rows.setdefault(bunch_id, first + i)
+
+    def find(self, bunch_id):
+        """Returns the row of a bunch ID, None if it is not (yet) in the file"""
+        row = self._rows.get(int(bunch_id))
+        if row is None and self.update():
+            row = self._rows.get(int(bunch_id))
+        return row
+
+class MotorIndex(TextIndex):
+    """Index of a log of motor positions with lines of a time followed by pairs of motor names and positions,
+    with a column for every motor (NaN where a line does not have the motor)."""
+    def parse(self, lines):
+        lines = [l.split() for l in lines]
+        times = numpy.array([float(l[0]) for l in lines])
+        names = set()
+        for l in lines:
+            names.update(l[1::2])
+        columns = dict((name, numpy.full(len(lines), numpy.nan)) for name in names)
+        for i, l in enumerate(lines):
+            for name, position in zip(l[1::2], l[2::2]):
+                columns[name][i] = float(position)
+        columns['time'] = times
+        return columns
+
+    def find(self, timestamp):
+        """Returns the last row at or before timestamp (the first row for earlier timestamps), None if the log is empty"""
+        if self.rows == 0:
+            return None
+        return max(int(numpy.searchsorted(self.columns['time'], timestamp, side='right')) - 1, 0)
+
+    def positions(self, row):
+        """Returns a dictionary with the positions of the motors in a row"""
+        return dict((name, float(values[row])) for name, values in self.columns.items()
+                    if name != 'time' and not numpy.isnan(values[row]))
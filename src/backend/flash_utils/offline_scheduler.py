@@ -0,0 +1,91 @@
+"""Distribution of the frames of many files over the event readers for offline processing.
+
+The list of all (file, frame) pairs is built once, as chunks of contiguous
+frames of a file. The chunks are handed out on demand: the index of the next
+free chunk is a counter in an MPI window on rank 0, which every process
+increments atomically (``Fetch_and_op``) when it needs more work. Processes
+that get through their frames faster simply take more chunks, no process
+waits for the others at the end of a file."""
+from __future__ import print_function, absolute_import # Compatibility with python 2 and 3
+import numpy
+
+class OfflineScheduler(object):
+    """Hands out the frames of a list of files in chunks of contiguous frames.
+
+    Args:
+        :files(list):       Names of the files
+        :count_frames:      Function f(filename) returning the number of frames of a file,
+                            only called on rank 0
+
+    Kwargs:
+        :chunk_size(int):   Number of contiguous frames handed out at once (default = 16)
+        :comm:              MPI communicator of the processes sharing the work (default = None, no sharing)
+    """
+    def __init__(self, files, count_frames, chunk_size=16, comm=None):
+        self.comm = comm
+        self.chunk_size = chunk_size
+        self._window = None
+        chunks = None
+        if comm is None or comm.Get_rank() == 0:
+            self.files = list(files)
+            self.frames = [count_frames(f) for f in self.files]
+            chunks = [(i, start, min(start + chunk_size, n)) for i, n in enumerate(self.frames)
+                      for start in range(0, n, chunk_size)]
+        if comm is not None:
+            self.files, self.frames, chunks = comm.bcast((getattr(self, 'files', None), getattr(self, 'frames', None), chunks), root=0)
+            # The counter of the next free chunk, in the memory of rank 0
+            from mpi4py import MPI
+            self._MPI = MPI
+            size = numpy.dtype(numpy.int64).itemsize if comm.Get_rank() == 0 else 0
+            self._window = MPI.Win.Allocate(size, numpy.dtype(numpy.int64).itemsize, comm=comm)
+            if comm.Get_rank() == 0:
+                self._window.Lock(0)
+                numpy.frombuffer(self._window.tomemory(), dtype=numpy.int64)[0] = 0
+                self._window.Unlock(0)
+            comm.Barrier()
+        self.chunks = chunks
+        self._counter = 0
+        self._chunk = None
+        self._next_frame = None
+        self.done = False
+
+    @property
+    def nframes(self):
+        """Total number of frames"""
+        return sum(self.frames)
+
+    def _take(self):
+        """Returns the index of the next free chunk and increments the counter"""
+        if self.comm is None:
+            self._counter += 1
+            return self._counter - 1
+        one = numpy.ones(1, dtype=numpy.int64)
+        result = numpy.zeros(1, dtype=numpy.int64)
+        self._window.Lock(0, self._MPI.LOCK_SHARED)
+        self._window.Fetch_and_op(one, result, 0, 0, self._MPI.SUM)
+        self._window.Unlock(0)
+        return int(result[0])
+
+    def next(self):
+        """Returns the file name and number of the next frame to process, None when all frames have been handed out.
+        Never waits for the other processes, see :func:`close`."""
+        if self.done:
+            return None
+        if self._chunk is None or self._next_frame >= self._chunk[2]:
+            i = self._take()
+            if i >= len(self.chunks):
+                self.done = True
+                return None
+            self._chunk = self.chunks[i]
+            self._next_frame = self._chunk[1]
+        frame = self._next_frame
+        self._next_frame += 1
+        return self.files[self._chunk[0]], frame
+
+    def close(self):
+        """Frees the counter. This is a collective call, it has to be called by all processes
+        at the same point (e.g. at shutdown), not when they run out of frames."""
+        if self.comm is not None and self._window is not None:
+            self._window.Free()
+            self._window = None
+        self.done = True
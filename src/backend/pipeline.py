@@ -0,0 +1,167 @@
+# --------------------------------------------------------------------------------------
+# Copyright 2016, Benedikt J. Daurer, Filipe R.N.C. Maia, Max F. Hantke, Carl Nettelblad
+# Hummingbird is distributed under the terms of the Simplified BSD License.
+# -------------------------------------------------------------------------
+"""Declarative analysis pipelines with stages that only run when they are needed.
+
+A configuration file can declare its analysis as stages of a :class:`Pipeline`
+instead of writing it out in ``onEvent``::
+
+    pipeline = backend.pipeline.Pipeline()
+
+    @pipeline.stage()
+    def hitfinding(evt):
+        analysis.hitfinding.countLitPixels(evt, evt["photonPixelDetectors"]["CCD"])
+
+    @pipeline.stage(after=["hitfinding"], gate="litpixel: isHit")
+    def sizing(evt):
+        analysis.sizing.fitSphere(evt, "photonPixelDetectors", "CCD")
+
+    @pipeline.stage(after=["sizing"])
+    def plots(evt):
+        plotting.line.plotHistory(evt["analysis"]["diameter"])
+
+    onEvent = pipeline
+
+A stage runs after the stages it depends on. If the gate of a stage is false,
+the stage and every stage that depends on it are skipped for that event.
+Stages declared with ``lazy=True`` do not run by themselves, their outputs are
+added to ``evt["analysis"]`` as lazy records that run the stage the first time
+their data is accessed."""
+from __future__ import print_function, absolute_import # Compatibility with python 2 and 3
+import time
+import logging
+from .record import Record
+
+_DONE = 'done'
+_SKIPPED = 'skipped'
+_LAZY = 'lazy'
+
+class Stage(object):
+    """A stage of a :class:`Pipeline` with its statistics"""
+    def __init__(self, name, func, after=(), gate=None, lazy=False, outputs=()):
+        self.name = name
+        self.func = func
+        self.after = list(after)
+        self.gate = gate
+        self.lazy = lazy
+        self.outputs = list(outputs)
+        self.runs = 0
+        self.gated = 0
+        self.skipped = 0
+        self.time = 0.
+
+    def is_open(self, evt):
+        """Evaluates the gate of the stage for the event"""
+        if self.gate is None:
+            return True
+        if callable(self.gate):
+            return bool(self.gate(evt))
+        record = evt["analysis"].get(self.gate)
+        return record is not None and bool(record.data)
+
+class Pipeline(object):
+    """Analysis stages with dependencies and gates, called for every event instead of ``onEvent``.
+
+    Args:
+        :report_interval(float): Print the statistics of the stages every report_interval seconds (default = None, never)
+    """
+    def __init__(self, report_interval=None):
+        self.stages = []
+        self._stages = {}
+        self.report_interval = report_interval
+        self._last_report = time.time()
+        self.events = 0
+
+    def stage(self, name=None, after=(), gate=None, lazy=False, outputs=()):
+        """Decorator adding a function f(evt) as a stage of the pipeline.
+
+        Kwargs:
+            :name(str):      Name of the stage (default = name of the function)
+            :after(list):    Names of the stages that have to run before this one
+            :gate:           Function f(evt) or key in evt["analysis"], the stage (and all stages that depend on it)
+                             are skipped if it is False
+            :lazy(bool):     Only run the stage when one of its outputs is accessed
+            :outputs(list):  Keys that the stage adds to evt["analysis"], needed for lazy stages
+        """
+        def decorator(func):
+            self.add_stage(func, name=name, after=after, gate=gate, lazy=lazy, outputs=outputs)
+            return func
+        return decorator
+
+    def add_stage(self, func, name=None, after=(), gate=None, lazy=False, outputs=()):
+        """Adds a function f(evt) as a stage of the pipeline, see :func:`stage`."""
+        if name is None:
+            name = func.__name__
+        if name in self._stages:
+            raise ValueError("A stage with the name %s already exists" % name)
+        for n in after:
+            if n not in self._stages:
+                raise ValueError("Stage %s depends on the unknown stage %s" % (name, n))
+        if lazy and not outputs:
+            raise ValueError("The lazy stage %s needs to declare its outputs" % name)
+        s = Stage(name, func, after, gate, lazy, outputs)
+        self.stages.append(s)
+        self._stages[name] = s
+        return s
+
+    def __call__(self, evt):
+        status = {}
+        for s in self.stages:
+            if not s.lazy:
+                self._run(s, evt, status)
+        self.events += 1
+        if self.report_interval is not None and time.time() - self._last_report > self.report_interval:
+            self._last_report = time.time()
+            print(self.report())
+
+    def _run(self, s, evt, status):
+        """Runs the stage s, after the stages it depends on, unless it is gated. Returns the status of the stage."""
+        if s.name in status:
+            return status[s.name]
+        for n in s.after:
+            if self._run(self._stages[n], evt, status) == _SKIPPED:
+                s.skipped += 1
+                status[s.name] = _SKIPPED
+                return _SKIPPED
+        if not s.is_open(evt):
+            s.gated += 1
+            status[s.name] = _SKIPPED
+            return _SKIPPED
+        if s.lazy and status.get((s.name, 'forced')) is None:
+            # The stage runs when one of its outputs is accessed
+            status[s.name] = _LAZY
+            for key in s.outputs:
+                evt["analysis"][key] = self._force(s, evt, status, key)
+            return _LAZY
+        t0 = time.time()
+        s.func(evt)
+        s.time += time.time() - t0
+        s.runs += 1
+        status[s.name] = _DONE
+        return _DONE
+
+    def _force(self, s, evt, status, key):
+        """Returns the placeholder record of the output key of the lazy stage s, which runs the stage when accessed"""
+        def evaluate():
+            if status.get(s.name) != _DONE:
+                status.pop(s.name, None)
+                status[(s.name, 'forced')] = True
+                if self._run(s, evt, status) == _SKIPPED:
+                    return None
+            record = evt["analysis"].get(key)
+            if record is None or record is placeholder:
+                logging.warning("Lazy stage %s did not add %s to the analysis records." % (s.name, key))
+                return None
+            return record.data
+        placeholder = Record("analysis / " + key, evaluate)
+        return placeholder
+
+    def report(self):
+        """Returns a table with the number of runs, skips and the time spent in every stage"""
+        lines = ["Pipeline after %d events:" % self.events]
+        for s in self.stages:
+            mean = 1000.*s.time/s.runs if s.runs else 0.
+            lines.append("  %-20s %8d runs %8d gated %8d skipped %10.3f ms/run %10.2f s total" %
+                         (s.name, s.runs, s.gated, s.skipped, mean, s.time))
+        return "\n".join(lines)
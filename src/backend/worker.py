@@ -10,6 +10,7 @@ import imp
 import ipc
 import time
 import signal
+from .pipeline import Pipeline
 
 
 class Worker(object):
@@ -56,6 +57,13 @@ class Worker(object):
             rmin = 0
             
         ipc.mpi.init_event_reader_comm(rmin)
+
+        if 'mpi_send_window' in Worker.conf.state:
+            ipc.mpi.send_window = Worker.conf.state['mpi_send_window']
+        if 'scalar_batch_size' in Worker.conf.state:
+            ipc.broadcast.scalar_batch_size = Worker.conf.state['scalar_batch_size']
+        if 'scalar_batch_interval' in Worker.conf.state:
+            ipc.broadcast.scalar_batch_interval = Worker.conf.state['scalar_batch_interval']
         
         if ipc.mpi.is_event_reader():
             self.translator = init_translator(Worker.state)
@@ -115,9 +123,19 @@ class Worker(object):
         if 'end_of_run' in dir(Worker.conf) and not ipc.mpi.is_master():
             print('End of run (worker %i/%i) ...' % (ipc.mpi.worker_index()+1, ipc.mpi.nr_workers()))
             self.conf.end_of_run()
+        if isinstance(getattr(Worker.conf, 'onEvent', None), Pipeline) and not ipc.mpi.is_master():
+            print(Worker.conf.onEvent.report())
         if not ipc.mpi.is_master():
+            ipc.broadcast.flush(force=True)
             ipc.mpi.slave_done()
         
+    def flush(self):
+        """Sends the batches that are due and progresses the reductions,
+        after every event and whenever the event loop skips an event."""
+        ipc.broadcast.flush()
+        ipc.mpi.flush()
+        ipc.mpi.progress_reductions()
+
     def ctrlcevent(self, whatSignal, stack):
         self.reloadnow = True
         signal.signal(signal.SIGINT, self.oldHandler)
@@ -146,8 +164,10 @@ class Worker(object):
                             raise KeyboardInterrupt
                         except AttributeError as e:
                             logging.warning("Attribute error during event translation. Skipping event. (%s)" % e)
+                            self.flush()
                             continue
                         except IndexError:
+                            self.flush()
                             continue
                         ipc.set_current_event(evt)
                         try:
@@ -160,6 +180,7 @@ class Worker(object):
                         except StopIteration:
                             logging.warning("Stopping iteration.")
                             return
+                        self.flush()
             except KeyboardInterrupt:
                 try:
                     print("Hit Ctrl+c again in the next second to quit...")
@@ -211,6 +211,19 @@ class DataSource(QtCore.QObject):
                     self._plotdata[title].append(data, data_x, conf['msg'])
                 else:
                     self._plotdata[title].append(data, data_x, '')                    
+        elif(cmd == 'new_data_batch'):
+            # A batch of scalars with their event ids, which all share the same conf
+            data_x = payload[4]
+            data_x.dtype = numpy.dtype(data_x.dtype, metadata={'units': 's'})
+            conf = payload[5]
+            self.conf[title].update(conf)
+            if self._plotdata[title].recordhistory:
+                for y, x in zip(data, data_x):
+                    self._recorder.append(title, y, x)
+            if 'sum_over' in conf:
+                self._plotdata[title].sum_over_block(data, data_x, conf.get('msg', ''))
+            else:
+                self._plotdata[title].extend(data, data_x, conf.get('msg', ''))
 
     @property
     def hostname(self):
@@ -8,7 +8,7 @@ from interface.ui import AddBackendDialog, PreferencesDialog
 from interface.ui import PlotWindow, ImageWindow
 from interface.ui import Ui_mainWindow
 from interface.recorder import H5Recorder
-from interface import DataSource
+from interface import DataSource, PlotData
 import logging
 import os
 
@@ -95,6 +95,7 @@ class GUI(QtGui.QMainWindow, Ui_mainWindow):
         if not settings.contains("plotFontSize"):
             settings.setValue("plotFontSize", "13")
         self._recorder = H5Recorder(settings.value("outputPath"), 100)
+        PlotData.history_path = settings.value("outputPath")
 
     def _restore_data_windows(self, settings, data_sources):
         """Restores the geometry and data sources of the data windows."""
@@ -235,6 +236,7 @@ class GUI(QtGui.QMainWindow, Ui_mainWindow):
             for dw in self._data_windows:
                 dw.updateFonts()
             self._recorder.outpath = v
+            PlotData.history_path = v
 
     def _recorder_toggled(self, turn_on):
         """Start/Stop the recorder"""
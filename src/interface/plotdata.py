@@ -3,11 +3,17 @@
 # Hummingbird is distributed under the terms of the Simplified BSD License.
 # -------------------------------------------------------------------------
 """Stores the data associated with a given broadcast"""
-from interface.ringbuffer import RingBuffer, RingBufferStr
+from interface.ringbuffer import RingBuffer, CompactRingBuffer, MappedRingBuffer, RingBufferStr
 import numpy
+import hashlib
+import logging
+import os
+import re
 
 class PlotData(object):
     """Stores the data associated with a given broadcast"""
+    # Directory for the files of broadcasts configured with disk_history=True
+    history_path = '.'
     def __init__(self, parent, title, maxlen=1000, group=None):
         self._title = title
         self._group = group
@@ -24,23 +30,64 @@ class PlotData(object):
             if('history_length' in parent.conf[title]):
                 self._maxlen = parent.conf[title]['history_length']
 
-    def append(self, y, x, l):
-        """Append the new data to the ringbuffers"""
+    def _init_buffers(self, y):
+        """Create the ringbuffers if they do not exist yet"""
+        disk_history = self.disk_history
         if(self._y is None):
-            if(isinstance(y, numpy.ndarray)):
+            if(disk_history):
+                self._y = MappedRingBuffer(self._maxlen, self._history_filename('y'))
+            elif(isinstance(y, numpy.ndarray)):
+                # Images are stored in a compact buffer, which only keeps one copy
+                if(self.data_type == 'image' and y.ndim >= 2):
+                    copies = 1
+                    buffer_class = CompactRingBuffer
+                else:
+                    copies = 2
+                    buffer_class = RingBuffer
                 # Make sure the image ringbuffers don't take more than
-                # 200 MBs. The factor of 2 takes into account the fact
-                # that the buffer is twice as big as its usable size
-                self._maxlen = max(1, min(self._maxlen, 1024*1024*200//(2*y.nbytes)))
-            self._y = RingBuffer(self._maxlen)
+                # 200 MBs. The factor of copies takes into account the fact
+                # that a RingBuffer is twice as big as its usable size
+                self._maxlen = max(1, min(self._maxlen, 1024*1024*200//(copies*y.nbytes)))
+                self._y = buffer_class(self._maxlen)
+            else:
+                self._y = RingBuffer(self._maxlen)
         if(self._x is None):
-            self._x = RingBuffer(self._maxlen)
+            if(disk_history):
+                self._x = MappedRingBuffer(self._maxlen, self._history_filename('x'))
+            else:
+                self._x = RingBuffer(self._maxlen)
         if(self._l is None):
             self._l = RingBufferStr(self._maxlen)
+
+    def _history_filename(self, name):
+        """Returns the name of the file for the buffer name of a disk history"""
+        key = '%s_%s_%s' % (self._parent.hostname, self._parent.port, self._title)
+        m = hashlib.md5()
+        m.update(key.encode('UTF-8'))
+        path = os.path.join(self.history_path, 'history')
+        if(not os.path.isdir(path)):
+            os.makedirs(path)
+        return os.path.join(path, '%s_%s.%s' % (re.sub(r'[^\w\-]+', '_', key), m.hexdigest()[:8], name))
+
+    def append(self, y, x, l):
+        """Append the new data to the ringbuffers"""
+        self._init_buffers(y)
         self._y.append(y)
         self._x.append(x)
         self._l.append(l)
 
+    def extend(self, ys, xs, labels):
+        """Append a block of new data to the ringbuffers.
+        labels is either a list with one label per value or a single label for all of them."""
+        if(len(ys) == 0):
+            return
+        self._init_buffers(ys[0, ...] if isinstance(ys, numpy.ndarray) else ys[0])
+        self._y.extend(ys)
+        self._x.extend(xs)
+        if(not isinstance(labels, (list, tuple))):
+            labels = [labels]*len(ys)
+        self._l.extend(labels)
+
     def sum_over(self, y, x, l):
         if self._y is None:
             self._y = RingBuffer(1)
@@ -55,6 +102,11 @@ class PlotData(object):
             self._num += 1.
             self._y._data[0] = self._y._data[0] * (self._num-1)/self._num + y/self._num
 
+    def sum_over_block(self, ys, xs, l):
+        """Add a block of new data to the running mean (see sum_over)"""
+        for i in range(len(ys)):
+            self.sum_over(ys[i, ...], xs[i, ...], l)
+
     def resize(self, new_maxlen):
         """Change the capacity of the buffers"""
         if(self._y is not None):
@@ -76,6 +128,20 @@ class PlotData(object):
             self._l.clear()
         self.clear_histogram = True
 
+    @property
+    def disk_history(self):
+        """Returns True if the broadcast is configured to keep its history on disk"""
+        conf = getattr(self._parent, 'conf', {})
+        return bool(self._title in conf and conf[self._title].get('disk_history', False))
+
+    @property
+    def data_type(self):
+        """Returns the data type of the broadcast, as configured in the backend"""
+        conf = getattr(self._parent, 'conf', {})
+        if(self._title in conf):
+            return conf[self._title].get('data_type')
+        return None
+
     @property
     def title(self):
         """Returns the plot data title"""
@@ -124,7 +190,8 @@ class PlotData(object):
         """Return a serialized representation of the PlotData for saving to disk"""
         pds = {}
         pds['data_source'] = [self._parent.hostname, self._parent.port, self._parent.ssh_tunnel]
-        if(save_data):
+        # Histories on disk only save the name of their files, so they are always kept
+        if((save_data or isinstance(self.y, MappedRingBuffer)) and self.y is not None):
             pds['x'] = self.x.save_state()
             pds['y'] = self.y.save_state()
             pds['l'] = self.l.save_state()
@@ -138,11 +205,25 @@ class PlotData(object):
         """Restore a previous stored state"""
         self.parent = parent
         if 'x' in state:
-            self._x = RingBuffer.restore_state(state['x'])
-            self._y = RingBuffer.restore_state(state['y'])
-            self._l = RingBufferStr.restore_state(state['l'])
-            self.restored = True
+            try:
+                self._x = self._restore_ringbuffer(state['x'])
+                self._y = self._restore_ringbuffer(state['y'])
+                self._l = RingBufferStr.restore_state(state['l'])
+                self.restored = True
+            except (IOError, OSError, ValueError):
+                logging.warning("Could not restore the history of %s", state['title'])
+                self._x = None
+                self._y = None
+                self._l = None
         self._title = state['title']
         self._maxlen = state['maxlen']
         self.recordhistory = state['recordhistory']
 
+    @staticmethod
+    def _restore_ringbuffer(state):
+        """Restore a ringbuffer of the right kind from a saved state"""
+        if(state.get('mapped', False)):
+            return MappedRingBuffer.restore_state(state)
+        elif(state.get('compact', False)):
+            return CompactRingBuffer.restore_state(state)
+        return RingBuffer.restore_state(state)
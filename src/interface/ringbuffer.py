@@ -6,10 +6,14 @@
 It's always possible to retrieve the buffer data as a numpy array in O(1)
 This is achieve by always inserting two copies of any appended data, so
 it's a bit slower to add data, and it takes twice as much memory as a
-regular buffer.
+regular buffer. The CompactRingBuffer avoids the second copy for large
+data, at the cost of reading the buffer. The MappedRingBuffer keeps its
+data in a memory-mapped file, for histories which don't fit in memory.
 """
 
 import numpy
+import json
+import os
 
 class RingBuffer(object):
     """Provides a ring buffer for scalar and numpy data.
@@ -43,6 +47,36 @@ class RingBuffer(object):
             self._len += 1
         self._counter += 1
 
+    def extend(self, x):
+        """Append all values along the first axis of x to the end of the buffer.
+        Gives the same result as appending them one by one, but copies
+        whole blocks at once."""
+        x = numpy.asarray(x)
+        n = x.shape[0]
+        if(n == 0):
+            return
+        if(self._data is None or self._data.shape[1:] != x.shape[1:]):
+            # Index with an ellipsis to keep the dtype metadata
+            self._init_data(x[0, ...])
+            self._index = 0
+            self._len = 0
+        self._counter += n
+        # Only the last maxlen values end up in the buffer
+        if(n > self._maxlen):
+            self._index = (self._index + n - self._maxlen) % self._maxlen
+            x = x[n-self._maxlen:]
+            n = self._maxlen
+        # Copy up to the end of the buffer and wrap the rest to the beginning
+        start = self._index
+        first = min(n, self._maxlen - start)
+        self._data[start:start+first] = x[:first]
+        self._data[start+self._maxlen:start+self._maxlen+first] = x[:first]
+        if(first < n):
+            self._data[:n-first] = x[first:]
+            self._data[self._maxlen:self._maxlen+n-first] = x[first:]
+        self._index = (start + n) % self._maxlen
+        self._len = min(self._len + n, self._maxlen)
+
     def resize(self, new_maxlen):
         """Change the capacity of the buffers"""
         tmp_data = self._data
@@ -160,6 +194,224 @@ class RingBuffer(object):
     def number_of_added_elements(self):
         return self._counter
 
+
+
+class CompactRingBuffer(RingBuffer):
+    """Provides a ring buffer for numpy data which stores every element only once.
+    Reading the buffer as a numpy array is O(1) unless the data wraps around the
+    end of the storage, in which case the storage is first rotated in place.
+    The rotation only happens when reading after new data has been written, so
+    it's well suited for large data, like images, that are read less often
+    than they are written.
+    """
+    def append(self, x):
+        """Append a value to the end of the buffer"""
+        if(self._data is None):
+            self._init_data(x)
+        try:
+            self._data[self._index] = x
+        except ValueError:
+            self._init_data(x)
+            self._index = 0
+            self._len = 0
+            self._data[self._index] = x
+        self._index = (self._index + 1) % self._maxlen
+        if(self._len < self._maxlen):
+            self._len += 1
+        self._counter += 1
+
+    def extend(self, x):
+        """Append all values along the first axis of x to the end of the buffer"""
+        x = numpy.asarray(x)
+        n = x.shape[0]
+        if(n == 0):
+            return
+        if(self._data is None or self._data.shape[1:] != x.shape[1:]):
+            self._init_data(x[0, ...])
+            self._index = 0
+            self._len = 0
+        self._counter += n
+        if(n > self._maxlen):
+            self._index = (self._index + n - self._maxlen) % self._maxlen
+            x = x[n-self._maxlen:]
+            n = self._maxlen
+        start = self._index
+        first = min(n, self._maxlen - start)
+        self._data[start:start+first] = x[:first]
+        if(first < n):
+            self._data[:n-first] = x[first:]
+        self._index = (start + n) % self._maxlen
+        self._len = min(self._len + n, self._maxlen)
+
+    def resize(self, new_maxlen):
+        """Change the capacity of the buffers"""
+        tmp_data = self.__array__()
+        self._maxlen = new_maxlen
+        self._init_data(tmp_data[0, ...])
+        self._len = min(self._len, new_maxlen)
+        self._data[:self._len] = tmp_data[tmp_data.shape[0]-self._len:]
+        self._index = self._len % self._maxlen
+        # Preserve dtype, otherwise dtype.metadata is lost
+        self._data.dtype = tmp_data.dtype
+
+    def _init_data(self, x):
+        """Initialize the buffer with the given data"""
+        try:
+            self._data = numpy.empty(tuple([self._maxlen]+list(x.shape)),
+                                     x.dtype)
+        except AttributeError:
+            self._data = numpy.empty([self._maxlen], type(x))
+
+    @property
+    def _start(self):
+        """Position of the oldest element in the storage"""
+        return (self._index - self._len) % self._maxlen
+
+    def _rotate(self, shift):
+        """Rotate the storage in place, such that position shift moves to 0.
+        Blocks are moved such that source and destination never overlap and
+        only the smaller part of the storage is copied to a temporary array."""
+        n = self._maxlen
+        d = self._data
+        if(shift <= n - shift):
+            tmp = d[:shift].copy()
+            for i in range(0, n - shift, shift):
+                c = min(shift, n - shift - i)
+                d[i:i+c] = d[i+shift:i+shift+c]
+            d[n-shift:] = tmp
+        else:
+            k = n - shift
+            tmp = d[shift:].copy()
+            for i in range(shift, 0, -k):
+                c = min(k, i)
+                d[i-c+k:i+k] = d[i-c:i]
+            d[:k] = tmp
+
+    def __array__(self):
+        """Return a numpy array with the buffer data"""
+        start = self._start
+        if(start + self._len > self._maxlen):
+            self._rotate(start)
+            start = 0
+            self._index = self._len % self._maxlen
+        return self._data[start:start+self._len]
+
+    def __getitem__(self, args):
+        """Returns items from the buffer, just like a numpy array"""
+        if(isinstance(args, tuple)):
+            first = args[0]
+            rest = tuple(args[1:])
+        else:
+            first = args
+            rest = ()
+        if(isinstance(first, slice)):
+            return self.__array__()[(first,)+rest]
+        if first < 0:
+            first = self._len + first
+        return self._data[((self._start + first) % self._maxlen,)+rest]
+
+    def save_state(self):
+        """Return a serialized representation of the RingBuffer for saving to disk"""
+        rs = RingBuffer.save_state(self)
+        rs['compact'] = True
+        return rs
+
+    @staticmethod
+    def restore_state(state):
+        data = numpy.array(state['data'])
+        index = state['index']
+        length = state['len']
+        maxlen = state['maxlen']
+        rb = CompactRingBuffer(maxlen, data = data, index = index, length = length)
+        return rb
+
+
+
+class MappedRingBuffer(RingBuffer):
+    """Provides a ring buffer whose data is stored in a memory-mapped file.
+    The file has the same doubled layout as a RingBuffer, so reading the
+    buffer as a numpy array is still O(1) and only the parts of the buffer
+    that are actually accessed are read from disk. The position of the ring
+    is kept in a small index file next to the data, which is updated by flush.
+    """
+    def __init__(self, maxlen, filename, data = None, index = 0, length = 0):
+        RingBuffer.__init__(self, maxlen, data = data, index = index, length = length)
+        self._filename = filename
+
+    def _init_data(self, x):
+        """Initialize the buffer file with the given data"""
+        self._data = self._create_file(self._filename, x)
+        self.flush()
+
+    def _create_file(self, filename, x):
+        """Create a buffer file for data like x"""
+        try:
+            shape, dtype = tuple([2*self._maxlen]+list(x.shape)), x.dtype
+        except AttributeError:
+            shape, dtype = (2*self._maxlen,), numpy.dtype(type(x))
+        data = numpy.memmap(filename, dtype=dtype, mode='w+', shape=shape)
+        # Preserve dtype, otherwise dtype.metadata is lost
+        data.dtype = dtype
+        return data
+
+    def resize(self, new_maxlen):
+        """Change the capacity of the buffer, using a new file"""
+        tmp_data = self._data
+        prev_maxlen = self._maxlen
+        self._maxlen = new_maxlen
+        data = self._create_file(self._filename + '.tmp', tmp_data[0, ...])
+        self._len = min(self._len, new_maxlen)
+        data[0:self._len] = tmp_data[prev_maxlen+self._index-self._len:prev_maxlen+self._index]
+        data[self._maxlen:self._maxlen+self._len] = data[0:self._len]
+        self._index = self._len % self._maxlen
+        os.rename(self._filename + '.tmp', self._filename)
+        self._data = data
+        self.flush()
+
+    @property
+    def filename(self):
+        """Returns the name of the file holding the data"""
+        return self._filename
+
+    def flush(self):
+        """Write the data and the index of the ring to disk"""
+        if(self._data is None):
+            return
+        self._data.flush()
+        index = {'index': self._index, 'len': self._len, 'maxlen': self._maxlen,
+                 'counter': self._counter, 'dtype': self._data.dtype.str,
+                 'shape': list(self._data.shape[1:]),
+                 'metadata': dict(self._data.dtype.metadata or {})}
+        with open(self._filename + '.index', 'w') as f:
+            json.dump(index, f)
+
+    def save_state(self):
+        """Return the name of the buffer file, instead of the data, for saving to disk"""
+        self.flush()
+        rs = {}
+        rs['filename'] = self._filename
+        rs['mapped'] = True
+        return rs
+
+    @staticmethod
+    def open(filename):
+        """Open an existing buffer file"""
+        with open(filename + '.index', 'r') as f:
+            index = json.load(f)
+        maxlen = index['maxlen']
+        dtype = numpy.dtype(str(index['dtype']))
+        if(index['metadata']):
+            dtype = numpy.dtype(dtype, metadata=index['metadata'])
+        data = numpy.memmap(filename, dtype=dtype, mode='r+', shape=tuple([2*maxlen]+index['shape']))
+        data.dtype = dtype
+        rb = MappedRingBuffer(maxlen, filename, data = data, index = index['index'], length = index['len'])
+        rb._counter = index['counter']
+        return rb
+
+    @staticmethod
+    def restore_state(state):
+        return MappedRingBuffer.open(state['filename'])
+
         
 class RingBufferStr(object):
     """Provides a ring buffer for strings."""
@@ -180,6 +432,25 @@ class RingBufferStr(object):
             self._len += 1
         self._counter = 0
 
+    def extend(self, x):
+        """Append all strings in the list x to the end of the buffer"""
+        x = list(x)
+        n = len(x)
+        if(n == 0):
+            return
+        if(self._data is None):
+            self._init_data()
+        if(n > self._maxlen):
+            self._index = (self._index + n - self._maxlen) % self._maxlen
+            x = x[n-self._maxlen:]
+            n = self._maxlen
+        start = self._index
+        first = min(n, self._maxlen - start)
+        self._data[start:start+first] = x[:first]
+        self._data[:n-first] = x[first:]
+        self._index = (start + n) % self._maxlen
+        self._len = min(self._len + n, self._maxlen)
+
     def resize(self, new_maxlen):
         """Change the capacity of the buffers"""
         tmp_data = self._data
@@ -32,6 +32,7 @@ class ImageWindow(DataWindow, Ui_imageWindow):
         self.last_x = None
         self.last_y = None
         self.mm_last = None
+        self.mm_tile = 64
         self.vline = None
         self.hline = None
 
@@ -85,6 +86,7 @@ class ImageWindow(DataWindow, Ui_imageWindow):
         self._set_logscale_lookuptable()
 
         self.running_hist_initialised = False
+        self.running_hists = {}
         self._has_circular_roi = False
         self._circular_rois = []
         
@@ -264,11 +266,29 @@ class ImageWindow(DataWindow, Ui_imageWindow):
         self.mm_ymax = ymax
         self.mm_xbins = xbins
         self.mm_ybins = ybins
-        self.mm_dx = numpy.float(self.mm_xmax - self.mm_xmin)/self.mm_xbins
-        self.mm_dy = numpy.float(self.mm_ymax - self.mm_ymin)/self.mm_ybins
-        self.meanmap = numpy.zeros((3, self.mm_ybins, self.mm_xbins), dtype=numpy.float64)
+        self.mm_dx = float(self.mm_xmax - self.mm_xmin)/self.mm_xbins
+        self.mm_dy = float(self.mm_ymax - self.mm_ymin)/self.mm_ybins
+        self._allocate_meanmap()
         self._update_meanmap_transform()
 
+    def _allocate_meanmap(self, old=None, iy_min=0, ix_min=0):
+        """Allocates the storage of the meanmap with a margin of whole tiles on every side
+        and makes self.meanmap a view of the current extent. The previous map is copied in
+        at offset (-iy_min, -ix_min) of the new extent."""
+        tile = self.mm_tile
+        margin_y = tile*int(numpy.ceil(max(self.mm_ybins/2., tile)/tile))
+        margin_x = tile*int(numpy.ceil(max(self.mm_xbins/2., tile)/tile))
+        self._mm_storage = numpy.zeros((3, self.mm_ybins + 2*margin_y, self.mm_xbins + 2*margin_x),
+                                       dtype=numpy.float64)
+        self._mm_offset = (margin_y, margin_x)
+        self._view_meanmap()
+        if old is not None:
+            self.meanmap[:, -iy_min:-iy_min+old.shape[1], -ix_min:-ix_min+old.shape[2]] = old
+
+    def _view_meanmap(self):
+        oy, ox = self._mm_offset
+        self.meanmap = self._mm_storage[:, oy:oy+self.mm_ybins, ox:ox+self.mm_xbins]
+
     def _update_meanmap_transform(self):
         translate_transform = QtGui.QTransform().translate(self.mm_ymin, self.mm_xmin)
         scale_transform = QtGui.QTransform().scale(self.mm_dy, self.mm_dx)
@@ -277,17 +297,22 @@ class ImageWindow(DataWindow, Ui_imageWindow):
                                                 1, 0, 0,
                                                 0, 0, 1)
         self.meanmap_transform = scale_transform*translate_transform*transpose_transform
-        
+
+    def _meanmap_indices(self, x, y):
+        """Returns the (unclipped) bin indices of the positions x and y"""
+        ix = numpy.round((x - (self.mm_xmin+self.mm_dx/2.))/self.mm_dx).astype(numpy.intp)
+        iy = numpy.round((y - (self.mm_ymin+self.mm_dy/2.))/self.mm_dy).astype(numpy.intp)
+        return ix, iy
+
     def _extend_meanmap(self, x, y):
-        ix = numpy.round((x - self.mm_xmin)/self.mm_dx)
-        iy = numpy.round((y - self.mm_ymin)/self.mm_dx)
-        ix_max = max([self.meanmap.shape[2]-1, ix.max()])
+        ix, iy = self._meanmap_indices(x, y)
+        ix_max = max([self.mm_xbins-1, ix.max()])
         ix_min = min([0, ix.min()])
-        iy_max = max([self.meanmap.shape[1]-1, iy.max()])
+        iy_max = max([self.mm_ybins-1, iy.max()])
         iy_min = min([0, iy.min()])
         xbins = ix_max - ix_min + 1
         ybins = iy_max - iy_min + 1
-        if xbins > self.meanmap.shape[2] or ybins > self.meanmap.shape[1]:
+        if xbins > self.mm_xbins or ybins > self.mm_ybins:
             # A little nasty fix - just for now
             if xbins > 5000 or ybins > 5000:
                 logging.warning("Too large extent of meanmap (%i, %i) - restting meanmap with new extent centered around corrent position: x=%f, y=%f" % (xbins, ybins, x[-1], y[-1]))
@@ -300,33 +325,32 @@ class ImageWindow(DataWindow, Ui_imageWindow):
                 self._init_meanmap(xmin, xmax, ymin, ymax, xbins, ybins)
                 self._extend_meanmap(x,y)
                 return
-            temp = numpy.zeros(shape=(3, ybins, xbins), dtype=self.meanmap.dtype)
-            temp[:,
-                 -iy_min:-iy_min+self.meanmap.shape[1],
-                 -ix_min:-ix_min+self.meanmap.shape[2]] = self.meanmap[:,:,:]
-            self.meanmap = temp
             self.mm_xmin = self.mm_xmin + ix_min * self.mm_dx
-            self.mm_xmax = self.mm_xmin + (xbins-1) * self.mm_dx
-            self.mm_ymin = self.mm_ymin + iy_min * self.mm_dx
-            self.mm_ymax = self.mm_ymin + (ybins-1) * self.mm_dx
+            self.mm_xmax = self.mm_xmin + xbins * self.mm_dx
+            self.mm_ymin = self.mm_ymin + iy_min * self.mm_dy
+            self.mm_ymax = self.mm_ymin + ybins * self.mm_dy
             self.mm_xbins = xbins
             self.mm_ybins = ybins
+            oy, ox = self._mm_offset[0] + iy_min, self._mm_offset[1] + ix_min
+            if (oy >= 0 and oy + ybins <= self._mm_storage.shape[1] and
+                ox >= 0 and ox + xbins <= self._mm_storage.shape[2]):
+                # The new extent still fits into the allocated tiles
+                self._mm_offset = (oy, ox)
+                self._view_meanmap()
+            else:
+                self._allocate_meanmap(self.meanmap, iy_min, ix_min)
             self._update_meanmap_transform()
         
-    def _fill_meanmap(self, times, triples, xmin=0, xmax=100, ymin=0, ymax=100, xbins=100, ybins=100, dynamic_extent=False, initial_reset=False):
-
-        triples_new = triples
-        if self.meanmap is not None:
-            w = numpy.where(self.mm_last==times)
-            if len(w) > 0:
-                if w[0] > 0:
-                    triples_new = triples[:w[0],:]
-        x = triples_new[:,0]
-        y = triples_new[:,1]
-        z = triples_new[:,2]
-
-        self.last_x = x[-1]
-        self.last_y = y[-1] 
+    def _fill_meanmap(self, triples, number_of_added_elements, xmin=0, xmax=100, ymin=0, ymax=100, xbins=100, ybins=100, dynamic_extent=False, initial_reset=False):
+
+        # Only the triples that were added since the last call are accumulated
+        number_of_new_triples = len(triples)
+        if self.mm_last is not None:
+            number_of_new_triples = min(number_of_added_elements - self.mm_last, len(triples))
+        triples_new = triples[len(triples)-number_of_new_triples:]
+
+        self.last_x = triples[-1,0]
+        self.last_y = triples[-1,1]
         
         if self.meanmap is None:
             self._init_meanmap(xmin, xmax, ymin, ymax, xbins, ybins)
@@ -334,29 +358,27 @@ class ImageWindow(DataWindow, Ui_imageWindow):
         if self.mm_last is None and initial_reset:
             self._reset_meanmap_cache()
             
-        self.mm_last = times[0]
-            
-        if dynamic_extent:
-            self._extend_meanmap(triples_new[:,0], triples_new[:,1])                    
-
-        for x,y,z in triples_new:
-            
-            ix = numpy.round((x - (self.mm_xmin+self.mm_dx/2.))/self.mm_dx)
-            iy = numpy.round((y - (self.mm_ymin+self.mm_dy/2.))/self.mm_dy)
-            
-            if (ix < 0):                    
-                ix = 0
-            elif (ix >= self.mm_xbins):
-                ix = self.mm_xbins - 1
-            if (iy < 0):
-                iy = 0
-            elif (iy >= self.mm_ybins):
-                iy = self.mm_ybins - 1
-
-            self.meanmap[0,iy,ix] += z
-            self.meanmap[1,iy,ix] += 1
+        self.mm_last = number_of_added_elements
+
+        if len(triples_new):
+            x = triples_new[:,0]
+            y = triples_new[:,1]
+            z = triples_new[:,2]
+
+            if dynamic_extent:
+                self._extend_meanmap(x, y)
+
+            ix, iy = self._meanmap_indices(x, y)
+            ix = numpy.clip(ix, 0, self.mm_xbins - 1)
+            iy = numpy.clip(iy, 0, self.mm_ybins - 1)
+            # Accumulate on the flattened map and update the mean of the visited bins only
+            flat, inverse = numpy.unique(iy*self.mm_xbins + ix, return_inverse=True)
+            iy, ix = numpy.unravel_index(flat, (self.mm_ybins, self.mm_xbins))
+            self.meanmap[0,iy,ix] += numpy.bincount(inverse, weights=z, minlength=len(flat))
+            self.meanmap[1,iy,ix] += numpy.bincount(inverse, minlength=len(flat))
             self.meanmap[2,iy,ix] = self.meanmap[0,iy,ix]/self.meanmap[1,iy,ix]
 
+        x, y = self.last_x, self.last_y
         if (self.settingsWidget.ui.show_heatmap.isChecked()):
             return self.meanmap[0], self.meanmap_transform, x, y
         elif (self.settingsWidget.ui.show_visitedmap.isChecked()):
@@ -443,11 +465,18 @@ class ImageWindow(DataWindow, Ui_imageWindow):
                     self.init_running_hist(source, title)
                 window = int(self.settingsWidget.ui.runningHistWindow.text())
                 bins   = int(self.settingsWidget.ui.runningHistBins.text())
-                hmin   = int(self.settingsWidget.ui.runningHistMin.text())
-                hmax   = int(self.settingsWidget.ui.runningHistMax.text())
-                v      = pd.y[-1]
+                hmin   = float(self.settingsWidget.ui.runningHistMin.text())
+                hmax   = float(self.settingsWidget.ui.runningHistMax.text())
                 length = pd.maxlen
-                img = utils.array.runningHistogram(v, title, length, window, bins, hmin, hmax)
+                if title not in self.running_hists:
+                    self.running_hists[title] = [utils.array.RunningHistogram(length, window, bins, hmin, hmax), 0]
+                running_hist, last = self.running_hists[title]
+                # Only the values added since the last replot go into the running histogram
+                added  = pd.y.number_of_added_elements
+                n      = min(added - last, len(pd.y))
+                v      = numpy.asarray(pd.y)[len(pd.y)-max(n, 0):]
+                self.running_hists[title][1] = added
+                img = running_hist.next(v, length, window, bins, hmin, hmax)
                 if not img.shape[0]:
                     continue
             elif conf["data_type"] == "vector":
@@ -483,9 +512,8 @@ class ImageWindow(DataWindow, Ui_imageWindow):
                     auto_rage = True
                     auto_histogram = True
                 if "data_type" in conf and conf["data_type"] == "triple":
-                    triples = numpy.array(pd.y, copy=False)
-                    times   = numpy.array(pd.x, copy=False)
-                    img, transform, x, y = self._fill_meanmap(times, triples,
+                    triples = numpy.asarray(pd.y)
+                    img, transform, x, y = self._fill_meanmap(triples, pd.y.number_of_added_elements,
                                                               xmin=conf["xmin"], xmax=conf["xmax"], ymin=conf["ymin"], ymax=conf["ymax"],
                                                               ybins=conf["ybins"], xbins=conf["xbins"],
                                                               dynamic_extent=conf.get("dynamic_extent", False),
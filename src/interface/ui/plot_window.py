@@ -15,7 +15,15 @@ import os
 from .pg_time_axis import DateAxisItem
 
 class Histogram(object):
-    def __init__(self, hmin, hmax, bins):
+    """Histogram that is filled incrementally with the values added to a ring buffer.
+
+    If autorange is set, the range is doubled whenever values fall outside of it,
+    merging pairs of neighbouring bins instead of going through the history again."""
+    def __init__(self, hmin, hmax, bins, autorange=False):
+        self._autorange = autorange
+        if autorange:
+            # Merging pairs of bins needs an even number of bins
+            bins += bins % 2
         self._bins = bins
         self._range = (hmin, hmax)
         self._step = (hmax-hmin) / float(bins)
@@ -28,25 +36,76 @@ class Histogram(object):
             return None
         else:
             return index
-        
-    def add_value(self, value):
-        index = self._value_to_index(value)
-        if index is not None:
-            self._histogram[index] += 1
 
-    def add_values_from_ringbuffer(self, ringbuffer):
-        current_index = ringbuffer.number_of_added_elements
-        number_of_values_to_add = current_index-self._last_add_index
-        if number_of_values_to_add > 0:
-            values = numpy.array(ringbuffer, copy=False)[-(current_index-self._last_add_index):]
+    def _values_to_indices(self, values):
+        """Returns the bin indices of values and a mask of the values inside the range"""
+        indices = numpy.floor((values - self._range[0]) / self._step)
+        valid = (indices >= 0) & (indices < self._bins)
+        return indices[valid].astype(numpy.intp), valid
+
+    def _double_range(self, below):
+        """Doubles the range, towards lower values if below is set, merging pairs of bins"""
+        for array in self._binned_arrays():
+            merged = array.reshape(-1, 2).sum(axis=1)
+            array[:] = 0
+            if below:
+                array[self._bins//2:] = merged
+            else:
+                array[:self._bins//2] = merged
+        width = self._range[1] - self._range[0]
+        if below:
+            self._range = (self._range[0] - width, self._range[1])
         else:
+            self._range = (self._range[0], self._range[1] + width)
+        self._step *= 2
+
+    def _binned_arrays(self):
+        return [self._histogram]
+
+    def _grow_to(self, values):
+        values = values[numpy.isfinite(values)]
+        if not values.size or self._step <= 0:
             return
-        for this_value in values:
-            self.add_value(this_value)
+        vmin, vmax = values.min(), values.max()
+        while vmin < self._range[0]:
+            self._double_range(below=True)
+        while vmax >= self._range[1]:
+            self._double_range(below=False)
+
+    def _bincount(self, values, weights=None):
+        """Returns the histogram of values (optionally weighted) over the current bins"""
+        indices, valid = self._values_to_indices(values)
+        if weights is not None:
+            weights = weights[valid]
+        return numpy.bincount(indices, weights=weights, minlength=self._bins)
+
+    def add_value(self, value):
+        self.add_values(numpy.array([value], dtype=numpy.float64))
+
+    def add_values(self, values, weights=None):
+        """Adds an array of values, each counted with its weight (default 1)"""
+        values = numpy.asarray(values, dtype=numpy.float64).ravel()
+        if weights is not None:
+            weights = numpy.asarray(weights, dtype=numpy.float64).ravel()
+        if self._autorange:
+            self._grow_to(values)
+        self._histogram += self._bincount(values, weights)
+
+    def _new_values(self, ringbuffer):
+        """Returns the values added to the ring buffer since the last call, or None"""
+        current_index = ringbuffer.number_of_added_elements
+        number_of_values_to_add = min(current_index-self._last_add_index, len(ringbuffer))
         self._last_add_index = current_index
+        if number_of_values_to_add <= 0:
+            return None
+        return numpy.asarray(ringbuffer)[-number_of_values_to_add:]
+
+    def add_values_from_ringbuffer(self, ringbuffer):
+        values = self._new_values(ringbuffer)
+        if values is not None:
+            self.add_values(values)
 
     def reset(self):
-        print("Reset histogram!")
         self._histogram[:] = 0
         self._last_add_index = 0
 
@@ -59,27 +118,30 @@ class Histogram(object):
         return self._histogram
 
 class NormalizedHistogram(Histogram):
-    def __init__(self, hmin, hmax, bins):
-        super(NormalizedHistogram, self).__init__(hmin, hmax, bins)
+    """Histogram of the mean weight of the values in each bin"""
+    def __init__(self, hmin, hmax, bins, autorange=False):
+        super(NormalizedHistogram, self).__init__(hmin, hmax, bins, autorange)
         self._weight = numpy.zeros(self._histogram.shape)
 
+    def _binned_arrays(self):
+        return [self._histogram, self._weight]
+
     def add_value(self, value, weight):
-        index = self._value_to_index(value)
-        if index is not None:
-            self._histogram[index] += weight
-            self._weight[index] += 1.
+        self.add_values(numpy.array([value], dtype=numpy.float64), numpy.array([weight], dtype=numpy.float64))
+
+    def add_values(self, values, weights):
+        """Adds an array of values with their weights"""
+        values = numpy.asarray(values, dtype=numpy.float64).ravel()
+        weights = numpy.asarray(weights, dtype=numpy.float64).ravel()
+        if self._autorange:
+            self._grow_to(values)
+        self._histogram += self._bincount(values, weights)
+        self._weight += self._bincount(values)
 
     def add_values_from_ringbuffer(self, ringbuffer):
-        current_index = ringbuffer.number_of_added_elements
-        number_of_values_to_add = (current_index-self._last_add_index)
-        if number_of_values_to_add > 0:
-            values = numpy.array(ringbuffer, copy=False)[-number_of_values_to_add:, 0]
-            weights = numpy.array(ringbuffer, copy=False)[-number_of_values_to_add:, 1]
-        else:
-            return
-        for this_value, this_weight in zip(values, weights):
-            self.add_value(this_value, this_weight)
-        self._last_add_index = current_index
+        values = self._new_values(ringbuffer)
+        if values is not None:
+            self.add_values(values[:, 0], values[:, 1])
 
     def reset(self):
         super(NormalizedHistogram, self).reset()
@@ -360,13 +422,14 @@ class PlotWindow(DataWindow, Ui_plotWindow):
                     y = self.last_vector_y[title][self.current_index % self.last_vector_y[title].shape[0]]
             elif source.data_type[title] == 'histogram':
                 if title not in self._histograms:
-                    self._histograms[title] = Histogram(conf["hmin"], conf["hmax"], conf["bins"])
+                    self._histograms[title] = Histogram(conf["hmin"], conf["hmax"], conf["bins"],
+                                                        conf.get("autorange", False))
                 x = self._histograms[title].values_x
                 y = self._histograms[title].values_y
             elif source.data_type[title] == 'normalized_histogram':
                 if title not in self._normalized_histograms:
                     self._normalized_histograms[title] = NormalizedHistogram(conf["hmin"], conf["hmax"],
-                                                                    conf["bins"])
+                                                                    conf["bins"], conf.get("autorange", False))
                 x = self._normalized_histograms[title].values_x
                 y = self._normalized_histograms[title].values_y
                 
@@ -425,10 +488,9 @@ class PlotWindow(DataWindow, Ui_plotWindow):
             elif(source.data_type[title] == "normalized_histogram"):
                 ringbuffer = pd.y
                 # Clear histogram if asked for
-                print("clear_histograms = {0}".format(pd.clear_histograms))
-                if pd.clear_histograms:
-                    self._histograms[title].reset()
-                    pd.clear_histograms = False
+                if pd.clear_histogram:
+                    self._normalized_histograms[title].reset()
+                    pd.clear_histogram = False
                 self._normalized_histograms[title].add_values_from_ringbuffer(ringbuffer)
                 x = self._normalized_histograms[title].values_x
                 y = self._normalized_histograms[title].values_y
@@ -9,8 +9,8 @@ from interface.Qt import QtCore
 from interface.zmqcontext import ZmqContext
 from zmq import FD, IDENTITY, SUBSCRIBE, UNSUBSCRIBE, EVENTS, \
                 POLLIN, RCVHWM
-import numpy
 import hashlib
+import utils.frames
 
 class ZmqSocket(QtCore.QObject):
     """Wrapper around a zmq socket. Provides Qt signal handling"""
@@ -105,8 +105,11 @@ class ZmqSocket(QtCore.QObject):
         """Send a list of messages as a multipart message on the socket"""
         return self._socket.send_multipart(_msg)
 
-    def recv_array(self, flags=0, copy=True, track=False):
-        """Receive a numpy array"""
-        md = self._socket.recv_json(flags=flags)
+    def recv_array(self, flags=0, copy=False, track=False):
+        """Receive a numpy array sent as a binary header followed by the raw buffer.
+        Unless copy is True the returned array shares the memory of the received message."""
+        header = self._socket.recv(flags=flags)
         msg = self._socket.recv(flags=flags, copy=copy, track=track)
-        return  numpy.ndarray(shape=md['shape'], dtype=md['dtype'], buffer=msg, strides=md['strides'])
+        if not copy:
+            msg = msg.buffer
+        return utils.frames.decode_array(header, msg)
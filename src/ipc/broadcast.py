@@ -8,11 +8,19 @@ import numpy
 import ipc
 import logging
 import hashlib
+import time
 
 evt = None
 data_conf = {}
 sent_time = {}
 
+# Scalar values are collected per title and sent as arrays of values and event ids,
+# once scalar_batch_size values are collected or the oldest value is older than
+# scalar_batch_interval seconds. A batch size of 1 sends every value on its own.
+scalar_batch_size = 100
+scalar_batch_interval = 0.1
+_scalar_batches = {}
+
 
 def init_data(title, **kwds):
     """Configures the data broadcast named title. All the keyword=value
@@ -70,24 +78,73 @@ def new_data(title, data_y, mpi_reduce=False, **kwds):
             # do not send the data
             return
 
+    if(ipc.mpi.is_slave() and mpi_reduce):
+        ipc.mpi.send_reduce(title, 'new_data', data_y, event_id, **kwds)
+    elif data_conf[title]["data_type"] == "scalar" and scalar_batch_size > 1:
+        _add_to_batch(title, data_y, event_id, kwds)
+    else:
+        _send(title, [ipc.uuid, 'new_data', title, data_y, event_id, kwds])
+    if data_conf[title]["data_type"] == "scalar":
+        ipc.influx.write(title, data_y, event_id, kwds)
+
+def _send(title, data):
+    """Send data to the interface, through the master if there is one."""
     if(ipc.mpi.is_slave()):
-        if(mpi_reduce):
-            ipc.mpi.send_reduce(title, 'new_data', data_y, event_id, **kwds)
+        m = hashlib.md5()
+        m.update(title.encode('UTF-8'))
+        if m.digest() in ipc.mpi.subscribed:
+            ipc.mpi.send(title, data)
         else:
-            m = hashlib.md5()
-            m.update(title.encode('UTF-8'))
-            if m.digest() in ipc.mpi.subscribed:
-                ipc.mpi.send(title, [ipc.uuid, 'new_data', title, data_y,
-                                     event_id, kwds])
-            else:
-                logging.debug('%s not subscribed, not sending' % (title))
+            logging.debug('%s not subscribed, not sending' % (title))
     else:
-        ipc.zmq().send(title, [ipc.uuid, 'new_data', title, data_y,
-                               event_id, kwds])
+        ipc.zmq().send(title, data)
         logging.debug("Sending data on source '%s'" % title)
-    if data_conf[title]["data_type"] == "scalar":
-        ipc.influx.write(title, data_y, event_id, kwds)
-        
+
+def _kwds_key(kwds):
+    """Hashable key of the keywords of a batch, None if they can not be compared (e.g. arrays)"""
+    try:
+        key = tuple(sorted(kwds.items()))
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+def _add_to_batch(title, data_y, event_id, kwds):
+    """Add a scalar value to the batch of the given title.
+    Values with different keywords do not share a batch, values with
+    keywords that can not be compared are sent on their own."""
+    key = _kwds_key(kwds)
+    batch = _scalar_batches.get(title)
+    if batch is not None and (key is None or batch['key'] != key):
+        _send_batch(title)
+        batch = None
+    if key is None:
+        _send(title, [ipc.uuid, 'new_data', title, data_y, event_id, kwds])
+        return
+    if batch is None:
+        batch = {'values': [], 'event_ids': [], 'kwds': kwds, 'key': key, 'time': time.time()}
+        _scalar_batches[title] = batch
+    batch['values'].append(data_y)
+    batch['event_ids'].append(event_id)
+    if len(batch['values']) >= scalar_batch_size:
+        _send_batch(title)
+
+def _send_batch(title):
+    """Send the batch of scalars of the given title as arrays"""
+    batch = _scalar_batches.pop(title)
+    _send(title, [ipc.uuid, 'new_data_batch', title, numpy.array(batch['values']),
+                  numpy.array(batch['event_ids'], dtype=numpy.float64), batch['kwds']])
+
+def flush(force=False):
+    """Send all batches of scalars which are older than scalar_batch_interval
+    or all of them if force is True."""
+    if not _scalar_batches:
+        return
+    now = time.time()
+    for title in list(_scalar_batches.keys()):
+        if force or now - _scalar_batches[title]['time'] >= scalar_batch_interval:
+            _send_batch(title)
+
 
 def set_current_event(_evt):
     """Updates the current event, such that it can
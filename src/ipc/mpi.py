@@ -7,6 +7,7 @@ from __future__ import print_function, absolute_import # Compatibility with pyth
 import ipc
 import numpy
 import numbers
+import pickle
 import logging
 import time
 import sys
@@ -102,6 +103,8 @@ def init_event_reader_comm(slave_event_reader_min_rank):
     else:
         event_reader_group = comm.Get_group().Incl(range(1+0, comm.size))
     event_reader_comm = comm.Create(event_reader_group)
+    # The reductions registered in the configuration file
+    _create_reductions()
 
 def is_event_reader():
     """Returns True if the process is an event reader."""
@@ -154,11 +157,69 @@ def is_zmqserver():
 
 # COMMUNICATIONS
 
+# Maximum number of batches a slave can have in flight to the master.
+# Setting it to 0 sends every message immediately (blocking).
+send_window = 8
+_BATCH_TAG = 1
+_send_batch = []
+_send_requests = []
+# The buffers of the batches in flight, in the order of _send_requests
+_send_buffers = []
+
 def send(title, data):
-    """Send a list of data items to the master node."""
-    if comm is not None:
+    """Send a list of data items to the master node.
+    Data messages are pickled right away into the current batch, such that
+    later changes of the data are not sent. The batch is sent as a single
+    buffer with :func:`flush`. Control messages (titles starting with '__')
+    are sent immediately."""
+    if comm is None:
+        return
+    if send_window > 0 and not title.startswith('__'):
+        _send_batch.append(pickle.dumps([title, data], pickle.HIGHEST_PROTOCOL))
+    else:
+        flush()
         comm.send([title, data], 0)
 
+def flush():
+    """Send all messages collected since the last flush to the master node
+    as one non-blocking message. Blocks only if there are already
+    send_window batches in flight.
+
+    The batch is the concatenation of the pickled messages, followed by
+    their sizes and their number (int64)."""
+    global _send_batch
+    if comm is None or not _send_batch:
+        return
+    while len(_send_requests) >= send_window:
+        for i in sorted(MPI.Request.Waitsome(_send_requests), reverse=True):
+            _send_requests.pop(i)
+            _send_buffers.pop(i)
+    sizes = [len(m) for m in _send_batch] + [len(_send_batch)]
+    _send_batch.append(numpy.array(sizes, dtype=numpy.int64).tobytes())
+    buf = b''.join(_send_batch)
+    _send_requests.append(comm.Isend([buf, MPI.BYTE], 0, tag=_BATCH_TAG))
+    _send_buffers.append(buf)
+    _send_batch = []
+
+def _wait_sends():
+    """Flush and wait until all batches have been delivered."""
+    flush()
+    MPI.Request.Waitall(_send_requests)
+    del _send_requests[:]
+    del _send_buffers[:]
+
+def _unpickle_batch(buf):
+    """Returns the messages of a batch received from a slave."""
+    n = int(numpy.frombuffer(buf, numpy.int64, 1, len(buf) - 8)[0])
+    sizes = numpy.frombuffer(buf, numpy.int64, n, len(buf) - 8*(n+1))
+    view = memoryview(buf)
+    messages = []
+    start = 0
+    for size in sizes.tolist():
+        messages.append(pickle.loads(view[start:start+size]))
+        start += size
+    return messages
+
 # RELOADING OF CONFIGURATION FILE
 
 subscribed = set()
@@ -187,54 +248,433 @@ def checkreload():
 
 reducedata = {}
 slavesdone = []
+# Counters of the messages handled by the master, useful to monitor its throughput
+master_stats = {'messages': 0, 'batches': 0, 'forwarded': 0, 'start': time.time()}
+# Maximum number of messages the master receives before forwarding them
+master_drain_limit = 1000
 def master_loop():
     """Run the main loop on the master process.
-    It retransmits all received messages using its zmqserver
+    It waits for a message and then drains all other pending messages,
+    retransmits all received data using its zmqserver
     and handles any possible reductions."""
     status = MPI.Status()
-    msg = comm.recv(None, MPI.ANY_SOURCE, status = status)
+    comm.Probe(MPI.ANY_SOURCE, MPI.ANY_TAG, status)
+    outgoing = []
+    is_exiting = False
+    while True:
+        master_stats['messages'] += 1
+        if status.Get_tag() == _BATCH_TAG:
+            master_stats['batches'] += 1
+            buf = bytearray(status.Get_count(MPI.BYTE))
+            comm.Recv([buf, MPI.BYTE], status.Get_source(), _BATCH_TAG)
+            outgoing.extend(_unpickle_batch(buf))
+        else:
+            msg = comm.recv(None, status.Get_source(), status.Get_tag())
+            is_exiting = _master_handle(msg, status.Get_source(), outgoing)
+        if is_exiting or len(outgoing) >= master_drain_limit:
+            break
+        if not comm.Iprobe(MPI.ANY_SOURCE, MPI.ANY_TAG, status):
+            break
+    _master_forward(outgoing)
+    if is_exiting:
+        MPI.Finalize()
+    return is_exiting
+
+def _master_forward(outgoing):
+    """Send the data received from the slaves with the zmqserver."""
+    if not outgoing:
+        return
+    server = ipc.zmq()
+    for title, data in outgoing:
+        # Inject a proper UUID
+        data[0] = ipc.uuid
+        # The arrays have just been unpickled, nobody else uses them
+        server.send(title, data, owned=True)
+    master_stats['forwarded'] += len(outgoing)
+
+def _master_handle(msg, source, outgoing):
+    """Handle a single message received by the master.
+    Returns True when all slaves are done."""
     if(msg[0] == '__data_conf__'):
         ipc.broadcast.data_conf.update(msg[1])
     elif(msg[0] == '__reduce__'):
         cmd = msg[1]
         if(msg[2] != ()):
-            data_y = numpy.zeros(msg[1])
+            data_y = numpy.zeros(msg[2])
         else:
             data_y = 0
         incomingdata = msg[3]
         getback = msg[4]
         
-        source = status.Get_source()
-        
         # This indicates that we really should have an object for the state
         if cmd not in reducedata:
             reducedata[cmd] = {}
         reducedata[cmd][source] = incomingdata
         
         if getback:
-            cnt = 0
-            for data in reducedata[cmd]:
-                data_y = data_y + reducedata[cmd][data]
+            if len(msg) > 5 and msg[5] != "SUM":
+                data_y = _master_ops[msg[5]].reduce(list(reducedata[cmd].values()))
+            else:
+                for data in reducedata[cmd]:
+                    data_y = data_y + reducedata[cmd][data]
             comm.send(data_y, source)
     elif(msg[0] == '__exit__'):
         slavesdone.append(True)
         logging.info("Slave with rank = %d reports to be done" %msg[1])
         if len(slavesdone) == nr_slaves():
-            MPI.Finalize()
             return True
     else:
-        # Inject a proper UUID
-        msg[1][0] = ipc.uuid
-        ipc.zmq().send(msg[0], msg[1])
+        outgoing.append(msg)
+    return False
+
+_shutdown_hooks = []
+def at_shutdown(func):
+    """Registers a function that is called by :func:`slave_done` on the event readers, in the order of
+    registration. Collective calls that must not be made while other readers are still processing
+    events (e.g. freeing a window) go there."""
+    _shutdown_hooks.append(func)
 
 def slave_done():
+    if is_event_reader():
+        for func in _shutdown_hooks:
+            func()
+        del _shutdown_hooks[:]
+        finalize_reductions()
+    if comm is not None:
+        _wait_sends()
     send('__exit__', rank)
-            
-def sum(cmd, array):
-    """Element-wise sum of a numpy array across all processes of event readers.
+
+# REDUCTIONS
+
+class _Reduction(object):
+    """Element-wise reduction of an array across all event readers, see :func:`reduce`.
+
+    Every reduction has its own duplicate of the event reader communicator, which all event
+    readers create in the same order (see :func:`register_reduction` and :class:`_Agreement`),
+    such that the same communicator belongs to the same reduction on every rank.
+    A round is a non-blocking ``Iallreduce`` of the latest array of every reader;
+    the result of a round becomes available once every event reader has contributed
+    to it, meanwhile the readers keep processing. A new round is posted on every
+    call of :func:`progress_reductions`, whether or not the reader has updated its array.
+    Only non-blocking rounds are posted on the communicator, also for blocking calls."""
+    def __init__(self, array, op, comm=None):
+        self.op = op
+        self.comm = event_reader_comm.Dup() if comm is None else comm
+        self.latest = numpy.array(array, copy=True)
+        self.sendbuf = numpy.empty_like(self.latest)
+        self.recvbuf = numpy.empty_like(self.latest)
+        self.result = numpy.array(self.latest, copy=True)
+        self.request = None
+        self.rounds = 0
+        self.post()
+
+    def check(self, array, op):
+        if array.shape != self.result.shape or array.dtype != self.result.dtype:
+            raise ValueError("Cannot change shape or dtype of a reduction from %s %s to %s %s" %
+                             (self.result.shape, self.result.dtype, array.shape, array.dtype))
+        if op != self.op:
+            raise ValueError("Cannot change the operation of an existing reduction")
+
+    def test(self):
+        """Collect the result of the pending round, if it has finished."""
+        if self.request is not None and self.request.Test():
+            self.request = None
+            self.result[...] = self.recvbuf
+        return self.request is None
+
+    def wait(self):
+        """Wait for the pending round and collect its result."""
+        if self.request is not None:
+            self.request.Wait()
+            self.request = None
+            self.result[...] = self.recvbuf
+
+    def post(self):
+        """Start a new non-blocking round with a copy of the latest array."""
+        self.sendbuf[...] = self.latest
+        self.request = self.comm.Iallreduce(self.sendbuf, self.recvbuf, op=self.op)
+        self.rounds += 1
+
+    def progress(self):
+        if self.test():
+            self.post()
+
+    def blocking(self):
+        """Post a round with the latest array and wait for it."""
+        self.wait()
+        self.post()
+        self.wait()
+
+    def finish(self, rounds):
+        """Post rounds until the given number of rounds is reached and wait for all of them."""
+        self.wait()
+        while self.rounds < rounds:
+            self.post()
+            self.wait()
+        self.comm.Free()
+
+class _Agreement(object):
+    """Agreement of all event readers on the reductions that are used without being registered.
+
+    The first time a reader reduces an unregistered cmd, it announces the cmd (with the shape,
+    dtype and operation of its array). The announcements of all readers are exchanged in rounds of
+    non-blocking ``Iallgather`` (the sizes) and ``Iallgatherv`` (the pickled announcements) on a
+    control communicator, such that every reader gets the same list of new cmds in the same order,
+    no matter when the readers have first used them. For every new cmd, a communicator is duplicated
+    with ``Idup``, in this order on all ranks, and the reduction becomes collective once the duplicate
+    is available. Only non-blocking operations are posted on the control communicator, in the same
+    sequence by all readers. The duplicates are made from a second communicator, as Open MPI
+    mixes up ``Idup`` with other pending non-blocking collectives on the same communicator."""
+    def __init__(self):
+        self.comm = event_reader_comm.Dup()
+        self.dup_comm = event_reader_comm.Dup()
+        self.size = self.comm.Get_size()
+        self.announced = set()
+        self.pending = []
+        self.known = set()
+        self.creating = []
+        self.rounds = 0
+        self.request = None
+        self.phase = None
+        self.post()
+
+    def announce(self, cmd, array, op):
+        if cmd not in self.announced:
+            self.announced.add(cmd)
+            self.pending.append((cmd, array.shape, array.dtype.str, op))
+
+    def post(self):
+        """Start a new round with the sizes of the announcements made since the last round."""
+        self.sent = numpy.frombuffer(pickle.dumps(self.pending, 2), dtype=numpy.uint8)
+        self.pending = []
+        self.count = numpy.array([self.sent.size], dtype=numpy.int64)
+        self.counts = numpy.zeros(self.size, dtype=numpy.int64)
+        self.request = self.comm.Iallgather(self.count, self.counts)
+        self.phase = 'counts'
+        self.rounds += 1
+
+    def _step(self):
+        """Continues the current round after one of its operations has finished"""
+        if self.phase == 'counts':
+            counts = self.counts.tolist()
+            displs = [int(numpy.sum(counts[:i])) for i in range(self.size)]
+            self.received = numpy.empty(int(numpy.sum(counts)), dtype=numpy.uint8)
+            self.request = self.comm.Iallgatherv([self.sent, MPI.BYTE], [self.received, counts, displs, MPI.BYTE])
+            self.phase = 'announcements'
+        else:
+            start = 0
+            for count in self.counts.tolist():
+                for cmd, shape, dtype, op in pickle.loads(self.received[start:start+count].tobytes()):
+                    if cmd not in self.known and cmd not in _reductions:
+                        self.known.add(cmd)
+                        newcomm, request = self.dup_comm.Idup()
+                        self.creating.append((cmd, numpy.zeros(shape, dtype=dtype), op, newcomm, request))
+                start += count
+            self.request = None
+            self.phase = None
+
+    def progress(self):
+        """Advances the current round without waiting, starts a new one if it has finished"""
+        while self.request is not None and self.request.Test():
+            self._step()
+        if self.request is None:
+            self.post()
+        self._create(wait=False)
+
+    def _create(self, wait):
+        """Creates the reductions whose communicators have been duplicated, in the agreed order"""
+        while self.creating:
+            cmd, array, op, newcomm, request = self.creating[0]
+            if wait:
+                request.Wait()
+            elif not request.Test():
+                break
+            self.creating.pop(0)
+            _registered.append((cmd, array, op))
+            _reductions[cmd] = _Reduction(_initial(cmd, array, op), getattr(MPI, op), comm=newcomm)
+
+    def finish(self, rounds):
+        """Runs rounds until the given number of rounds is reached, creates all agreed reductions and frees the communicator."""
+        while True:
+            while self.request is not None:
+                self.request.Wait()
+                self._step()
+            if self.rounds >= rounds:
+                break
+            self.post()
+        self._create(wait=True)
+        self.comm.Free()
+        self.dup_comm.Free()
+
+# Registered reductions in the order of registration, (cmd, initial array, op)
+_registered = []
+_reductions = {}
+# The latest arrays of the reductions that are not collective yet
+_first_arrays = {}
+_agreement = None
+def register_reduction(cmd, array, op="SUM"):
+    """Registers a collective reduction for cmd, see :func:`reduce`.
+    Has to be called by all event readers in the same order with arrays of identical
+    shape and dtype, best at the top of the configuration file. The array is the
+    contribution of a reader until it calls :func:`reduce` for the first time.
+    Registering an existing reduction again (e.g. when reloading the configuration) does nothing.
+    Reductions that are not registered become collective automatically, after a short time
+    in which they are computed by the master."""
+    if(not isinstance(array, numpy.ndarray)):
+        raise TypeError("argument must be a numpy ndarray")
+    if not use_mpi or cmd in [c for c, a, o in _registered]:
+        return
+    _registered.append((cmd, numpy.array(array, copy=True), op))
+    if event_reader_comm is not None:
+        _create_reductions()
+
+def _create_reductions():
+    """Creates the registered reductions that do not exist yet, in the order of registration.
+    Called by all event readers at the same points: when the event reader communicator
+    is initialised and when a reduction is registered after that."""
+    global _agreement
+    if not is_event_reader():
+        return
+    for cmd, array, op in _registered:
+        if cmd not in _reductions:
+            _reductions[cmd] = _Reduction(array, getattr(MPI, op))
+    if _agreement is None:
+        _agreement = _Agreement()
+
+def _initial(cmd, array, op):
+    """Returns the contribution of a reader to a reduction that becomes collective: its latest array
+    if it has used the reduction, otherwise the identity of the operation"""
+    if cmd in _first_arrays:
+        return _first_arrays.pop(cmd)
+    if op in ["PROD", "LAND"]:
+        array[...] = 1
+    elif op in ["MAX", "MIN"] and array.dtype.kind in 'iu':
+        info = numpy.iinfo(array.dtype)
+        array[...] = info.min if op == "MAX" else info.max
+    elif op in ["MAX", "MIN"]:
+        array[...] = -numpy.inf if op == "MAX" else numpy.inf
+    return array
+
+def progress_reductions():
+    """Collects finished rounds of the reductions and posts new ones,
+    called by the event readers once per event."""
+    if _agreement is not None:
+        _agreement.progress()
+    for cmd, array, op in _registered:
+        if cmd in _reductions:
+            _reductions[cmd].progress()
+
+def reduce(cmd, array, op="SUM", blocking=False):
+    """Element-wise reduction of a numpy array across all event readers
+    using the MPI operation op (e.g. SUM, MAX, MIN, PROD, LAND, LOR).
+    The result is written into array on the main event reader (rank 0 in event reader comm),
+    which is also the only reader getting the array back (None otherwise).
+
+    The reduction is collective and does not block: it returns the result of the most recently
+    finished round of the latest arrays of all readers. Only if blocking is True it waits for all
+    event readers to call it as well. Reductions that have been registered with :func:`register_reduction`
+    are collective from the start. Others are computed by the master from the most recent array it
+    has received from every reader, until all readers have agreed on the new reduction, which does
+    not need all event readers to take part. Numbers (instead of arrays) are always reduced by the
+    master, the main event reader gets the result returned."""
+    if isinstance(array, numbers.Number):
+        if not use_mpi:
+            return array
+        return _reduce_via_master(cmd, array, op)
+    if(not isinstance(array, numpy.ndarray)):
+        raise TypeError("argument must be a numpy ndarray or a number")
+    if not use_mpi:
+        return array
+    if cmd not in _reductions:
+        if _agreement is not None:
+            _first_arrays[cmd] = numpy.array(array, copy=True)
+            _agreement.announce(cmd, array, op)
+            _agreement.progress()
+        if cmd not in _reductions:
+            return _reduce_via_master(cmd, array, op)
+    reduction = _reductions[cmd]
+    reduction.check(array, getattr(MPI, op))
+    reduction.latest[...] = array
+    if blocking:
+        reduction.blocking()
+    else:
+        reduction.progress()
+    if not is_main_event_reader():
+        return None
+    array[...] = reduction.result
+    return array
+
+def finalize_reductions():
+    """Make sure that all reductions have completed on all event readers, such that
+    MPI can be finalized without any outstanding requests."""
+    global _agreement
+    if not use_mpi:
+        return
+    if _agreement is not None:
+        _agreement.finish(numpy.max(event_reader_comm.allgather(_agreement.rounds)))
+        _agreement = None
+    rounds = {}
+    for r in event_reader_comm.allgather(dict((cmd, red.rounds) for cmd, red in _reductions.items())):
+        for cmd in r:
+            rounds[cmd] = numpy.maximum(rounds.get(cmd, 0), r[cmd])
+    missing = [cmd for cmd in rounds if cmd not in _reductions]
+    if missing:
+        # The duplicated communicators cannot be matched any more, finishing would hang
+        raise RuntimeError("Reductions %s have not been registered by all event readers" % sorted(missing))
+    for cmd, array, op in _registered:
+        if cmd in rounds:
+            _reductions.pop(cmd).finish(rounds[cmd])
+
+def sum(cmd, array, blocking=False):
+    """Element-wise sum of a numpy array across all event readers.
+    The result is only available in the main event reader (rank 0 in event reader comm)."""
+    return reduce(cmd, array, "SUM", blocking)
+
+def max(cmd, array, blocking=False):
+    """Element-wise max of a numpy array across all event readers.
     The result is only available in the main event reader (rank 0 in event reader comm)."""
-    #_reduce(array, "SUM")
-    #return
+    return reduce(cmd, array, "MAX", blocking)
+
+def min(cmd, array, blocking=False):
+    """Element-wise min of a numpy array across all event readers.
+    The result is only available in the main event reader (rank 0 in event reader comm)."""
+    return reduce(cmd, array, "MIN", blocking)
+
+def prod(cmd, array, blocking=False):
+    """Element-wise product of a numpy array across all event readers.
+    The result is only available in the main event reader (rank 0 in event reader comm)."""
+    return reduce(cmd, array, "PROD", blocking)
+
+def logical_or(cmd, array, blocking=False):
+    """Element-wise logical OR of a numpy array across all event readers.
+    The result is only available in the main event reader (rank 0 in event reader comm)."""
+    return reduce(cmd, array, "LOR", blocking)
+
+def logical_and(cmd, array, blocking=False):
+    """Element-wise logical AND of a numpy array across all event readers.
+    The result is only available in the main event reader (rank 0 in event reader comm)."""
+    return reduce(cmd, array, "LAND", blocking)
+
+# Element-wise operations used by the master to reduce arrays
+_master_ops = {"SUM": numpy.add, "MAX": numpy.maximum, "MIN": numpy.minimum, "PROD": numpy.multiply,
+               "LOR": numpy.logical_or, "LAND": numpy.logical_and}
+
+def _reduce_via_master(cmd, array, op):
+    """Sends the array (or number) to the master, the main event reader waits for the reduction of
+    the most recent arrays of all readers."""
+    getback = is_main_event_reader()
+    comm.send(['__reduce__', cmd, numpy.shape(array), array, getback, op], dest=0)
+    if not getback:
+        return None
+    if isinstance(array, numbers.Number):
+        return comm.recv(None, 0)
+    array[...] = comm.recv(None, 0)
+    return array
+
+def sum_via_master(cmd, array):
+    """Element-wise sum of a numpy array across all processes of event readers,
+    computed by the master from the most recent array sent by each reader.
+    This is what :func:`sum` does for reductions that have not been registered."""
     if not use_mpi:
         return
 
@@ -270,38 +710,3 @@ def send_reduce(title, cmd, data_y, data_x, **kwds):
             comm.send(['__reduce__', title, cmd, (), data_x, kwds, data_y], 0)
         else:
             comm.send(['__reduce__', title, cmd, data_y.shape, data_x, kwds, data_y], 0)
-            
-def max(array):
-    """Element-wise max of a numpy array across all the slave processes.
-    The result is only available in the main_slave (rank 1)."""
-    _reduce(array, "MAX")
-
-def min(array):
-    """Element-wise max of a numpy array across all the slave processes.
-    The result is only available in the main_slave (rank 1)."""
-    _reduce(array, "MIN")
-
-def prod(array):
-    """Element-wise product of a numpy array across all the slave processes.
-    The result is only available in the main_slave (rank 1)."""
-    _reduce(array, "PROD")
-
-def logical_or(array):
-    """Element-wise logical OR of a numpy array across all the slave processes.
-    The result is only available in the main_slave (rank 1)."""
-    _reduce(array, "LOR")
-
-def logical_and(array):
-    """Element-wise logical AND of a numpy array across all the slave processes.
-    The result is only available in the main_worker()."""
-    _reduce(array, "LAND")
-
-def _reduce(array, op):
-    """Reduce a numpy array with the given MPI op across all the slave processes"""
-    if(not isinstance(array,numpy.ndarray)):
-        raise TypeError("argument must be a numpy ndarray")
-    if(slaves_comm):
-        if(is_main_slave()):
-            slaves_comm.Reduce(MPI.IN_PLACE, array, op=getattr(MPI,op))
-        else:
-            slaves_comm.Reduce(array,  None, op=getattr(MPI,op))
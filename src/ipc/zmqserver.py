@@ -11,10 +11,11 @@ import zmq.eventloop.zmqstream
 import threading
 import ipc
 import numpy
-import hashlib
+import numbers
 import ipc.mpi
 import backend.worker
 import logging
+import utils.frames
 from utils.cmdline_args import argparser as _argparser
 
 eventLimit = 125
@@ -83,23 +84,23 @@ class ZmqServer(object):
         t.start()
 
 
-    def _send_array(self, array, flags=0, copy=True, track=False):
-        """Send a numpy array with metadata"""
-        md = dict(
-            dtype=str(array.dtype),
-            shape=array.shape,
-            strides=array.strides,
-        )
-        if md['dtype'] == 'object':
-            raise ValueError('Cannot broadcast arrays with dtype=object')
-        self._data_socket.send_json(md, flags|zmq.SNDMORE)
-        return self._data_socket.send(array, flags, copy=copy, track=track)
+    def _send_array(self, array, event_id=0., key=b'', flags=0, copy=True):
+        """Send a numpy array as a binary header and the raw array buffer.
+        Without copy the buffer is handed to zmq, so the array must not be changed afterwards."""
+        array = utils.frames.sendable(array)
+        self._data_socket.send(utils.frames.encode_header(array, event_id, key), flags|zmq.SNDMORE)
+        return self._data_socket.send(array, flags, copy=copy)
 
-    def send(self, title, data):
-        """Send a list of data items to the broadcast named title"""
+    def send(self, title, data, owned=False):
+        """Send a list of data items to the broadcast named title.
+        If owned is True, the arrays in data are not used by anyone else (e.g. they have just
+        been received by the master) and are sent without copying them."""
         if self._batch_mode:
             return
         array_list = []
+        event_id = 0.
+        if len(data) > 4 and isinstance(data[4], numbers.Real):
+            event_id = data[4]
         for i in range(len(data)):
             if(isinstance(data[i], numpy.ndarray)):
                 array_list.append(data[i])
@@ -110,18 +111,17 @@ class ZmqServer(object):
         # Use the md5sum of the title as the key to avoid clashing
         # keys, when one title is a substring or another title
         # (e.g. "CCD" and "CCD1")
-        m = hashlib.md5()
-        m.update(title.encode('UTF-8'))
-        self._data_socket.send(m.digest(), zmq.SNDMORE)
+        key = utils.frames.title_hash(title)
+        self._data_socket.send(key, zmq.SNDMORE)
         if(len(array_list)):
             self._data_socket.send_json(data, zmq.SNDMORE)
         else:
             self._data_socket.send_json(data)
         for i in range(len(array_list)):
             if(i != len(array_list)-1):
-                self._send_array(array_list[i], flags=zmq.SNDMORE)
+                self._send_array(array_list[i], event_id, key, flags=zmq.SNDMORE, copy=not owned)
             else:
-                self._send_array(array_list[i])
+                self._send_array(array_list[i], event_id, key, copy=not owned)
     
     def _answer_command(self, stream, msg):
         """Reply to commands received on the _ctrl_stream"""
@@ -5,38 +5,109 @@
 """A plotting module for correlations and maps"""
 import numpy as np
 import ipc
-from scipy.sparse import lil_matrix
 from backend import Record
 
 _existingPlots = {}
 
 # Private classes / helper functions
 # ----------------------------------
+class _TiledMap(object):
+    """Sparse map of sums and norms on a virtually unbounded grid of bins,
+    stored as a dictionary of dense square tiles.
+
+    Points are collected in a batch (coordinate list) and folded into the
+    tiles with one bincount whenever the batch is full or the map is read."""
+    def __init__(self, tile=64, batch=1024):
+        self.tile = tile
+        self.batch = batch
+        self.tiles = {}
+        self._pending = []
+
+    def add(self, iy, ix, z, n):
+        self._pending.append((iy, ix, z, n))
+        if len(self._pending) >= self.batch:
+            self.compact()
+
+    def compact(self):
+        """Folds the pending points into the tiles"""
+        if not self._pending:
+            return
+        points = np.array(self._pending, dtype=np.float64)
+        self._pending = []
+        T = self.tile
+        iy = points[:,0].astype(np.int64)
+        ix = points[:,1].astype(np.int64)
+        keys, inverse = np.unique(np.column_stack((iy // T, ix // T)), axis=0, return_inverse=True)
+        flat = inverse.ravel()*T*T + (iy % T)*T + (ix % T)
+        size = len(keys)*T*T
+        sums  = np.bincount(flat, weights=points[:,2], minlength=size).reshape(len(keys), T, T)
+        norms = np.bincount(flat, weights=points[:,3], minlength=size).reshape(len(keys), T, T)
+        self.add_tiles(keys, np.stack((sums, norms), axis=1))
+
+    def add_tiles(self, keys, tiles):
+        """Adds tiles (shape: N x 2 x tile x tile) at the given tile coordinates (N x 2)"""
+        for key, tile in zip(keys, tiles):
+            key = (int(key[0]), int(key[1]))
+            if key in self.tiles:
+                self.tiles[key] += tile
+            else:
+                self.tiles[key] = tile.copy()
+
+    def pop_tiles(self):
+        """Returns the coordinates and the content of all tiles and clears the map"""
+        self.compact()
+        T = self.tile
+        keys = np.array(sorted(self.tiles.keys()), dtype=np.int64).reshape(-1, 2)
+        tiles = np.zeros((len(keys), 2, T, T))
+        for i, key in enumerate(keys):
+            tiles[i] = self.tiles[(key[0], key[1])]
+        self.tiles = {}
+        return keys, tiles
+
+    def window(self, iy0, ix0, ny, nx):
+        """Returns a dense array (2 x ny x nx) with the sums and norms of the bins starting at (iy0, ix0)"""
+        self.compact()
+        T = self.tile
+        out = np.zeros((2, ny, nx))
+        for ty in range(iy0 // T, (iy0 + ny - 1) // T + 1):
+            for tx in range(ix0 // T, (ix0 + nx - 1) // T + 1):
+                tile = self.tiles.get((ty, tx))
+                if tile is None:
+                    continue
+                y0, x0 = max(ty*T, iy0), max(tx*T, ix0)
+                y1, x1 = min((ty+1)*T, iy0+ny), min((tx+1)*T, ix0+nx)
+                out[:, y0-iy0:y1-iy0, x0-ix0:x1-ix0] = tile[:, y0-ty*T:y1-ty*T, x0-tx*T:x1-tx*T]
+        return out
+
 class _MeanMap:
     def __init__(self, name, xmin, xmax, ymin, ymax, step, localRadius, overviewStep, xlabel, ylabel, group=None):
 
         # Initialize local map
-        self.localRadius = localRadius / float(step)
-        self.step = step
-        self.xrange = np.linspace(xmin, xmax, (xmax-xmin)/float(step)+1)
-        self.yrange = np.linspace(ymin, ymax, (ymax-ymin)/float(step)+1)
-        self.Nx = self.xrange.shape[0]
-        self.Ny = self.yrange.shape[0]
-        self.localXmin = self.xrange[self.Nx/2-self.localRadius]
-        self.localXmax = self.xrange[self.Nx/2+self.localRadius]
-        self.localYmin = self.yrange[self.Ny/2-self.localRadius]
-        self.localYmax = self.yrange[self.Ny/2+self.localRadius]
-        self.sparseSum  = lil_matrix((self.Ny, self.Nx), dtype=np.float32)
-        self.sparseNorm = lil_matrix((self.Ny, self.Nx), dtype=np.float32)
-        self.localMap   = np.zeros((2*self.localRadius+1, 2*self.localRadius+1))
+        self.name = name
+        self.localRadius = int(localRadius / float(step))
+        self.step = float(step)
+        self.xmin = xmin
+        self.ymin = ymin
+        self.Nx = int(round((xmax-xmin)/self.step)) + 1
+        self.Ny = int(round((ymax-ymin)/self.step)) + 1
+        self.center = (self.Ny//2, self.Nx//2)
+        self.updateLocalLimits()
+        self.sparseMap = _TiledMap()
+        self.localMap  = np.zeros((2*self.localRadius+1, 2*self.localRadius+1))
 
         # Initialize overview map
-        self.overviewXrange = np.linspace(xmin, xmax, (xmax-xmin)/float(overviewStep))
-        self.overviewYrange = np.linspace(ymin, ymax, (ymax-ymin)/float(overviewStep))
-        overviewNx = self.overviewXrange.shape[0]
-        overviewNy = self.overviewYrange.shape[0]
+        overviewNx = max(int((xmax-xmin)/float(overviewStep)), 2)
+        overviewNy = max(int((ymax-ymin)/float(overviewStep)), 2)
+        self.overviewXstep = (xmax-xmin)/float(overviewNx-1)
+        self.overviewYstep = (ymax-ymin)/float(overviewNy-1)
         self.overviewMap = np.zeros((overviewNy, overviewNx))
 
+        # Touched tiles are sent to the main event reader, which keeps the full map
+        self.distributed = bool(ipc.mpi.use_mpi and ipc.mpi.is_event_reader())
+        if self.distributed and ipc.mpi.is_main_event_reader():
+            for keys, tiles in _pendingTiles.pop(name, []):
+                self.sparseMap.add_tiles(keys, tiles)
+
         # Initialize plots
         self.counter = 0
         ipc.broadcast.init_data(name+' -> Overview', data_type='image', history_length=1, flipy=True, \
@@ -45,55 +116,101 @@ class _MeanMap:
                                 xmin=self.localXmin, xmax=self.localXmax, \
                                 ymin=self.localYmin, ymax=self.localYmax, xlabel=xlabel, ylabel=ylabel, group=group)
 
+    def _index(self, X, Y):
+        """Returns the bin (iy, ix) closest to the position (X, Y)"""
+        ix = min(max(int(round((X.data - self.xmin)/self.step)), 0), self.Nx-1)
+        iy = min(max(int(round((Y.data - self.ymin)/self.step)), 0), self.Ny-1)
+        return iy, ix
+
+    def _overviewIndex(self, X, Y):
+        ix = min(max(int(round((X.data - self.xmin)/self.overviewXstep)), 0), self.overviewMap.shape[1]-1)
+        iy = min(max(int(round((Y.data - self.ymin)/self.overviewYstep)), 0), self.overviewMap.shape[0]-1)
+        return iy, ix
+
     def append(self, X, Y, Z, N):
         try:
             N = N.data
         except AttributeError:
             pass
-        self.sparseSum[abs(self.yrange - Y.data).argmin(), abs(self.xrange - X.data).argmin()] += Z.data
-        self.sparseNorm[abs(self.yrange - Y.data).argmin(), abs(self.xrange - X.data).argmin()] += N
-        self.overviewMap[abs(self.overviewYrange - Y.data).argmin(), abs(self.overviewXrange - X.data).argmin()] += 1
+        iy, ix = self._index(X, Y)
+        self.sparseMap.add(iy, ix, Z.data, N)
+        self.overviewMap[self._overviewIndex(X, Y)] += 1
         self.counter += 1
 
     def updateCenter(self, X, Y):
-        self.center = (abs(self.yrange - Y.data).argmin(), abs(self.xrange - X.data).argmin())
+        self.center = self._index(X, Y)
 
     def updateLocalLimits(self):
-        self.localXmin = max(self.xrange[max(self.center[1]-self.localRadius, 0)], self.xrange.min())
-        self.localXmax = min(self.xrange[min(self.center[1]+self.localRadius, self.Nx-1)], self.xrange.max())
-        self.localYmin = max(self.yrange[max(self.center[0]-self.localRadius, 0)], self.yrange.min())
-        self.localYmax = min(self.yrange[min(self.center[0]+self.localRadius, self.Ny-1)], self.yrange.max())
+        self.localXmin = self.xmin + (self.center[1]-self.localRadius)*self.step
+        self.localXmax = self.xmin + (self.center[1]+self.localRadius)*self.step
+        self.localYmin = self.ymin + (self.center[0]-self.localRadius)*self.step
+        self.localYmax = self.ymin + (self.center[0]+self.localRadius)*self.step
 
     def gatherSumsAndNorms(self):
-        if(ipc.mpi.slaves_comm):
-            sparseSums  = ipc.mpi.slaves_comm.gather(self.sparseSum)
-            sparseNorms = ipc.mpi.slaves_comm.gather(self.sparseNorm)
-            if(ipc.mpi.is_main_slave()):
-                self.sparseSum  = sparseSums[0]
-                self.sparseNorm = sparseNorms[0]
-                for i in sparseSums[1:]:
-                    self.sparseSum  += i
-                for n in sparseNorms[1:]:
-                    self.sparseNorm += n
+        """Sends the tiles touched since the last call to the main event reader, which keeps the full map.
+        The tiles are sent point to point without waiting, such that the readers do not need to call this together."""
+        if not self.distributed:
+            return
+        if ipc.mpi.is_main_event_reader():
+            self.sparseMap.compact()
+            _receiveTiles()
+        else:
+            _sendTiles(self.name, *self.sparseMap.pop_tiles())
 
     def gatherOverview(self):
-        ipc.mpi.sum(self.overviewMap)
+        ipc.mpi.sum(self.name+' -> Overview', self.overviewMap)
                     
     def updateLocalMap(self):
-        r = int(self.localRadius)
+        r = self.localRadius
         c = self.center
-        self.localSum  = self.sparseSum[c[0]-r: c[0]+r+1, c[1]-r:c[1]+r+1].toarray()
-        self.localNorm = self.sparseNorm[c[0]-r: c[0]+r+1, c[1]-r:c[1]+r+1].toarray()
+        self.localSum, self.localNorm = self.sparseMap.window(c[0]-r, c[1]-r, 2*r+1, 2*r+1)
         visited = self.localNorm != 0
+        self.localMap[:] = 0
         self.localMap[visited] = self.localSum[visited] / self.localNorm[visited]
 
     def updateOverviewMap(self, X,Y):
-        current = (abs(self.overviewYrange - Y.data).argmin(), abs(self.overviewXrange - X.data).argmin())
+        current = self._overviewIndex(X, Y)
         visited = self.overviewMap[()] != 0
         self.overviewMap[visited] = 1
         self.overviewMap[current] = 2
 
 
+# Tiles of mean maps sent from the event readers to the main event reader
+_TILES_TAG = 7
+_tileRequests = []
+_tileMessages = {'sent': 0, 'received': 0}
+_pendingTiles = {}
+
+def _sendTiles(name, keys, tiles):
+    global _tileRequests
+    _tileRequests = [r for r in _tileRequests if not r.Test()]
+    _tileRequests.append(ipc.mpi.event_reader_comm.isend((name, keys, tiles), 0, tag=_TILES_TAG))
+    _tileMessages['sent'] += 1
+
+def _receiveTiles(count=None):
+    """Adds the received tiles to their maps, waits for count messages in total if given"""
+    comm = ipc.mpi.event_reader_comm
+    while (comm.Iprobe(source=ipc.mpi.MPI.ANY_SOURCE, tag=_TILES_TAG) if count is None
+           else _tileMessages['received'] < count):
+        name, keys, tiles = comm.recv(source=ipc.mpi.MPI.ANY_SOURCE, tag=_TILES_TAG)
+        _tileMessages['received'] += 1
+        m = _existingPlots.get(name)
+        if isinstance(m, _MeanMap):
+            m.sparseMap.add_tiles(keys, tiles)
+        else:
+            _pendingTiles.setdefault(name, []).append((keys, tiles))
+
+def _finishTiles():
+    """Receives all tiles that have been sent, such that MPI can be finalized without any outstanding messages"""
+    if not ipc.mpi.use_mpi:
+        return
+    counts = ipc.mpi.event_reader_comm.gather(_tileMessages['sent'], root=0)
+    if ipc.mpi.is_main_event_reader():
+        _receiveTiles(sum(counts))
+    else:
+        ipc.mpi.MPI.Request.Waitall(_tileRequests)
+ipc.mpi.at_shutdown(_finishTiles)
+
 # Public Plotting functions - Put new plotting functions here!
 # ------------------------------------------------------------
 #meanMaps = {}
@@ -127,7 +244,7 @@ def plotMeanMapDynamic(X, Y, Z, norm=1., msg='', update=100, xmin=0, xmax=100, y
         if xlabel is None: xlabel = X.name
         if ylabel is None: ylabel = Y.name
         _existingPlots[name] = _MeanMap(name, xmin, xmax, ymin, ymax, step, localRadius, overviewStep, xlabel, ylabel, group=group)
-    m = existingPlots[name]
+    m = _existingPlots[name]
     m.append(X, Y, Z, norm)
     if(not m.counter % update):
         m.gatherSumsAndNorms()
@@ -203,12 +320,12 @@ def plotHeatmap(X, Y, xmin=0, xmax=1, xbins=10, ymin=0, ymax=1, ybins=10, name=N
     # assign y to row and x to col in 2D array
     _existingPlots[name][ny, nx] += 1
     current_heatmap = np.copy(heatmaps[name])
-    ipc.mpi.sum(current_heatmap)
+    ipc.mpi.sum(name, current_heatmap)
     if ipc.mpi.is_main_event_reader():
         ipc.new_data(name, current_heatmap[()])
 
 
-def plotMeanMap(X,Y,Z, xmin=0, xmax=10, xbins=10, ymin=0, ymax=10, ybins=10, xlabel=None, ylabel=None, msg='', dynamic_extent=False, initial_reset=False, name=None, group=None):
+def plotMeanMap(X,Y,Z, xmin=0, xmax=10, xbins=10, ymin=0, ymax=10, ybins=10, xlabel=None, ylabel=None, msg='', dynamic_extent=False, initial_reset=False, name=None, group=None, history=10000):
     """Plotting the meanmap of Z as a function of two parameters X and Y.
     (No buffer in the backend).
 
@@ -227,13 +344,14 @@ def plotMeanMap(X,Y,Z, xmin=0, xmax=10, xbins=10, ymin=0, ymax=10, ybins=10, xla
         :xlabel(str): 
         :ylabel(str):
         :msg(msg):   Any message to be displayed in the plot
+        :history(int): Number of triples buffered in the interface between two updates of the map
     """
     if name is None:
         name = "MeanMap(%s,%s,%s)" % (X.name, Y.name, Z.name)
     if (not name in _existingPlots):
         if xlabel is None: xlabel = X.name
         if ylabel is None: ylabel = Y.name
-        ipc.broadcast.init_data(name, data_type='triple', history_length=1,
+        ipc.broadcast.init_data(name, data_type='triple', history_length=history,
                                 xmin=xmin, xmax=xmax, ymin=ymin, ymax=ymax,
                                 xbins=xbins, ybins=ybins,
                                 xlabel=xlabel, ylabel=ylabel, flipy=True,
@@ -8,7 +8,19 @@ from backend import Record
 import numpy as np
 
 histograms = {}
-def plotHistogram(value, hmin=0, hmax=10, bins=10, name=None, group=None, buffer_length=100):
+def plotHistogram(value, hmin=0, hmax=10, bins=10, name=None, group=None, buffer_length=100, autorange=False):
+    """Plotting a histogram of a scalar value, which is filled incrementally in the interface.
+
+    Args:
+        :value:          Record or value to be histogrammed
+
+    Kwargs:
+        :hmin(float), hmax(float), bins(int): Initial range and number of bins
+        :name(str):      Name of the plot
+        :group(str):     Group of the plot
+        :buffer_length(int): Length of the buffer in the interface
+        :autorange(bool): Double the range in the interface when values fall outside of it
+    """
     if name is None:
         if hasattr(value, "name"):
             name = "Histogram of {0}".format(value.name)
@@ -16,14 +28,15 @@ def plotHistogram(value, hmin=0, hmax=10, bins=10, name=None, group=None, buffer
             name = "Histogram"
     if (name not in histograms):
         ipc.broadcast.init_data(name, data_type='histogram', history_length=buffer_length,
-                                hmin=hmin, hmax=hmax, bins=bins, group=group)
+                                hmin=hmin, hmax=hmax, bins=bins, group=group, autorange=autorange)
         histograms[name] = True
     value = value if not isinstance(value, Record) else value.data
     ipc.new_data(name, value, data_type="histogram")
 
 normalized_histograms = {}
 def plotNormalizedHistogram(value, weight, hmin=0, hmax=10, bins=10, name=None,
-                          group=None, buffer_length=100):
+                          group=None, buffer_length=100, autorange=False):
+    """Plotting the mean weight of the values in each bin of a histogram, see plotHistogram."""
     if name is None:
         if hasattr(value, "name"):
             name = "Normalized histogram of {0}".format(value.name)
@@ -32,7 +45,7 @@ def plotNormalizedHistogram(value, weight, hmin=0, hmax=10, bins=10, name=None,
         
     if name not in normalized_histograms:
         ipc.broadcast.init_data(name, data_type='normalized_histogram', history_length=buffer_length,
-                                hmin=hmin, hmax=hmax, bins=bins, group=group)
+                                hmin=hmin, hmax=hmax, bins=bins, group=group, autorange=autorange)
         normalized_histograms[name] = True
     value = value if not isinstance(value, Record) else value.data
     weight = weight if not isinstance(weight, Record) else weight.data
@@ -7,7 +7,7 @@ import numpy as np
 import ipc
 
 images = {}
-def plotImage(record, history=10, vmin=None, vmax=None, log=False, mask=None, msg=None, alert=False, name=None, group=None, send_rate=None, roi_center=None, roi_diameters=None):
+def plotImage(record, history=10, vmin=None, vmax=None, log=False, mask=None, msg=None, alert=False, name=None, group=None, send_rate=None, roi_center=None, roi_diameters=None, disk_history=False):
     """Plotting an image.
 
     Args:
@@ -19,6 +19,7 @@ def plotImage(record, history=10, vmin=None, vmax=None, log=False, mask=None, ms
         :vmax(float):   Maximum value
         :log(boolean):  Plot image in log scale (needs restart of GUI, only works with grayscale colormap)
         :mask(boolean or int): Multiply image with mask
+        :disk_history(boolean): Keep the history in a memory-mapped file in the interface, for long histories
     """
     if record is None:
         return
@@ -27,7 +28,7 @@ def plotImage(record, history=10, vmin=None, vmax=None, log=False, mask=None, ms
     else:
         n = name
     if(not n in images):
-        ipc.broadcast.init_data(n, data_type='image', history_length=history, vmin=vmin, vmax=vmax, log=log, group=group)
+        ipc.broadcast.init_data(n, data_type='image', history_length=history, vmin=vmin, vmax=vmax, log=log, group=group, disk_history=disk_history)
         images[n] = True
     image = record.data
     sh = image.shape
@@ -9,7 +9,7 @@ import utils.array
 
 
 histories = {}
-def plotHistory(param, label='', history=100, hline=None, runningHistogram=False, window=20, bins=100, hmin=0, hmax=100, name_extension="", name=None, group=None, **kwargs):
+def plotHistory(param, label='', history=100, hline=None, runningHistogram=False, window=20, bins=100, hmin=0, hmax=100, name_extension="", name=None, group=None, disk_history=False, **kwargs):
     """Plotting history of a parameter.
 
     Args:
@@ -18,6 +18,7 @@ def plotHistory(param, label='', history=100, hline=None, runningHistogram=False
     Kwargs:
         :label(str):     Label for param
         :history(int):   Length of history buffer
+        :disk_history(bool): Keep the history in a memory-mapped file in the interface, for long histories
     """
     if param is None:
         return
@@ -30,7 +31,7 @@ def plotHistory(param, label='', history=100, hline=None, runningHistogram=False
             ipc.broadcast.init_data(name, data_type=data_type, ylabel=label, history_length=history, window=window, bins=bins, hmin=hmin, hmax=hmax, group=group, **kwargs)
         else:
             data_type = 'scalar'
-            ipc.broadcast.init_data(name, data_type=data_type, ylabel=label, history_length=history, hline=hline, group=group, **kwargs)
+            ipc.broadcast.init_data(name, data_type=data_type, ylabel=label, history_length=history, hline=hline, group=group, disk_history=disk_history, **kwargs)
         histories[param.name] = True
     ipc.new_data(name, param.data, hline=hline, **kwargs)
 
@@ -5,6 +5,17 @@
 import numpy
 import logging
 
+def partition_median(x):
+    """Median along the last axis of x, which is partitioned in place. Partitioning around a single
+    position is much faster than around the two middle positions as done by numpy.median."""
+    k = x.shape[-1] // 2
+    x.partition(k, axis=-1)
+    median = x[..., k].astype(numpy.float64)
+    if x.shape[-1] % 2 == 0:
+        median += x[..., :k].max(axis=-1)
+        median /= 2.
+    return median
+
 def slacH5ToCheetah(slacArr):
     out_arr = numpy.zeros((8*185, 4*388))
     for c in range(4):
@@ -43,6 +54,155 @@ def assembleImage(x, y, img=None, nx=None, ny=None, dtype=None, return_indices=F
         assembled = assembled.astype(getattr(numpy, dtype))
     return assembled
 
+class AssemblyPlan(object):
+    """Precomputed plan for assembling detector frames given the pixel maps of a geometry.
+
+    The pixel maps y and x give the row and column in the assembled image of shape `shape`
+    for every pixel of a frame. Leading dimensions of the maps (e.g. panels) are kept, such
+    that a subset of them can be assembled. With binning > 1 the assembled image is reduced
+    by the given factor for display, either by taking the pixels that fall on the reduced
+    grid (mode='sample') or by adding up (mode='sum') or averaging (mode='mean') the pixels
+    that fall into the same bin.
+
+    :func:`assemble` returns a new image for every call, :func:`assemble_batch` writes N frames
+    into one of two preallocated output buffers used in turns."""
+    def __init__(self, y, x, shape, binning=1, mode='sample', dtype=numpy.float32):
+        y = numpy.asarray(y, dtype=numpy.intp)
+        x = numpy.asarray(x, dtype=numpy.intp)
+        assert y.shape == x.shape
+        self.binning = binning
+        self.mode = mode
+        self.dtype = dtype
+        self.frame_shape = y.shape
+        self.shape = (-(-shape[0] // binning), -(-shape[1] // binning))
+        self.size = self.shape[0]*self.shape[1]
+        if mode == 'sample':
+            selected = ((y % binning) == 0) & ((x % binning) == 0)
+        elif mode in ['sum', 'mean']:
+            selected = numpy.ones(y.shape, dtype=bool)
+        else:
+            raise ValueError("Unknown assembly mode %s" % mode)
+        # Pixels of a frame that are assembled and their linear index in the assembled image
+        self._pixels = numpy.flatnonzero(selected)
+        self._indices = numpy.ravel_multi_index((y.ravel()[self._pixels] // binning, x.ravel()[self._pixels] // binning), self.shape)
+        self._all = self._pixels.size == y.size
+        self._norm = None
+        if mode == 'mean':
+            counts = numpy.bincount(self._indices, minlength=self.size).astype(numpy.float64)
+            self._norm = 1. / numpy.maximum(counts, 1)
+        self._buffers = {}
+        self._turn = 0
+        self._subsets = {}
+
+    def _panel_pixels(self, panels):
+        """Returns the selected pixels and their indices of a subset of the leading dimension of the pixel maps"""
+        panels = tuple(panels)
+        if panels in self._subsets:
+            return self._subsets[panels]
+        per_panel = int(numpy.prod(self.frame_shape[1:]))
+        panel = self._pixels // per_panel
+        pixels = []
+        indices = []
+        for i, p in enumerate(panels):
+            selected = panel == p
+            pixels.append(self._pixels[selected] - p*per_panel + i*per_panel)
+            indices.append(self._indices[selected])
+        self._subsets[panels] = (numpy.concatenate(pixels), numpy.concatenate(indices))
+        return self._subsets[panels]
+
+    def _fill(self, out, frames, panels=None):
+        """Assembles frames (shape: N x frame) into out (shape: N x size)"""
+        frames = frames.reshape(frames.shape[0], -1)
+        if panels is None:
+            pixels, indices = (None if self._all else self._pixels), self._indices
+        else:
+            pixels, indices = self._panel_pixels(panels)
+        for i in range(frames.shape[0]):
+            values = frames[i] if pixels is None else frames[i, pixels]
+            if self.mode == 'sample':
+                out[i][indices] = values
+            else:
+                out[i] = numpy.bincount(indices, weights=values, minlength=self.size)
+        if self._norm is not None:
+            out *= self._norm
+
+    def assemble(self, data, panels=None):
+        """Returns a new assembled image of a frame, or only of the given panels (indices of the leading dimension)"""
+        out = numpy.zeros((1, self.size), dtype=self.dtype)
+        self._fill(out, numpy.asarray(data)[numpy.newaxis], panels)
+        return out.reshape(self.shape)
+
+    def assemble_batch(self, frames, panels=None):
+        """Assembles N frames into a preallocated array of shape (N,) + shape and returns it.
+        Two buffers are used in turns, the result is valid until the next but one call."""
+        n = frames.shape[0]
+        if n not in self._buffers:
+            self._buffers[n] = [numpy.zeros((n, self.size), dtype=self.dtype) for i in range(2)]
+        out = self._buffers[n][self._turn]
+        self._turn = 1 - self._turn
+        if panels is not None or self.mode != 'sample':
+            out[:] = 0
+        self._fill(out, frames, panels)
+        return out.reshape((n,) + self.shape)
+
+class RadialIntegrator(object):
+    """Precomputed radial average of detector frames of the given shape around the center (cx, cy).
+
+    Pixels are binned by their distance to the center rounded to multiples of bin_width, pixels that
+    are False in mask are left out. With subpixel=True every pixel is shared between the two nearest
+    bins, proportional to its distance to their radii. Optional weights are multiplied with the
+    frames before averaging, e.g. for a polarisation or solid angle correction.
+
+    :func:`integrate` returns the average of every bin (NaN for empty bins) with a single bincount
+    per frame. The radii of the bins are in :attr:`radii`."""
+    def __init__(self, shape, cx=None, cy=None, mask=None, bin_width=1., subpixel=False, weights=None):
+        self.shape = tuple(shape)
+        if cx is None:
+            cx = (shape[1]-1)/2.
+        if cy is None:
+            cy = (shape[0]-1)/2.
+        y, x = numpy.indices(self.shape, dtype=numpy.float64)
+        r = numpy.sqrt((x - cx)**2 + (y - cy)**2).ravel() / bin_width
+        if mask is None:
+            pixels = numpy.arange(r.size)
+        else:
+            pixels = numpy.flatnonzero(numpy.asarray(mask).ravel())
+        r = r[pixels]
+        if subpixel:
+            lower = numpy.floor(r)
+            fraction = r - lower
+            bins = numpy.concatenate([lower, lower + 1]).astype(numpy.intp)
+            share = numpy.concatenate([1. - fraction, fraction])
+            pixels = numpy.concatenate([pixels, pixels])
+        else:
+            bins = numpy.rint(r).astype(numpy.intp)
+            share = None
+        self.nbins = int(bins.max()) + 1 if bins.size else 0
+        self.radii = numpy.arange(self.nbins) * bin_width
+        norm = numpy.bincount(bins, weights=share, minlength=self.nbins)
+        with numpy.errstate(divide='ignore'):
+            self._norm = numpy.where(norm > 0, 1. / norm, numpy.nan)
+        self._all = (mask is None) and not subpixel
+        self._pixels = pixels
+        self._bins = bins
+        self._weights = share
+        if weights is not None:
+            weights = numpy.asarray(weights, dtype=numpy.float64).ravel()[pixels]
+            self._weights = weights if share is None else weights * share
+
+    def integrate(self, data):
+        """Returns the radial average of a frame (shape: nbins) or a stack of frames (shape: N x nbins)"""
+        data = numpy.asarray(data)
+        frames = data.reshape((-1, self.shape[0]*self.shape[1]))
+        average = numpy.empty((frames.shape[0], self.nbins))
+        for i in range(frames.shape[0]):
+            values = frames[i] if self._all else frames[i, self._pixels]
+            if self._weights is not None:
+                values = values * self._weights
+            average[i] = numpy.bincount(self._bins, weights=values, minlength=self.nbins)
+        average *= self._norm
+        return average[0] if data.ndim == 2 else average
+
 def get2D(data):
     res = numpy.zeros(shape=(data.shape[0]*data.shape[2],data.shape[1]),dtype=data.dtype)
     for i in range(data.shape[2]):
@@ -63,11 +223,18 @@ def runningTrend(array, window, trend):
 
 runningHist = {}
 def runningHistogram(new_data, name, length=100, window=20, bins=100, hmin=0, hmax=100):
+    """Adds a value or an array of values to the running histogram with the given name
+    and returns the last length histograms, see :class:`RunningHistogram`."""
     if name not in runningHist:
         runningHist[name] = RunningHistogram(length=length, window=window, bins=bins, hmin=hmin, hmax=hmax)
     return runningHist[name].next(new_data, length=length, window=window, bins=bins, hmin=hmin, hmax=hmax)
 
 class RunningHistogram:
+    """Histograms of the last window values, one for every added value,
+    of which the last length histograms are kept.
+
+    The counts of the window are updated incrementally by adding the bin of
+    the new value and subtracting the bin of the value that leaves the window."""
     def __init__(self, length=100, window=20, bins=100, hmin=0, hmax=100):
         self.length = length
         self.window = window
@@ -77,36 +244,63 @@ class RunningHistogram:
         self.clear()
 
     def clear(self):
-        self.buffer = numpy.zeros(shape=(self.window, self.bins))
+        self.counts = numpy.zeros(self.bins, dtype="int")
+        self.window_bins = numpy.zeros(self.window, dtype=numpy.intp)
         self.hist   = numpy.zeros(shape=(2*self.length, self.bins), dtype="int")
         self.i = 0
 
-    def next(self, new_value, length=None, window=None, bins=None, hmin=None, hmax=None):
+    def set_parameters(self, length=None, window=None, bins=None, hmin=None, hmax=None):
+        """Updates the given parameters and clears the histograms if any of them changed"""
         reset = False
-        for v in ["length", "window", "bins", "hmin", "hmax"]:
-            exec("if self.%s != %s and %s is not None: reset = True" % (v,v,v))
-            exec("if self.%s != %s and %s is not None: self.%s = %s" % (v,v,v,v,v))
+        for name, value in (("length", length), ("window", window), ("bins", bins), ("hmin", hmin), ("hmax", hmax)):
+            if value is not None and getattr(self, name) != value:
+                setattr(self, name, value)
+                reset = True
         if reset:
             self.clear()
-        # Update buffer
-        i_bin = int(numpy.round((new_value - self.hmin)/float(self.hmax - self.hmin) * (self.bins-1)))
-        if i_bin >= self.bins: 
-            i_bin = self.bins-1
-        if i_bin < 0:
-            i_bin = 0
-        i_buf = self.i % self.window
-        self.buffer[i_buf, :]     = 0
-        self.buffer[i_buf, i_bin] = 1
-        # Update histogram
-        i_his = self.i % self.length
-        s = self.buffer.sum(0)
-        self.hist[i_his, :]               = s[:]
-        self.hist[i_his + self.length, :] = s[:]
-        # Increase counter
-        self.i += 1
-        # Retrun slice
-        sl = self.hist[i_his+1:self.length+i_his+1,:]
-        return sl
+
+    def _bin(self, values):
+        i_bin = numpy.round((values - self.hmin)/float(self.hmax - self.hmin) * (self.bins-1))
+        return numpy.clip(i_bin, 0, self.bins-1).astype(numpy.intp)
+
+    def next(self, new_value, length=None, window=None, bins=None, hmin=None, hmax=None):
+        """Adds a value (or an array of values) and returns the last length histograms, oldest first"""
+        self.set_parameters(length, window, bins, hmin, hmax)
+        return self.extend(numpy.atleast_1d(numpy.asarray(new_value, dtype=numpy.float64)).ravel())
+
+    def extend(self, values):
+        """Adds an array of values and returns the last length histograms, oldest first"""
+        b = self._bin(values)
+        n = b.shape[0]
+        if n:
+            # Bins of the values in the window before this block followed by the new ones,
+            # the k-th new value pushes out the value at position k of this sequence
+            previous = min(self.i, self.window)
+            old = self.window_bins[(self.i - previous + numpy.arange(previous)) % self.window]
+            sequence = numpy.concatenate((old, b))
+            k = numpy.arange(n)
+            leaving = k + previous - self.window
+            # Only the histograms of the last length values are kept
+            skip = max(n - self.length, 0)
+            self.counts += numpy.bincount(b[:skip], minlength=self.bins)
+            self.counts -= numpy.bincount(sequence[leaving[:skip][leaving[:skip] >= 0]], minlength=self.bins)
+            m = n - skip
+            delta = numpy.zeros((m, self.bins), dtype="int")
+            delta[numpy.arange(m), b[skip:]] += 1
+            valid = leaving[skip:] >= 0
+            delta[numpy.arange(m)[valid], sequence[leaving[skip:][valid]]] -= 1
+            rows = self.counts + numpy.cumsum(delta, axis=0)
+            self.counts[:] = rows[-1]
+            i_his = (self.i + skip + numpy.arange(m)) % self.length
+            self.hist[i_his, :] = rows
+            self.hist[i_his + self.length, :] = rows
+            # Remember the bins of the values still in the window
+            last = min(n, self.window)
+            self.window_bins[(self.i + n - last + numpy.arange(last)) % self.window] = b[n-last:]
+            self.i += n
+        # Return slice
+        i_his = (self.i - 1) % self.length
+        return self.hist[i_his+1:self.length+i_his+1,:]
 
 
 def runningMean(x, N):
@@ -0,0 +1,164 @@
+# --------------------------------------------------------------------------------------
+# Copyright 2016, Benedikt J. Daurer, Filipe R.N.C. Maia, Max F. Hantke, Carl Nettelblad
+# Hummingbird is distributed under the terms of the Simplified BSD License.
+# -------------------------------------------------------------------------
+"""Common mode correction of pixel detectors along the lines of their ASICs.
+
+The medians of all lines are computed with a single partition of the lines.
+Excluded pixels of a line with n valid pixels are replaced by -inf and +inf,
+distributed such that the median of the valid pixels ends up in the middle of
+the line, the same position for all lines. The valid pixels and the padding of
+the lines are precomputed from the mask."""
+from __future__ import print_function, absolute_import # Compatibility with python 2 and 3
+import numpy
+from utils.array import partition_median
+
+class CommonMode(object):
+    """Precomputed common mode correction for frames of the given shape.
+
+    The frame is split into a grid of equally sized segments (e.g. grid=(1,2) for the
+    left and right halves of a pnCCD, grid=(2,2) for its quadrants). For every axis in
+    axes, one after the other, the median of the valid pixels of every line of every
+    segment is subtracted (axis=1 for rows, axis=0 for columns).
+
+    Args:
+        :shape(tuple):  Shape of a frame
+
+    Kwargs:
+        :grid(tuple):                   Number of segments along y and x (default = (1,1))
+        :axes(tuple):                   Axes of the lines, corrected in the given order (default = (1,))
+        :mask:                          Boolean mask, pixels that are False are neither used for
+                                        the median nor corrected (default = None, all pixels are valid)
+        :signal_threshold(float):       Only use pixels for the median that are not larger than the
+                                        median of their segment plus this value (default = None)
+        :min_nr_pixels_per_median(int): Lines that do not have more valid pixels than this are
+                                        not corrected, nor are lines without valid pixels (default = 1)
+    """
+    def __init__(self, shape, grid=(1,1), axes=(1,), mask=None, signal_threshold=None, min_nr_pixels_per_median=1):
+        self.shape = tuple(shape)
+        self.grid = tuple(grid)
+        self.axes = tuple(axes)
+        if (self.shape[0] % grid[0]) or (self.shape[1] % grid[1]):
+            raise ValueError("A frame of shape %s can not be split into a grid of %s segments" % (str(shape), str(grid)))
+        if any(axis not in [0, 1] for axis in self.axes):
+            raise ValueError("Invalid axes %s" % str(axes))
+        self.segment = (self.shape[0] // grid[0], self.shape[1] // grid[1])
+        self.signal_threshold = signal_threshold
+        self.min_pixels = max(min_nr_pixels_per_median, 0)
+        self.mask = None
+        if mask is not None:
+            self.mask = numpy.asarray(mask, dtype=bool)
+            assert self.mask.shape == self.shape
+        self._lines = {}
+        self._plans = {}
+        for axis in self.axes:
+            self._plans[axis] = self._plan(axis)
+
+    def _blocks(self, data):
+        """View of frames with shape (N, gy, h, gx, w)"""
+        return data.reshape((-1, self.grid[0], self.segment[0], self.grid[1], self.segment[1]))
+
+    def _order(self, axis):
+        """Transposition of the blocks into segments of lines along axis"""
+        return (0, 1, 3, 2, 4) if axis == 1 else (0, 1, 3, 4, 2)
+
+    def _plan(self, axis):
+        """Precomputes the valid pixels of every line and the positions of the padding for their median"""
+        length = self.segment[1] if axis == 1 else self.segment[0]
+        # The upper of the two middle positions, the lower one is the maximum of the pixels before it
+        plan = {'length': length, 'kth': min((length-1)//2 + 1, length-1)}
+        if self.mask is None:
+            plan['valid'] = None
+            return plan
+        valid = self._blocks(self.mask).transpose(self._order(axis)).reshape((-1, length))
+        plan['valid'] = valid
+        plan['n'], low, high = self._padding(valid)
+        # Linear indices of the padded pixels within a frame
+        plan['low'] = numpy.flatnonzero(low)
+        plan['high'] = numpy.flatnonzero(high)
+        return plan
+
+    def _padding(self, valid):
+        """Returns the number of valid pixels of the lines and where to put -inf and +inf"""
+        length = valid.shape[-1]
+        n = valid.sum(axis=-1)
+        # Number of -inf, puts the median of the valid pixels in the middle of the line
+        below = (length-1)//2 - (n-1)//2
+        invalid = ~valid
+        low = invalid & (numpy.cumsum(invalid, axis=-1, dtype=numpy.int32) <= below[..., None])
+        high = invalid & ~low
+        return n, low, high
+
+    def _work(self, nframes, axis, dtype):
+        """Reused buffer for the lines of nframes frames"""
+        key = (nframes, axis, dtype)
+        if key not in self._lines:
+            h, w = self.segment
+            shape = (nframes, self.grid[0], self.grid[1]) + ((h, w) if axis == 1 else (w, h))
+            self._lines[key] = numpy.empty(shape, dtype=dtype)
+        return self._lines[key]
+
+    def line_medians(self, data, axis):
+        """Returns the medians of the lines along axis of every segment of frames with shape (N, ny, nx),
+        with shape (N, gy*gx*nr. of lines) and zero for lines that are not corrected"""
+        plan = self._plans[axis] if axis in self._plans else self._plan(axis)
+        nframes = data.shape[0]
+        lines = self._work(nframes, axis, numpy.result_type(data.dtype, numpy.float32))
+        numpy.copyto(lines, self._blocks(data).transpose(self._order(axis)), casting='unsafe')
+        length = plan['length']
+        if self.signal_threshold is not None:
+            segments = lines.reshape((nframes, self.grid[0]*self.grid[1], -1))
+            median = partition_median(segments.copy())
+            valid = segments <= (median + self.signal_threshold)[..., None]
+            valid = valid.reshape((nframes, -1, length))
+            if plan['valid'] is not None:
+                valid &= plan['valid']
+            n, low, high = self._padding(valid)
+            lines = lines.reshape(valid.shape)
+            numpy.copyto(lines, -numpy.inf, where=low)
+            numpy.copyto(lines, numpy.inf, where=high)
+        else:
+            lines = lines.reshape((nframes, -1, length))
+            if plan['valid'] is not None:
+                flat = lines.reshape((nframes, -1))
+                flat[:, plan['low']] = -numpy.inf
+                flat[:, plan['high']] = numpy.inf
+                n = plan['n'][None, :]
+            else:
+                n = numpy.full((1, lines.shape[1]), length)
+        k = plan['kth']
+        lines.partition(k, axis=-1)
+        if k > 0:
+            cm = lines[..., :k].max(axis=-1).astype(numpy.float64)
+        else:
+            cm = lines[..., 0].astype(numpy.float64)
+        # Lines without valid pixels only contain the padding, they are never corrected
+        skip = numpy.broadcast_to((n == 0) | (n <= self.min_pixels), cm.shape)
+        even = numpy.broadcast_to((n % 2) == 0, cm.shape) & ~skip
+        cm[even] = 0.5*(cm[even] + lines[..., k][even])
+        cm[skip] = 0.
+        return cm
+
+    def correct(self, data):
+        """Subtracts the common mode from a frame (ny, nx) or frames (N, ny, nx) in place
+        and returns the corrected data."""
+        data = numpy.asarray(data)
+        if data.shape[-2:] != self.shape or data.ndim not in [2, 3]:
+            raise ValueError("Expected frames of shape %s, got %s" % (str(self.shape), str(data.shape)))
+        if not data.flags['C_CONTIGUOUS']:
+            raise ValueError("Common mode correction in place needs C-contiguous data")
+        blocks = self._blocks(data)
+        nframes = blocks.shape[0]
+        gy, gx = self.grid
+        h, w = self.segment
+        for axis in self.axes:
+            cm = self.line_medians(blocks, axis).astype(data.dtype)
+            if axis == 1:
+                cm = cm.reshape((nframes, gy, gx, h)).transpose(0, 1, 3, 2)[..., None]
+            else:
+                cm = cm.reshape((nframes, gy, gx, w))[:, :, None, :, :]
+            if self.mask is None:
+                blocks -= cm
+            else:
+                numpy.subtract(blocks, cm, out=blocks, where=self._blocks(self.mask))
+        return data
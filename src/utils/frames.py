@@ -0,0 +1,55 @@
+# --------------------------------------------------------------------------------------
+# Copyright 2016, Benedikt J. Daurer, Filipe R.N.C. Maia, Max F. Hantke, Carl Nettelblad
+# Hummingbird is distributed under the terms of the Simplified BSD License.
+# -------------------------------------------------------------------------
+"""Binary framing of numpy arrays sent from the backend to the interface.
+
+Every array is sent as two frames, a fixed size header followed by the raw
+array buffer, such that neither side needs to copy or parse the data."""
+import struct
+import hashlib
+import numpy
+
+MAX_NDIM = 8
+MAGIC = b'HBA1'
+# magic, ndim, dtype, shape, strides, event_id, md5 of title
+_header = struct.Struct('<4sB3x16s%dq%dqd16s' % (MAX_NDIM, MAX_NDIM))
+HEADER_SIZE = _header.size
+
+def title_hash(title):
+    """Returns the md5 digest of a broadcast title, which is also used as the zmq key"""
+    m = hashlib.md5()
+    m.update(title.encode('UTF-8'))
+    return m.digest()
+
+def sendable(array):
+    """Returns the array or a contiguous copy of it if the buffer can not be sent as is"""
+    if array.dtype.hasobject:
+        raise ValueError('Cannot broadcast arrays with dtype=object')
+    if array.ndim > MAX_NDIM:
+        raise ValueError('Cannot broadcast arrays with more than %d dimensions' % MAX_NDIM)
+    if not (array.flags['C_CONTIGUOUS'] or array.flags['F_CONTIGUOUS']):
+        array = numpy.ascontiguousarray(array)
+    return array
+
+def encode_header(array, event_id=0., key=b''):
+    """Returns the header frame describing array. key is the title hash of the broadcast."""
+    pad = [0]*(MAX_NDIM-array.ndim)
+    return _header.pack(MAGIC, array.ndim, array.dtype.str.encode('ascii'),
+                        *(list(array.shape) + pad + list(array.strides) + pad + [event_id, key]))
+
+def decode_header(header):
+    """Returns dtype, shape, strides, event_id and the title hash given a header frame"""
+    fields = _header.unpack(header)
+    if fields[0] != MAGIC:
+        raise ValueError('Not a valid array header')
+    ndim = fields[1]
+    dtype = numpy.dtype(fields[2].rstrip(b'\x00').decode('ascii'))
+    shape = tuple(fields[3:3+ndim])
+    strides = tuple(fields[3+MAX_NDIM:3+MAX_NDIM+ndim])
+    return dtype, shape, strides, fields[-2], fields[-1]
+
+def decode_array(header, buf):
+    """Returns an array that wraps the received buffer without copying it"""
+    dtype, shape, strides, event_id, key = decode_header(header)
+    return numpy.ndarray(shape=shape, dtype=dtype, buffer=buf, strides=strides)
@@ -0,0 +1,258 @@
+# --------------------------------------------------------------------------------------
+# Copyright 2016, Benedikt J. Daurer, Filipe R.N.C. Maia, Max F. Hantke, Carl Nettelblad
+# Hummingbird is distributed under the terms of the Simplified BSD License.
+# -------------------------------------------------------------------------
+"""Diffraction of homogeneous spheres and fast sizing of spheres from radial averages.
+
+All quantities are in SI units. The scattering power of a material is given by its
+electron density, i.e. the forward scattering factors are approximated by the
+atomic numbers (no anomalous scattering)."""
+from __future__ import print_function, absolute_import # Compatibility with python 2 and 3
+import numpy
+
+# Physical constants
+h = 6.62606957e-34 #[Js]
+c = 299792458 #[m/s]
+hc = h*c  #[Jm]
+r_e = 2.8179403267e-15 #[m] classical electron radius
+u = 1.660538921e-27 #[kg] atomic mass unit
+
+# Atomic number and mass [u]
+ATOMS = {'H': (1, 1.008), 'C': (6, 12.011), 'N': (7, 14.007), 'O': (8, 15.999),
+         'P': (15, 30.974), 'S': (16, 32.06), 'Au': (79, 196.967)}
+
+# Atomic composition and mass density [kg/m3] of materials
+MATERIALS = {
+    'protein':    ({'H': 86, 'C': 52, 'N': 13, 'O': 15, 'S': 0.3}, 1350),
+    'virus':      ({'H': 72.43, 'C': 47.52, 'N': 13.55, 'O': 17.08, 'P': 1.11, 'S': 0.27}, 1455),
+    'poliovirus': ({'H': 492388, 'C': 332652, 'N': 98245, 'O': 131196, 'P': 7501, 'S': 2340}, 1340),
+    'cell':       ({'H': 23, 'C': 3, 'N': 1, 'O': 10, 'S': 1}, 1000),
+    'dna':        ({'H': 11, 'C': 10, 'N': 4, 'O': 6, 'P': 1}, 1700),
+    'lipid':      ({'H': 69, 'C': 36, 'O': 6, 'P': 1}, 1000),
+    'latexball':  ({'H': 8, 'C': 8}, 1050),
+    'water':      ({'H': 2, 'O': 1}, 995),
+    'sucrose':    ({'H': 22, 'C': 12, 'O': 11}, 1587),
+    'gold':       ({'Au': 1}, 19320),
+}
+
+def electron_density(material):
+    """Returns the electron density [1/m3] of a material given by name or as a number"""
+    if not isinstance(material, str):
+        return float(material)
+    if material not in MATERIALS:
+        raise ValueError("Unknown material %s, choose from %s or give the electron density" % (material, ", ".join(sorted(MATERIALS))))
+    composition, density = MATERIALS[material]
+    electrons = sum(n*ATOMS[a][0] for a, n in composition.items())
+    mass = sum(n*ATOMS[a][1] for a, n in composition.items())*u
+    return density*electrons/mass
+
+def form_factor_squared(x):
+    """Returns the squared form factor of a sphere normalised to 1 at x = q*R = 0"""
+    x = numpy.asarray(x, dtype=numpy.float64)
+    small = x < 1e-3
+    x = numpy.where(small, 1., x)
+    f = 3*(numpy.sin(x) - x*numpy.cos(x))/x**3
+    return numpy.where(small, 1., f*f)
+
+def momentum_transfer(r, wavelength, pixelsize, distance):
+    """Returns the momentum transfer q = 4 pi sin(theta)/wavelength [1/m] at a distance of r pixels from the center"""
+    two_theta = numpy.arctan(numpy.asarray(r)*pixelsize/distance)
+    return 4*numpy.pi*numpy.sin(two_theta/2.)/wavelength
+
+def photons_per_pixel(r, diameter, wavelength, pixelsize, distance, material):
+    """Returns the number of photons scattered by a sphere into a pixel at a distance of r pixels from the
+    center per fluence of 1 J/m2 (without polarisation), with a leading axis for an array of diameters"""
+    diameter = numpy.asarray(diameter, dtype=numpy.float64)
+    radius = diameter[..., numpy.newaxis]/2.
+    r = numpy.asarray(r, dtype=numpy.float64)
+    q = momentum_transfer(r, wavelength, pixelsize, distance)
+    volume = 4/3.*numpy.pi*radius**3
+    two_theta = numpy.arctan(r*pixelsize/distance)
+    solid_angle = (pixelsize/distance)**2*numpy.cos(two_theta)**3
+    amplitude = r_e*electron_density(material)*volume
+    return wavelength/hc * amplitude**2 * form_factor_squared(q*radius) * solid_angle
+
+class SphereSizer(object):
+    """Precomputed sizing of spheres from radial averages of diffraction patterns of the given shape.
+
+    The radial average around the center (cx, cy) of the valid pixels within mask_radius is compared
+    (Pearson correlation over all pixels) to a table of sphere models for a grid of diameters, the best
+    diameter is then refined by Newton steps on the correlation. The intensity [J/m2] follows from the
+    number of photons, as for the 'nrphotons' method of libspimage. All frames of a stack are fitted at once.
+The center, diameter and intensity can then be refined on the full model of the valid pixels (:meth:`refine`).
+
+    Pixels are averaged in bins of 1 px of their distance to the center. The model of a bin is the
+    average over sub-bins of 1/subsampling px, such that it matches the average over its pixels.
+
+    Args:
+        :shape(tuple):        Shape of a frame
+        :diameters:           Grid of diameters [m] for the table of models
+
+    Kwargs:
+        :cx(float):           Center in x [px] (default = middle)
+        :cy(float):           Center in y [px] (default = middle)
+        :mask:                Boolean mask of valid pixels (default = None, all pixels are valid)
+        :mask_radius(float):  Only pixels within this radius [px] are used (default = None, all pixels)
+        :wavelength(float):   Photon wavelength [m] (default = 1E-9)
+        :pixelsize(float):    Side length of a pixel [m] (default = 110E-6)
+        :distance(float):     Distance from interaction to detector [m] (default = 1.)
+        :material:            Material of the spheres or its electron density [1/m3] (default = 'virus')
+        :quantum_efficiency(float): Quantum efficiency of the detector (default = 1)
+        :subsampling(int):    Number of sub-bins per bin for the models (default = 8)
+    """
+    def __init__(self, shape, diameters, cx=None, cy=None, mask=None, mask_radius=None, wavelength=1E-9,
+                 pixelsize=110E-6, distance=1., material='virus', quantum_efficiency=1., subsampling=8):
+        self.shape = tuple(shape)
+        if cx is None:
+            cx = (shape[1]-1)/2.
+        if cy is None:
+            cy = (shape[0]-1)/2.
+        y, x = numpy.indices(self.shape)
+        r = numpy.sqrt((x - cx)**2 + (y - cy)**2).ravel()
+        valid = numpy.ones(r.size, dtype=bool) if mask is None else numpy.array(mask, dtype=bool).ravel()
+        if mask_radius is not None:
+            valid &= r <= mask_radius
+        self._pixels = numpy.flatnonzero(valid)
+        # Positions of the valid pixels relative to the center
+        self._x = (x.ravel() - cx)[self._pixels]
+        self._y = (y.ravel() - cy)[self._pixels]
+        r = r[self._pixels]
+        fine = numpy.floor(r*subsampling + subsampling//2).astype(numpy.intp)
+        coarse = fine // subsampling
+        self.nbins = int(coarse.max()) + 1 if coarse.size else 0
+        self._coarse = coarse
+        counts = numpy.bincount(coarse, minlength=self.nbins).astype(numpy.float64)
+        fine_counts = numpy.bincount(fine, minlength=self.nbins*subsampling).astype(numpy.float64)
+        # Bins with pixels, their mean radius and their share of the valid pixels
+        self._bins = numpy.flatnonzero(counts)
+        self._counts = counts
+        self.r = (numpy.bincount(coarse, weights=r, minlength=self.nbins) / numpy.maximum(counts, 1))[self._bins]
+        self._weight = counts[self._bins] / counts[self._bins].sum()
+        self._fine_r = numpy.bincount(fine, weights=r, minlength=self.nbins*subsampling) / numpy.maximum(fine_counts, 1)
+        self._fine_share = (fine_counts.reshape((self.nbins, subsampling)) / numpy.maximum(counts, 1)[:, numpy.newaxis])[self._bins]
+        self._fine_r = self._fine_r.reshape((self.nbins, subsampling))[self._bins]
+        self._geometry = (wavelength, pixelsize, distance, material, quantum_efficiency)
+        self.diameters = numpy.asarray(diameters, dtype=numpy.float64)
+        self.table = self.model(self.diameters)
+        self._normalised_table = self._normalise(self.table)
+
+    def model(self, diameters):
+        """Returns the radial averages of the number of detected photons per fluence of 1 J/m2 for the
+        given diameters [m], with shape (nr. of diameters, nr. of radii :attr:`r`)"""
+        wavelength, pixelsize, distance, material, quantum_efficiency = self._geometry
+        diameters = numpy.atleast_1d(diameters)
+        photons = photons_per_pixel(self._fine_r.ravel(), diameters, wavelength, pixelsize, distance, material)
+        photons = photons.reshape((diameters.size,) + self._fine_r.shape)
+        return quantum_efficiency*(photons*self._fine_share).sum(axis=-1)
+
+    def _normalise(self, profiles):
+        """Profiles with zero weighted mean and unit weighted norm"""
+        centered = profiles - (profiles*self._weight).sum(axis=-1)[..., numpy.newaxis]
+        centered *= numpy.sqrt(self._weight)
+        norm = numpy.sqrt((centered**2).sum(axis=-1))[..., numpy.newaxis]
+        return centered / numpy.where(norm > 0, norm, 1.)
+
+    def _correlation(self, normalised, diameters):
+        """Pearson correlation of normalised profiles (N x nbins) with the models for N diameters"""
+        return (normalised*self._normalise(self.model(diameters))).sum(axis=-1)
+
+    def profiles(self, frames):
+        """Returns the radial averages of a frame or a stack of frames at the radii :attr:`r`"""
+        frames = numpy.asarray(frames)
+        frames = frames.reshape((-1, self.shape[0]*self.shape[1]))
+        out = numpy.empty((frames.shape[0], self._bins.size))
+        for i in range(frames.shape[0]):
+            out[i] = numpy.bincount(self._coarse, weights=frames[i, self._pixels], minlength=self.nbins)[self._bins]
+        out /= self._counts[self._bins]
+        return out
+
+    def fit(self, frames, newton_steps=3):
+        """Fits a frame or a stack of frames given in photons. Returns arrays with the diameter [m],
+        intensity [J/m2], the Pearson correlation of the fit and the relative error of the fitted radial
+        average for every frame."""
+        p = self.profiles(frames)
+        normalised = self._normalise(p)
+        correlation = normalised.dot(self._normalised_table.T)
+        best = numpy.argmax(correlation, axis=1)
+        diameter = self.diameters[best]
+        step = numpy.diff(self.diameters).mean() if self.diameters.size > 1 else diameter.mean()*1e-3
+        # Parabola through the best grid point and its neighbours
+        rows = numpy.flatnonzero((best > 0) & (best < self.diameters.size-1))
+        c0 = correlation[rows, best[rows]-1]
+        c1 = correlation[rows, best[rows]]
+        c2 = correlation[rows, best[rows]+1]
+        curvature = c0 - 2*c1 + c2
+        shift = numpy.where(curvature < 0, 0.5*(c0 - c2)/numpy.where(curvature < 0, curvature, -1.), 0.)
+        diameter[rows] += numpy.clip(shift, -1, 1)*step
+        # Newton steps on the correlation, with derivatives from finite differences
+        d = step/10.
+        for i in range(newton_steps):
+            cm = self._correlation(normalised, diameter - d)
+            cc = self._correlation(normalised, diameter)
+            cp = self._correlation(normalised, diameter + d)
+            curvature = (cp - 2*cc + cm)/d**2
+            slope = (cp - cm)/(2*d)
+            update = numpy.where(curvature < 0, -slope/numpy.where(curvature < 0, curvature, -1.), 0.)
+            diameter = numpy.maximum(diameter + numpy.clip(update, -step, step), d)
+        model = self.model(diameter)
+        # Intensity from the number of photons
+        intensity = (p*self._weight).sum(axis=1) / (model*self._weight).sum(axis=1)
+        fit = intensity[:, numpy.newaxis]*model
+        error = numpy.sqrt(((p - fit)**2*self._weight).sum(axis=1) / numpy.maximum((p**2*self._weight).sum(axis=1), 1e-300))
+        return diameter, intensity, self._correlation(normalised, diameter), error
+
+    def _model_2d(self, shift_x, shift_y, diameter, derivatives=False):
+        """The number of detected photons per fluence of 1 J/m2 in the valid pixels for the center shifted by
+        (shift_x, shift_y) px and the given diameter [m], optionally with the derivatives by the shifts and
+        the diameter from finite differences"""
+        wavelength, pixelsize, distance, material, quantum_efficiency = self._geometry
+        x = self._x - shift_x
+        y = self._y - shift_y
+        r = numpy.sqrt(x**2 + y**2)
+        if not derivatives:
+            return quantum_efficiency*photons_per_pixel(r, diameter, wavelength, pixelsize, distance, material)
+        dr = 1e-3
+        dd = diameter*1e-4
+        m = quantum_efficiency*photons_per_pixel(numpy.array([r, r + dr]), diameter, wavelength, pixelsize, distance, material)
+        md = quantum_efficiency*photons_per_pixel(r, diameter + dd, wavelength, pixelsize, distance, material)
+        slope = (m[1] - m[0]) / dr / numpy.where(r > 0, r, numpy.inf)
+        return m[0], -slope*x, -slope*y, (md - m[0])/dd
+
+    def refine(self, frames, diameter, intensity, shift_x=0., shift_y=0., steps=3):
+        """Refines the center, diameter [m] and intensity [J/m2] of a frame or a stack of frames given in photons
+        by Gauss-Newton steps on the model of the valid pixels, as the full model fit of libspimage.
+        Returns arrays with the shifts of the center in x and y [px] from (cx, cy), the diameter, the intensity
+        and the reduced chi-squared of the model for every frame."""
+        frames = numpy.asarray(frames, dtype=numpy.float64).reshape((-1, self.shape[0]*self.shape[1]))[:, self._pixels]
+        params = numpy.zeros((frames.shape[0], 4))
+        params[:, 0] = shift_x
+        params[:, 1] = shift_y
+        params[:, 2] = diameter
+        params[:, 3] = intensity
+        error = numpy.empty(frames.shape[0])
+        dof = max(frames.shape[1] - 4, 1)
+        for i in range(frames.shape[0]):
+            p = params[i]
+            chi2 = ((frames[i] - p[3]*self._model_2d(*p[:3]))**2).sum()
+            for j in range(steps):
+                m, mx, my, md = self._model_2d(*p[:3], derivatives=True)
+                # Columns scaled to unit norm, as the parameters differ by orders of magnitude
+                J = numpy.array([p[3]*mx, p[3]*my, p[3]*md, m]).T
+                scale = numpy.sqrt((J**2).sum(axis=0))
+                scale[scale == 0] = 1.
+                update = numpy.linalg.lstsq(J/scale, frames[i] - p[3]*m, rcond=None)[0]/scale
+                update[:2] = numpy.clip(update[:2], -1., 1.)
+                update[2] = numpy.clip(update[2], -0.1*p[2], 0.1*p[2])
+                # Halve the step until the fit improves
+                for k in range(5):
+                    q = p + update
+                    qchi2 = ((frames[i] - q[3]*self._model_2d(*q[:3]))**2).sum()
+                    if qchi2 <= chi2:
+                        break
+                    update /= 2.
+                else:
+                    break
+                p, chi2 = q, qchi2
+            params[i] = p
+            error[i] = chi2 / dof
+        return params[:, 0], params[:, 1], params[:, 2], params[:, 3], error
@@ -111,6 +111,326 @@ def test_hitfinding_countLitPixels():
     assert (evt['analysis']['litpixel: isMiss'].data == 0)
     assert (evt['analysis']['litpixel: hitscore'].data == 128*128)
 
+# Testing count lit pixels for a stack of frames against single frames
+def test_hitfinding_countLitPixelsBatch():
+    from backend import Record
+    evt = DummyTranslator(state).next_event()
+    frames = np.random.randint(0, 40, size=(7, 32, 16)).astype(np.float32)
+    frames[3] = 0
+    mask = np.random.random((32, 16)) > 0.3
+    hit = analysis.hitfinding.countLitPixelsBatch(evt, Record('stack', frames), aduThreshold=20, hitscoreThreshold=150,
+                                                  valid=analysis.hitfinding.validPixels(mask), chunk=100)
+    for i in range(frames.shape[0]):
+        analysis.hitfinding.countLitPixels(evt, Record('frame', frames[i]), aduThreshold=20, hitscoreThreshold=150,
+                                           mask=mask, outkey='single: ')
+        assert evt['analysis']['litpixel: hitscore'].data[i] == evt['analysis']['single: hitscore'].data
+        assert evt['analysis']['litpixel: isHit'].data[i] == evt['analysis']['single: isHit'].data
+        assert evt['analysis']['litpixel: isMiss'].data[i] == evt['analysis']['single: isMiss'].data
+        assert hit[i] == evt['analysis']['single: isHit'].data
+
+# Testing that gated stages of a pipeline and their dependents are skipped, and lazy stages only run when needed
+def test_pipeline_gating():
+    from backend import Pipeline, add_record
+    pipeline = Pipeline()
+    calls = []
+    @pipeline.stage()
+    def hitfinding(evt):
+        analysis.hitfinding.countLitPixels(evt, evt['photonPixelDetectors'][evt['detector']], aduThreshold=20, hitscoreThreshold=200)
+    @pipeline.stage(after=['hitfinding'], gate='litpixel: isHit', lazy=True, outputs=['size'])
+    def sizing(evt):
+        calls.append('sizing')
+        add_record(evt['analysis'], 'analysis', 'size', 42.)
+    @pipeline.stage(after=['sizing'])
+    def plots(evt):
+        calls.append('plots')
+    @pipeline.stage(after=['sizing'], gate=lambda evt: evt['analysis']['size'].data > 40)
+    def saving(evt):
+        calls.append('saving')
+    for detector in ['CCDlow', 'CCDstrong', 'CCDlow']:
+        evt = DummyTranslator(state).next_event()
+        evt['detector'] = detector
+        pipeline(evt)
+    assert calls == ['plots', 'sizing', 'saving']
+    stages = dict((s.name, s) for s in pipeline.stages)
+    assert (stages['hitfinding'].runs, stages['sizing'].runs, stages['plots'].runs) == (3, 1, 1)
+    assert (stages['sizing'].gated, stages['plots'].skipped) == (2, 2)
+    assert 'sizing' in pipeline.report()
+
+# Testing that a lazy stage which does not add its output gives None instead of recursing
+def test_pipeline_lazy_missing_output():
+    from backend import Pipeline
+    pipeline = Pipeline()
+    values = []
+    @pipeline.stage(lazy=True, outputs=['x'])
+    def forgetful(evt):
+        pass
+    @pipeline.stage(after=['forgetful'])
+    def reader(evt):
+        values.append(evt['analysis']['x'].data)
+    evt = DummyTranslator(state).next_event()
+    pipeline(evt)
+    assert values == [None]
+    assert evt['analysis']['x'].data is None
+
+# Testing that scalars are batched per title and keywords, and sent on their own if their keywords can not be compared
+def test_broadcast_scalar_batches(monkeypatch):
+    import ipc.broadcast
+    sent = []
+    monkeypatch.setattr(ipc.broadcast, '_send', lambda title, data: sent.append((data[1], list(np.atleast_1d(data[3])), data[5])))
+    ipc.broadcast._add_to_batch('x', 1., 0, {'unit': 'nm'})
+    ipc.broadcast._add_to_batch('x', 2., 1, {'unit': 'nm'})
+    ipc.broadcast._add_to_batch('x', 3., 2, {'vline': np.array([1, 2])})
+    ipc.broadcast._add_to_batch('x', 4., 3, {'unit': 'px'})
+    ipc.broadcast._add_to_batch('x', 5., 4, {'unit': 'px'})
+    ipc.broadcast.flush(force=True)
+    assert [(m, v) for m, v, k in sent] == [('new_data_batch', [1., 2.]), ('new_data', [3.]), ('new_data_batch', [4., 5.])]
+    assert not ipc.broadcast._scalar_batches
+
+# Testing the common mode correction of pnCCD quadrants against the correction of one quadrant and axis at a time
+def test_common_mode_pnccd():
+    import analysis.pixel_detector
+    from backend import Record
+    data = np.random.normal(0, 1, (3, 16, 12)) + np.random.normal(0, 5, (3, 16, 1)) + (np.random.random((3, 16, 12)) > 0.9)*30
+    mask = np.random.random((16, 12)) > 0.3
+    evt = {'photonPixelDetectors': {'CCD': Record('CCD', data)}, 'analysis': {}}
+    analysis.pixel_detector.commonModePNCCD2(evt, 'photonPixelDetectors', 'CCD', signal_threshold=5., mask=mask, min_nr_pixels_per_median=2)
+    for i in range(data.shape[0]):
+        expected = data[i].copy()
+        for quad in [np.s_[:8,:6], np.s_[8:,:6], np.s_[:8,6:], np.s_[8:,6:]]:
+            for axis in [0, 1]:
+                analysis.pixel_detector._cmc(expected[quad], msk=mask[quad], axis=axis, signal_threshold=5., min_nr_pixels_per_median=2)
+        assert np.allclose(evt['analysis']['corrected - CCD'].data[i], expected)
+
+# Testing that lines without pixels below the signal threshold are not corrected, even without a minimum number of pixels
+def test_common_mode_empty_lines():
+    import warnings
+    import analysis.pixel_detector
+    from backend import Record
+    data = np.random.normal(0, 1, (2, 16, 12))
+    data[:, 3, :6] += 100
+    evt = {'photonPixelDetectors': {'CCD': Record('CCD', data.copy())}, 'analysis': {}}
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        analysis.pixel_detector.commonModePNCCD(evt, 'photonPixelDetectors', 'CCD', signal_threshold=5., min_nr_pixels_per_median=0)
+    corrected = evt['analysis']['corrected - CCD'].data
+    assert np.array_equal(corrected[:, 3, :6], data[:, 3, :6])
+    assert np.allclose(corrected[:, 3, 6:], data[:, 3, 6:] - np.median(data[:, 3, 6:], axis=-1)[:, None])
+
+# Testing the radial average against averaging the pixels of every rounded radius
+def test_pixel_detector_radial():
+    import analysis.pixel_detector
+    from backend import Record
+    image = np.random.random((30, 40))
+    mask = np.random.random((30, 40)) > 0.2
+    evt = {'analysis': {}}
+    analysis.pixel_detector.radial(evt, Record('CCD', np.array([image, 2*image])), mask=mask, cx=12.3, cy=17.6, key='CCD')
+    y, x = np.indices(image.shape)
+    r = np.rint(np.sqrt((x-12.3)**2 + (y-17.6)**2))
+    radii = np.unique(r[mask])
+    expected = np.array([image[mask & (r == ri)].mean() for ri in radii])
+    assert np.array_equal(evt['analysis']['radial distance - CCD'].data, radii)
+    assert np.allclose(evt['analysis']['radial average - CCD'].data, [expected, 2*expected])
+
+# Testing the radial sphere sizing of a stack of simulated sphere patterns
+def test_sizing_fitSphereFast():
+    import analysis.sizing
+    from utils.sphere_model import photons_per_pixel
+    from backend import Record
+    y, x = np.indices((64, 64))
+    r = np.sqrt((x - 32.7)**2 + (y - 30.3)**2)
+    diameters = np.array([60e-9, 85e-9, 110e-9])
+    intensities = np.array([1., 2., 3.])*1e-3/1e-12
+    frames = np.array([i*photons_per_pixel(r, d, 0.12398e-9, 880e-6, 2.16, 'virus') for d, i in zip(diameters, intensities)])
+    mask = np.ones((64, 64), dtype=bool)
+    mask[28:34] = False
+    evt = {'photonPixelDetectors': {'CCD': Record('CCD', 10*frames)}, 'analysis': {}}
+    analysis.sizing.fitSphereFast(evt, 'photonPixelDetectors', 'CCD', mask=mask, x0=1., y0=-1., d0=80, wavelength=0.12398, pixelsize=880,
+                                  distance=2160, adu_per_photon=10, photon_counting=False, mask_radius=30)
+    assert np.allclose(evt['analysis']['diameter'].data, diameters*1e9, rtol=1e-3)
+    assert np.allclose(evt['analysis']['intensity'].data, [1., 2., 3.], rtol=1e-3)
+    assert np.allclose(evt['analysis']['offCenterX'].data, 1.2, atol=1e-3) and np.allclose(evt['analysis']['offCenterY'].data, -1.2, atol=1e-3)
+    assert np.allclose(evt['analysis']['cx'].data, 32.7, atol=1e-3) and np.allclose(evt['analysis']['cy'].data, 30.3, atol=1e-3)
+    assert np.all(evt['analysis']['error'].data < 1e-3)
+
+# Testing that the error of fitSphereFast is the reduced chi-squared of the full model, as for fitSphere,
+# which is at most the one of the true model for a noisy pattern
+def test_sizing_fitSphereFast_error():
+    import analysis.sizing
+    from utils.sphere_model import photons_per_pixel
+    from backend import Record
+    np.random.seed(0)
+    y, x = np.indices((64, 64))
+    r = np.sqrt((x - 31.7)**2 + (y - 31.2)**2)
+    model = 2e9*photons_per_pixel(r, 85e-9, 0.12398e-9, 880e-6, 2.16, 'virus')
+    data = np.random.poisson(model)
+    evt = {'photonPixelDetectors': {'CCD': Record('CCD', data)}, 'analysis': {}}
+    analysis.sizing.fitSphereFast(evt, 'photonPixelDetectors', 'CCD', d0=80, wavelength=0.12398, pixelsize=880,
+                                  distance=2160, mask_radius=30)
+    assert np.isclose(evt['analysis']['diameter'].data, 85, rtol=1e-2)
+    assert np.isclose(evt['analysis']['intensity'].data, 2, rtol=2e-2)
+    assert abs(evt['analysis']['offCenterX'].data - 0.2) < 0.05 and abs(evt['analysis']['offCenterY'].data + 0.3) < 0.05
+    valid = (x - 31.5)**2 + (y - 31.5)**2 <= 30**2
+    chi2 = ((data - model)[valid]**2).sum() / (valid.sum() - 4)
+    assert 0.8*chi2 < evt['analysis']['error'].data <= chi2
+
+# Testing the Patterson maps and multiple scores of a stack against the shifted inverse FFT of every image
+def test_patterson_pattersonFast():
+    import analysis.patterson
+    from backend import Record
+    images = np.random.poisson(5, (3, 40, 41)).astype(np.float64)
+    mask = np.random.random((40, 41)) > 0.1
+    evt = {'photonPixelDetectors': {'CCD': Record('CCD', images)}, 'analysis': {}}
+    analysis.patterson.pattersonFast(evt, 'photonPixelDetectors', 'CCD', mask=mask, threshold=2., diameter_pix=8,
+                                     xgap_pix=3, frame_pix=2, single_precision=False)
+    Y, X = np.indices((40, 41))
+    excluded = ((X-20)**2 + (Y-20)**2 > 16)
+    excluded[19:21] = False
+    excluded[:2] = excluded[-2:] = excluded[:, :2] = excluded[:, -2:] = False
+    for i in range(3):
+        P = abs(np.fft.fftshift(np.fft.ifftn(np.fft.ifftshift(images[i]*mask))))
+        P /= np.median(P)
+        assert np.allclose(evt['analysis']['patterson'].data[i], P)
+        assert evt['analysis']['multiple score'].data[i] == ((P > 2.) & excluded).sum()
+
+# Testing the STXM values of a stack against summing the pixels of every frame
+def test_stxm_stxmAll():
+    import analysis.stxm
+    from backend import Record
+    frames = np.random.randint(0, 1000, (3, 30, 41)).astype(np.uint16)
+    badmask = np.random.random((30, 41)) > 0.1
+    badmask[14, 30] = True
+    pulse_energy = np.array([1., 2., 4.])
+    evt = {'analysis': {}}
+    analysis.stxm.stxmAll(evt, Record('CCD', frames), pulse_energy=pulse_energy, cx=15.2, cy=14, r=6, badmask=badmask)
+    y, x = np.indices((30, 41))
+    r = np.sqrt((x - 15)**2 + (y - 14)**2)
+    for i in range(3):
+        data = frames[i]*badmask/pulse_energy[i]
+        assert np.isclose(evt['analysis']['stxm bf'].data[i], data[r < 6].sum())
+        assert np.isclose(evt['analysis']['stxm df'].data[i], data[r > 6].sum())
+        assert np.isclose(evt['analysis']['stxm sum'].data[i], data.sum())
+        diffx = data[:29, :15].sum() - data[:29, 16:31].sum()
+        diffy = data[:14, :31].sum() - data[15:29, :31].sum()
+        assert np.isclose(evt['analysis']['stxm diff'].data[i], np.sqrt(diffx**2 + diffy**2))
+    analysis.stxm.stxm(evt, Record('CCD', frames[0]), pulse_energy=2., mode='bf', cx=15.2, cy=14, r=6, badmask=badmask)
+    assert np.isclose(evt['analysis']['stxm bf'].data, (frames[0]*badmask)[r < 6].sum()/2.)
+    # Non-finite pixels only spoil the values they belong to
+    frame = frames[0].astype(float)
+    frame[~badmask] = np.nan
+    frame[14, 30] = np.inf
+    analysis.stxm.stxmAll(evt, Record('CCD', frame), cx=15.2, cy=14, r=6, badmask=badmask)
+    assert np.isclose(evt['analysis']['stxm bf'].data, (frames[0]*badmask)[r < 6].sum())
+    assert np.isinf(evt['analysis']['stxm df'].data)
+
+# Testing the memory-mapped frms6 reader against reshaping the raw frames, including a file that grows
+def test_frms6_reader(tmpdir):
+    import struct
+    from backend.flash_utils.convert_frms6 import Frms6_reader
+    filename = str(tmpdir.join('test.frms6'))
+    raw = np.random.randint(0, 3000, (4, 1024*1024)).astype('=i2')
+    def write_frame(f, i):
+        f.write(struct.pack('4B3Id2HIL24s', 0, 0, 0, 0, 1000+i, i, i, 25., 0, 1024, 70000+i, i, b''))
+        f.write(raw[i].tobytes())
+    with open(filename, 'wb') as f:
+        f.write(struct.pack('2H4B80s2H932s', 1024, 64, 1, 128, 255, 6, b'test', 1024, 1024, b''))
+        for i in range(3):
+            write_frame(f, i)
+    offset = np.random.random((1024, 1024))
+    reader = Frms6_reader(filename, offset=offset)
+    assert reader.nframes == 3
+    assert np.array_equal(reader.header_table()['external_id'], [70000, 70001, 70002])
+    assert np.array_equal(reader.header_table()['tv_sec'], [1208, 1209, 1210])
+    for i in range(3):
+        assert np.array_equal(reader.frame(i), reader.arg_reshape(raw[i]) - offset)
+    reader.parse_frames(start_num=3, num_frames=1)
+    assert reader.frames == []
+    with open(filename, 'ab') as f:
+        write_frame(f, 3)
+    reader.parse_frames(start_num=2, num_frames=2)
+    assert [h.external_id for h in reader.frame_headers] == [70002, 70003]
+    assert np.array_equal(reader.frames[1], reader.arg_reshape(raw[3]) - offset)
+    native = Frms6_reader(filename, shape_str='native')
+    assert np.array_equal(native.frame(1), raw[1].reshape(1024, 1024))
+
+# Testing that the file index of the FLASH backend finds new and growing files without stat'ing settled ones
+def test_flash_file_index(tmpdir, monkeypatch):
+    import time
+    import backend.flash_utils.file_index as file_index
+    pattern = str(tmpdir.join('run_*.frms6'))
+    for i in range(5):
+        tmpdir.join('run_%d.frms6' % i).write('x'*(i+1))
+        os.utime(str(tmpdir.join('run_%d.frms6' % i)), (1000.*i, 1000.*i))
+    tmpdir.join('other.txt').write('')
+    for use_inotify in [False, True]:
+        index = file_index.FileIndex(pattern, accept=lambda f: not f.endswith('run_0.frms6'), interval=0, use_inotify=use_inotify)
+        assert index.update()
+        assert [os.path.basename(f) for f in index.files] == ['run_%d.frms6' % i for i in range(1, 5)]
+        assert index.size(index.by_mtime()[-1]) == 5
+        stats = []
+        def counting_stat(name, stat=os.stat):
+            stats.append(name)
+            return stat(name)
+        monkeypatch.setattr(file_index.os, 'stat', counting_stat)
+        tmpdir.join('run_4.frms6').write('y', mode='a')
+        tmpdir.join('run_5.frms6').write('z')
+        assert index.update()
+        assert index.size(str(tmpdir.join('run_4.frms6'))) == 6
+        assert index.by_mtime()[-1] == str(tmpdir.join('run_5.frms6'))
+        assert str(tmpdir.join('run_1.frms6')) not in stats
+        assert not index.update()
+        monkeypatch.undo()
+        tmpdir.join('run_5.frms6').remove()
+        tmpdir.join('run_4.frms6').write('x'*5)
+        os.utime(str(tmpdir.join('run_4.frms6')), (4000., 4000.))
+
+# Testing the incremental, cached indexes of the FLASH DAQ and motor files
+def test_flash_metadata_index(tmpdir):
+    from backend.flash_utils.metadata_index import DAQIndex
+    from backend.flash_utils.tomas_motors import MotorPositions
+    cache_dir = str(tmpdir.join('cache'))
+    daq = tmpdir.join('daq.txt')
+    daq.write(''.join('%d %d %.3f %s\n' % (1000+i, 500+i, 4.5, 'nan' if i == 3 else '%d' % i) for i in range(10)) + '1010 510')
+    index = DAQIndex(str(daq), cache_dir=cache_dir, cache_interval=0)
+    assert index.rows == 10 and index.find(505) == 5 and index.find(510) is None
+    assert np.isnan(index.columns['gmd'][3]) and index.columns['gmd'][4] == 4
+    daq.write(' 4.6 7\n1011 500 4.7 8\n', mode='a')
+    assert index.find(510) == 10 and index.find(500) == 0
+    assert index.columns['wavelength'][10] == 4.6
+    parsed = []
+    class CountingIndex(DAQIndex):
+        def parse(self, lines):
+            parsed.extend(lines)
+            return DAQIndex.parse(self, lines)
+    CountingIndex.__name__ = 'DAQIndex'
+    daq.write('1012 512 4.8 9\n', mode='a')
+    restarted = CountingIndex(str(daq), cache_dir=cache_dir)
+    assert parsed == ['1012 512 4.8 9'] and restarted.find(512) == 12 and restarted.find(503) == 3
+    daq.write('2000 600 5.0 1\n')
+    assert CountingIndex(str(daq), cache_dir=cache_dir).find(600) == 0
+    motors = tmpdir.join('motors.txt')
+    motors.write('10.0 InjectorX 1.0 InjectorY 2.0\n20.0 InjectorX 1.5\n30.0 InjectorX 2.5 InjectorY 3.0\n')
+    positions = MotorPositions(str(motors), cache_dir=cache_dir)
+    assert positions.get(5.) == {'InjectorX': 1.0, 'InjectorY': 2.0}
+    assert positions.get(25.) == {'InjectorX': 1.5}
+    motors.write('40.0 InjectorZ 7.0\n', mode='a')
+    assert positions.get(30.) == {'InjectorX': 2.5, 'InjectorY': 3.0}
+    assert positions.get(100.) == {'InjectorZ': 7.0}
+
+# Testing that the offline scheduler hands out every frame of all files once, in contiguous chunks
+def test_flash_offline_scheduler():
+    from backend.flash_utils.offline_scheduler import OfflineScheduler
+    frames = {'a.frms6': 5, 'b.frms6': 0, 'c.frms6': 21}
+    scheduler = OfflineScheduler(sorted(frames), frames.get, chunk_size=8)
+    assert scheduler.nframes == 26
+    assert scheduler.chunks == [(0, 0, 5), (2, 0, 8), (2, 8, 16), (2, 16, 21)]
+    items = []
+    item = scheduler.next()
+    while item is not None:
+        items.append(item)
+        item = scheduler.next()
+    assert items == [(f, i) for f in sorted(frames) for i in range(frames[f])]
+    assert scheduler.done and scheduler.next() is None
+
 # Testing Tof hitfinder
 def test_countTof():
     evt = DummyTranslator(state).next_event()
@@ -128,6 +448,108 @@ def test_countHitscore():
     assert evt['analysis']['predef: isHit'].data == True
     assert evt['analysis']['predef: hitscore'].data == 300
 
+# Testing the AGIPD calibration
+# ------------------------------
+
+# Testing the calibration of a train against the calibration of single pixels
+def test_agipd_calibrate_train(tmpdir):
+    import h5py
+    import analysis.agipd
+    np.random.seed(0)
+    shape = (3, 64, 4, 3)
+    filenames = []
+    consts = []
+    for p in range(16):
+        c = {'Badpixel': np.random.randint(0, 2, shape).astype(np.uint8) * (np.random.random(shape) < 0.2),
+             'AnalogOffset': np.random.randint(0, 100, shape).astype(np.int16),
+             'RelativeGain': np.random.random(shape).astype(np.float32),
+             'DigitalGainLevel': np.random.randint(0, 1000, shape).astype(np.uint16)}
+        filenames.append(str(tmpdir.join('calib%02d.h5' % p)))
+        with h5py.File(filenames[-1], 'w') as f:
+            for k, v in c.items():
+                f[k] = v
+        consts.append(c)
+    cells = np.array([3, 0, 63, 17, 3])
+    adu  = np.random.randint(0, 1000, (5, 16, 4, 3)).astype(np.uint16)
+    gain = np.random.randint(0, 1000, (5, 16, 4, 3)).astype(np.uint16)
+    for nthreads in [None, 4]:
+        calibrator = analysis.agipd.AGIPD_Calibrator(filenames, nthreads=nthreads)
+        out, mask = calibrator.calibrate_train(adu, gain, cells)
+        for i, c in enumerate(cells):
+            for p in range(16):
+                stage = (gain[i, p] >= consts[p]['DigitalGainLevel'][1, c]).astype(int)
+                for y, x in np.ndindex(4, 3):
+                    g = stage[y, x]
+                    good = consts[p]['Badpixel'][g, c, y, x] == 0
+                    expected = (adu[i, p, y, x] - np.float32(consts[p]['AnalogOffset'][g, c, y, x])) * consts[p]['RelativeGain'][g, c, y, x] * good
+                    assert np.isclose(out[i, p, y, x], expected)
+                    assert mask[i, p, y, x] == good
+        panel, panel_mask = calibrator.calibrate_panel(adu[2, 5], gain[2, 5], cellID=63, panelID=5, apply_gain_switch=False)
+        assert np.array_equal(panel, out[2, 5]) and np.array_equal(panel_mask, mask[2, 5])
+        subset, subset_mask = calibrator.calibrate_train(adu[:, [7, 2]], gain[:, [7, 2]], cells, panelID=[7, 2])
+        assert np.array_equal(subset, out[:, [7, 2]])
+
+# Testing the assembly plans against assembling with the pixel maps
+def test_assembly_plan():
+    import utils.array
+    np.random.seed(0)
+    shape = (40, 50)
+    yx = np.random.permutation(shape[0]*shape[1])[:3*8*10]
+    y, x = np.unravel_index(yx, shape)
+    y, x = y.reshape(3, 8, 10), x.reshape(3, 8, 10)
+    frames = np.random.random((4, 3, 8, 10)).astype(np.float32)
+    expected = np.zeros((4,) + shape, dtype=np.float32)
+    for i in range(4):
+        expected[i][y, x] = frames[i]
+    plan = utils.array.AssemblyPlan(y, x, shape)
+    img = plan.assemble(frames[0])
+    assert np.array_equal(img, expected[0])
+    assert plan.assemble(frames[1]) is not img
+    first = plan.assemble_batch(frames)
+    assert np.array_equal(first, expected)
+    second = plan.assemble_batch(frames[:, :, ::-1].copy())
+    assert np.array_equal(first, expected) and not np.shares_memory(first, second)
+    subset = plan.assemble(frames[0, [2, 0]], panels=[2, 0])
+    expected_subset = np.zeros(shape, dtype=np.float32)
+    expected_subset[y[[2, 0]], x[[2, 0]]] = frames[0, [2, 0]]
+    assert np.array_equal(subset, expected_subset)
+    binned = utils.array.AssemblyPlan(y, x, shape, binning=4, mode='sum').assemble(frames[0])
+    assert np.allclose(binned, np.add.reduceat(np.add.reduceat(expected[0], np.arange(0, 40, 4), axis=0), np.arange(0, 50, 4), axis=1))
+    sampled = utils.array.AssemblyPlan(y, x, shape, binning=4).assemble(frames[0])
+    assert np.array_equal(sampled, expected[0][::4, ::4])
+
+# Testing the pulses of EuXFEL trains with bad cells, skipped pulses and several pulses per event
+def test_euxfel_pulses():
+    from backend.euxfel import EUxfelPulseTranslator, MAX_TRAIN_LENGTH
+    data = np.random.random((3, 4, 10))
+    train = {'DET': {'image.data': data, 'image.pulseId': np.arange(10), 'names': ['a', 'b']}}
+    meta = {'DET': {'timestamp.tid': 7, 'image.pulseId': 'meta'}}
+    translator = EUxfelPulseTranslator.__new__(EUxfelPulseTranslator)
+    translator._cell_filter = np.ones(MAX_TRAIN_LENGTH, dtype=bool)
+    translator._cell_filter[[1, 4]] = False
+    translator._pulses = []
+    translator._next_pulse = 0
+    translator.next_train = lambda: (train, meta)
+    translator._skip_n_pulses = 1
+    translator._pulses_per_event = 1
+    assert translator._pulse_indices(translator._cell_filter[:10]) == [0, 2, 5, 7, 9]
+    translator._pulses_per_event = 2
+    assert [list(p) for p in translator._pulse_indices(translator._cell_filter[:10])] == [[0, 2], [5, 7], [9]]
+    pulses = [translator.next_event()._evt for i in range(4)]
+    assert [list(p.index) for p in pulses] == [[0, 2], [5, 7], [9], [0, 2]]
+    source = pulses[1]['DET']
+    assert source._cache == {}
+    assert np.array_equal(source['image.data'], data[..., [5, 7]])
+    assert list(source._cache) == ['image.data']
+    assert source['image.pulseId'] == 'meta' and source['timestamp.tid'] == 7
+    assert 'names' not in source and 'image.pulseId' in source
+    assert sorted(source.keys()) == ['image.data', 'image.pulseId', 'timestamp.tid']
+    # A single pulse is a view of the train
+    translator._pulses_per_event = 1
+    translator._pulses = []
+    pulse = translator.next_event()._evt
+    assert pulse.index == 0 and np.shares_memory(pulse['DET']['image.data'], data)
+
 # Testing photon count vs energy
 #def test_countPhotonsvsEnergy():
 #    evt = DummyTranslator(state).next_event()
@@ -12,6 +12,8 @@ def test_detector_example():
     run_hummingbird(conf=__thisdir__ + '/../examples/basic/detector.py')
 def test_hitfinding_example():
     run_hummingbird(conf=__thisdir__ + '/../examples/basic/hitfinding.py')
+def test_pipeline_example():
+    run_hummingbird(conf=__thisdir__ + '/../examples/basic/pipeline.py')
 def test_correlation_example():
     run_hummingbird(conf=__thisdir__ + '/../examples/basic/correlation.py')
 def test_lcls_mimi_dark_example():
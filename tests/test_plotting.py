@@ -0,0 +1,48 @@
+import os, sys
+import numpy as np
+
+# Make sure we are relative to the root path
+__thisdir__ = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, __thisdir__ + "/../src")
+
+from plotting.correlation import _TiledMap
+from utils.array import RunningHistogram
+
+# Testing the tiled map against a dense map, including negative bins and exchanging tiles
+def test_tiled_map():
+    np.random.seed(0)
+    iy = np.random.randint(-100, 300, 5000)
+    ix = np.random.randint(-50, 500, 5000)
+    z = np.random.random(5000)
+    dense = np.zeros((2, 400, 550))
+    np.add.at(dense[0], (iy+100, ix+50), z)
+    np.add.at(dense[1], (iy+100, ix+50), 1.)
+    full = _TiledMap(tile=16, batch=300)
+    part = _TiledMap(tile=16, batch=300)
+    for i in range(5000):
+        (full if i % 2 else part).add(iy[i], ix[i], z[i], 1.)
+    keys, tiles = part.pop_tiles()
+    assert not part.tiles
+    full.add_tiles(keys, tiles)
+    assert np.allclose(full.window(-100, -50, 400, 550), dense)
+    assert np.allclose(full.window(10, 20, 33, 7), dense[:, 110:143, 70:77])
+    assert not full.window(1000, 1000, 5, 5).any()
+
+# Testing the running histogram with blocks of values against histograms of the window
+def test_running_histogram():
+    np.random.seed(0)
+    values = np.random.random(300)*120 - 10
+    length, window, bins = 10, 7, 12
+    rh = RunningHistogram(length, window, bins, 0, 100)
+    i = 0
+    for n in [1, 0, 5, 30, 2, 100, 1, 161]:
+        out = rh.next(values[i:i+n])
+        i += n
+        assert out.shape == (length, bins)
+        for row, j in zip(out[::-1], range(i-1, max(i-1-length, -1), -1)):
+            b = np.clip(np.round(values[max(j-window+1, 0):j+1]/100.*(bins-1)), 0, bins-1)
+            assert np.array_equal(row, np.bincount(b.astype(int), minlength=bins))
+
+# Remove traces from testing
+def teardown_module():
+    sys.path.pop(0)
@@ -0,0 +1,169 @@
+import os, sys
+import numpy as np
+
+# Make sure we are relative to the root path
+__thisdir__ = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, __thisdir__ + "/../src")
+
+from interface.ringbuffer import RingBuffer, CompactRingBuffer, MappedRingBuffer, RingBufferStr
+from interface.plotdata import PlotData
+
+# Helper for comparing extend with repeated append
+def compare_extend_to_append(blocks, maxlen):
+    rb_append = RingBuffer(maxlen)
+    rb_extend = RingBuffer(maxlen)
+    for block in blocks:
+        for value in block:
+            rb_append.append(value)
+        rb_extend.extend(block)
+        assert len(rb_extend) == len(rb_append)
+        assert rb_extend.number_of_added_elements == rb_append.number_of_added_elements
+        assert np.array_equal(np.array(rb_extend), np.array(rb_append))
+        assert np.array_equal(rb_extend[-1], rb_append[-1])
+
+# Testing extend with scalars, including wrapping around the end of the buffer
+def test_ringbuffer_extend_scalars():
+    blocks = [np.arange(i*10, i*10+n, dtype=np.float64) for i, n in enumerate([3, 5, 1, 7, 4, 9])]
+    compare_extend_to_append(blocks, 10)
+
+# Testing extend with blocks larger than the capacity
+def test_ringbuffer_extend_larger_than_capacity():
+    blocks = [np.arange(25), np.arange(3)+100, np.arange(11)+200]
+    compare_extend_to_append(blocks, 10)
+
+# Testing extend with images
+def test_ringbuffer_extend_images():
+    blocks = [np.random.random((n, 4, 3)) for n in [2, 6, 1, 8]]
+    compare_extend_to_append(blocks, 5)
+
+# Testing extend of the string buffer
+def test_ringbufferstr_extend():
+    rb = RingBufferStr(4)
+    rb.extend(['a', 'b', 'c'])
+    rb.extend(['d', 'e', 'f', 'g', 'h', 'i'])
+    assert len(rb) == 4
+    assert rb[len(rb)-1] == 'i'
+
+# Testing that extending a PlotData keeps the time metadata of x
+def test_plotdata_extend():
+    class Parent(object):
+        conf = {}
+    pd_append = PlotData(Parent(), 'History(test)', maxlen=8)
+    pd_extend = PlotData(Parent(), 'History(test)', maxlen=8)
+    ys = np.arange(20)*2
+    xs = np.arange(20, dtype=np.float64)
+    xs.dtype = np.dtype(xs.dtype, metadata={'units': 's'})
+    for i in range(20):
+        pd_append.append(ys[i], xs[i, ...], 'msg')
+    pd_extend.extend(ys, xs, 'msg')
+    assert np.array_equal(np.array(pd_extend.y), np.array(pd_append.y))
+    assert np.array_equal(np.array(pd_extend.x), np.array(pd_append.x))
+    assert np.array(pd_extend.x).dtype.metadata['units'] == 's'
+
+# Testing that summing over a block gives the same running mean as summing over every value
+def test_plotdata_sum_over_block():
+    class Parent(object):
+        conf = {}
+    pd_single = PlotData(Parent(), 'History(test)', maxlen=8)
+    pd_block = PlotData(Parent(), 'History(test)', maxlen=8)
+    ys = np.random.random(20)
+    xs = np.arange(20, dtype=np.float64)
+    for i in range(20):
+        pd_single.sum_over(ys[i, ...], xs[i, ...], 'msg')
+    pd_block.sum_over_block(ys[:5], xs[:5], 'msg')
+    pd_block.sum_over_block(ys[5:], xs[5:], 'msg')
+    assert np.allclose(np.array(pd_block.y), np.array(pd_single.y))
+    assert np.isclose(np.array(pd_block.y)[0], ys.mean())
+
+# Testing the compact ring buffer against the regular one, reading at random times
+def test_compact_ringbuffer():
+    np.random.seed(0)
+    for maxlen in [1, 2, 5, 8]:
+        rb = RingBuffer(maxlen)
+        crb = CompactRingBuffer(maxlen)
+        for i in range(40):
+            block = np.random.random((np.random.randint(1, 12), 3, 2))
+            if np.random.random() < 0.5:
+                for value in block:
+                    rb.append(value)
+                    crb.append(value)
+            else:
+                rb.extend(block)
+                crb.extend(block)
+            assert np.array_equal(crb[-1], rb[-1])
+            assert np.array_equal(crb[0, 1], rb[0, 1])
+            if np.random.random() < 0.5:
+                assert np.array_equal(np.array(crb), np.array(rb))
+                assert np.array_equal(crb[1:], rb[1:])
+                assert crb.shape == rb.shape
+        assert crb.nbytes*2 == rb.nbytes
+        rb.resize(3)
+        crb.resize(3)
+        assert np.array_equal(np.array(crb), np.array(rb))
+
+# Testing that image broadcasts are stored in a compact ring buffer
+def test_plotdata_image_buffer():
+    class Parent(object):
+        conf = {'image': {'data_type': 'image'}, 'vector': {'data_type': 'vector'}}
+    pd_image = PlotData(Parent(), 'image')
+    pd_image.append(np.zeros((4, 4)), 1., '')
+    assert isinstance(pd_image.y, CompactRingBuffer)
+    pd_vector = PlotData(Parent(), 'vector')
+    pd_vector.append(np.zeros(4), 1., '')
+    assert not isinstance(pd_vector.y, CompactRingBuffer)
+    restored = PlotData(Parent(), 'image')
+    restored.restore_state({'x': pd_image.x.save_state(), 'y': pd_image.y.save_state(),
+                            'l': pd_image.l.save_state(), 'title': 'image',
+                            'maxlen': pd_image.maxlen, 'recordhistory': False}, Parent())
+    assert isinstance(restored.y, CompactRingBuffer)
+    assert np.array_equal(np.array(restored.y), np.array(pd_image.y))
+
+# Testing the memory-mapped ring buffer against the regular one and reopening it from disk
+def test_mapped_ringbuffer(tmpdir):
+    filename = str(tmpdir.join('history'))
+    rb = RingBuffer(6)
+    mrb = MappedRingBuffer(6, filename)
+    for block in [np.arange(4.), np.arange(3.)+10, np.arange(9.)+20]:
+        rb.extend(block)
+        mrb.extend(block)
+        assert np.array_equal(np.array(mrb), np.array(rb))
+    mrb.append(99.)
+    rb.append(99.)
+    state = mrb.save_state()
+    reopened = MappedRingBuffer.restore_state(state)
+    assert len(reopened) == len(rb)
+    assert reopened.number_of_added_elements == rb.number_of_added_elements
+    assert np.array_equal(np.array(reopened), np.array(rb))
+    reopened.resize(3)
+    rb.resize(3)
+    assert np.array_equal(np.array(reopened), np.array(rb))
+
+# Testing the interface histograms filled from a ring buffer against numpy.histogram
+def test_histogram_from_ringbuffer():
+    from interface.ui.plot_window import Histogram, NormalizedHistogram
+    np.random.seed(1)
+    rb = RingBuffer(1000)
+    rb_pairs = RingBuffer(1000)
+    histogram = Histogram(0, 10, 20)
+    autorange = Histogram(4, 6, 20, autorange=True)
+    normalized = NormalizedHistogram(0, 10, 20)
+    values = np.random.normal(5, 2, 600)
+    weights = np.random.random(600)
+    for i in range(0, 600, 150):
+        rb.extend(values[i:i+150])
+        rb_pairs.extend(np.array([values[i:i+150], weights[i:i+150]]).T)
+        histogram.add_values_from_ringbuffer(rb)
+        autorange.add_values_from_ringbuffer(rb)
+        normalized.add_values_from_ringbuffer(rb_pairs)
+    assert np.array_equal(histogram.values_y, np.histogram(values, bins=20, range=(0, 10))[0])
+    assert autorange.values_y.sum() == 600
+    edges = autorange.values_x - autorange._step/2.
+    assert edges[0] <= values.min() and edges[-1] + autorange._step > values.max()
+    assert np.array_equal(autorange.values_y, np.histogram(values, bins=np.append(edges, edges[-1] + autorange._step))[0])
+    num = np.histogram(values, bins=20, range=(0, 10), weights=weights)[0]
+    den = np.histogram(values, bins=20, range=(0, 10))[0]
+    assert np.allclose(normalized.values_y[den > 0], num[den > 0]/den[den > 0])
+
+# Remove traces from testing
+def teardown_module():
+    sys.path.pop(0)